@@ -14,16 +14,90 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
-import warnings
-
-from .record_readers import *
-from .gps_pressure_reader import *
-from .heart_rate_reader import *
-from .altitude_filter import *
-from .altitude_rate_filter import *
-from .altitude_rate_smoother import *
-
-try:
-    from .elevation import *
-except ImportError as e:
-    warnings.warn("Elevation module is not available: %s" % str(e))
\ No newline at end of file
+import importlib
+
+# Version of the package, recorded by benchmarks and part of the keys of cached results
+__version__ = '0.1.0'
+
+# Public names of the submodules. Submodules are imported on the first access to any of their
+# names, so that importing the package doesn't load scipy, matplotlib, pyproj, GDAL or numba
+# until a feature actually needs them.
+_SUBMODULE_NAMES = {
+    'record_readers': ['RecordReaderError', 'RecordReader', 'RecordToText', 'RecordBatteryToText',
+                       'RecordNmeaToText', 'V12_MAX_DEVICE', 'V12_MAX_VALUES', 'V12_MAX_LENGTH',
+                       'V12_TIME_BACKWARD', 'V12_TIME_FORWARD', 'read_binary', 'read_text'],
+    'gps_pressure_reader': ['GpsPressureReader'],
+    'heart_rate_reader': ['DEVICE_NAME_UUID', 'APPEARANCE_UUID', 'HEART_RATE_UUID',
+                          'BODY_SENSOR_LOCATION_UUID', 'SYSTEM_ID_UUID',
+                          'MODEL_NUMBER_STRING_UUID', 'SERIAL_NUMBER_STRING_UUID',
+                          'FIRMWARE_REVISION_STRING_UUID', 'HARDWARE_REVISION_STRING_UUID',
+                          'SOFTWARE_REVISION_STRING_UUID', 'MANUFACTURER_NAME_STRING_UUID',
+                          'BATTERY_LEVEL_UUID', 'HEART_RATE_FORMAT_MASK',
+                          'HEART_RATE_FORMAT_UINT8', 'HEART_RATE_FORMAT_UINT16',
+                          'HEART_RATE_CONTACT_MASK', 'HEART_RATE_CONTACT_NOT_DETECTED',
+                          'HEART_RATE_CONTACT_DETECTED', 'HEART_RATE_ENERGY_EXPANDED_MASK',
+                          'HEART_RATE_ENERGY_EXPANDED_PRESENT', 'HEART_RATE_RR_INTERVALS_MASK',
+                          'HEART_RATE_RR_INTERVALS_PRESENT', 'HeartRateReader'],
+    'atmosphere': ['PRESSURE_EXPONENT', 'PRESSURE_FACTOR', 'STANDARD_LAPSE_RATE', 'CELSIUS_ZERO',
+                   'pressure_ratio', 'StandardAtmosphere', 'LapseRateAtmosphere',
+                   'make_atmosphere'],
+    'altitude_filter': ['AltitudeFilter'],
+    'altitude_rate_filter': ['AltitudeRateFilter'],
+    'altitude_rate_smoother': ['AltitudeRateSmoother'],
+    'altitude_accel_filter': ['STANDARD_GRAVITY', 'events_array', 'vertical_acceleration',
+                              'AltitudeAccelFilter'],
+    'archive': ['ARCHIVE_MAGIC', 'ARCHIVE_VERSION', 'ARCHIVE_COMPRESSION', 'ARCHIVE_SCHEMA',
+                'ArchiveWriter', 'Archive', 'write_archive', 'read_archive'],
+    'tuning': ['TuningCase', 'dem_case', 'repeat_case', 'Uniform', 'LogUniform', 'grid_candidates',
+               'random_candidates', 'filter_arguments', 'evaluate', 'Sweep'],
+    'estimation': ['ESTIMATED_PARAMETERS', 'LIKELIHOOD_OUTLIER_MODES', 'EVENT_GPS',
+                   'EVENT_PRESSURE', 'merge_events', 'filter_defaults', 'LikelihoodModel'],
+    'synthetic': ['SYNTHETIC_START_TIME', 'EARTH_RADIUS', 'MAGIC_WORD', 'synthetic_terrain',
+                  'SyntheticRecording', 'write_geotiff'],
+    'route_alignment': ['ALIGNMENT_RADIUS', 'ALIGNMENT_SPACING', 'ALIGNMENT_WINDOW', 'arc_length',
+                        'route_distance', 'dtw_window', 'dtw_path', 'align_points'],
+    'consensus': ['route_positions', 'ConsensusProfile'],
+    'nmea': ['NMEA_UERE', 'NMEA_EPOCH_DELAY', 'NMEA_GGA_DTYPE', 'NMEA_GSA_DTYPE', 'NMEA_RMC_DTYPE',
+             'NMEA_FIX_DTYPE', 'NMEA_SENTENCES', 'KNOT', 'nmea_checksum', 'parse_nmea',
+             'NmeaReader'],
+    'smoothing': ['DIRECT_CONVOLUTION_LIMIT', 'SMOOTHING_MIN_WEIGHT',
+                  'SMOOTHING_WEIGHT_TOLERANCE', 'dpss_window', 'swt_window', 'convolve_valid',
+                  'smooth', 'StreamingSmoother'],
+    'resampling': ['RESAMPLING_METHODS', 'GAP_POLICIES', 'uniform_grid', 'event_grid', 'IndexMap',
+                   'Resampler'],
+    'export': ['EXPORT_METADATA_KEY', 'FILTER_COLUMNS', 'FILTER_GPS_COLUMNS', 'filter_parameters',
+               'reader_columns', 'filter_columns', 'heart_rate_columns', 'aligned_columns',
+               'recording_columns', 'export_metadata', 'arrow_table', 'arrow_tables',
+               'table_metadata', 'data_frames', 'write_dataset'],
+    'track_store': ['TRACK_STORE_VERSION', 'TRACK_CHUNK_POINTS', 'time_value', 'local_projection',
+                    'densify', 'TrackStore'],
+    'result_cache': ['RESULT_CACHE_VERSION', 'RESULT_CACHE_SIZE', 'RESULT_ARRAYS', 'file_digest',
+                     'code_digest', 'ResultCache'],
+    'decimation': ['DECIMATION_METHODS', 'm4_indices', 'm4', 'lttb_indices', 'lttb',
+                   'decimation_indices', 'MinMaxPyramid'],
+    'elevation': ['GeoFile', 'GeoFiles'],
+}
+
+_SUBMODULES = ['filter_base', 'profiling'] + list(_SUBMODULE_NAMES)
+
+_NAME_SUBMODULE = {name: module for module, names in _SUBMODULE_NAMES.items() for name in names}
+
+# Elevation needs GDAL, its names are left out so that star imports work without it
+__all__ = [name for module, names in _SUBMODULE_NAMES.items() if module != 'elevation'
+           for name in names]
+
+
+def __getattr__(name):
+    if name in _NAME_SUBMODULE:
+        value = getattr(importlib.import_module('.' + _NAME_SUBMODULE[name], __name__), name)
+    elif name in _SUBMODULES:
+        value = importlib.import_module('.' + name, __name__)
+    else:
+        raise AttributeError('module %r has no attribute %r' % (__name__, name))
+    # Later accesses find the name in the module dictionary and skip this function
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_NAME_SUBMODULE) | set(_SUBMODULES))
@@ -0,0 +1,396 @@
+# -*- coding: utf-8 -*-
+#
+#  (C) Copyright 2013, 2016 Wojciech Mruczkiewicz
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from .atmosphere import (PRESSURE_EXPONENT, PRESSURE_FACTOR, StandardAtmosphere, make_atmosphere,
+                         pressure_ratio)
+from .estimation import EVENT_GPS, merge_events
+from . import profiling
+from .filter_base import (FilterBase, OUTLIER_MODES, StandardCovariance, robust_variance,
+                          make_covariance)
+from math import exp, sqrt
+import itertools
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+if njit is not None:
+    _pressure_ratio = njit(inline='always')(pressure_ratio)
+else:
+    _pressure_ratio = pressure_ratio
+
+STANDARD_GRAVITY = 9.80665
+
+
+def events_array(events, columns):
+    if isinstance(events, np.ndarray):
+        return events.reshape(-1, columns).astype(float)
+    return np.fromiter(itertools.chain.from_iterable(events), dtype=float,
+                       count=columns*len(events)).reshape(-1, columns)
+
+
+def vertical_acceleration(accel_events, gyro_events=None, time_constant=1.0):
+    # Upward acceleration with gravity removed, at the accelerometer times. The gravity direction
+    # in the device frame is tracked by a complementary filter, the accelerometer low-passed with
+    # the given time constant and rotations measured by the gyroscope passed through the
+    # complementary high-pass. Rotations are linearized around the low-passed direction so that
+    # both parts are linear filters. The heading, which a magnetometer would add, does not affect
+    # the vertical component.
+    import scipy.signal as signal
+    accel = events_array(accel_events, 4)
+    time, a = accel[:, 0], accel[:, 1:]
+    if len(time) < 2:
+        return time, np.zeros(len(time))
+    dt = np.diff(time, prepend=time[0]) / 1000.0
+    beta = exp(-np.median(dt[1:]) / time_constant)
+    g, _ = signal.lfilter([1.0 - beta], [1.0, -beta], a, axis=0, zi=beta*a[:1])
+    if gyro_events is not None and len(gyro_events) > 1:
+        gyro = events_array(gyro_events, 4)
+        w = np.column_stack([np.interp(time, gyro[:, 0], gyro[:, i]) for i in (1, 2, 3)])
+        g = g + signal.lfilter([beta], [1.0, -beta], -np.cross(w, g)*dt[:, np.newaxis], axis=0)
+    n = g / np.linalg.norm(g, axis=1)[:, np.newaxis]
+    return time, np.einsum('ij,ij->i', a, n) - STANDARD_GRAVITY
+
+
+def _accel_update(x, P, H, r, R, gate, mode, dof):
+    # StandardCovariance.update of the 4 states with the gating of robust_variance
+    PH = np.zeros(4)
+    HP = np.zeros(4)
+    for i in range(4):
+        for j in range(4):
+            PH[i] += P[i, j]*H[j]
+            HP[j] += H[i]*P[i, j]
+    HPH = H[0]*PH[0] + H[1]*PH[1] + H[2]*PH[2] + H[3]*PH[3]
+    S = HPH + R
+    nu2 = r*r/S
+    if mode == 1:
+        if nu2 > gate*gate:
+            S *= sqrt(nu2)/gate
+    elif mode == 2:
+        S = HPH + R*((dof + nu2)/(dof + 1.0))
+    for i in range(4):
+        K = PH[i]/S
+        x[i] += K*r
+        for j in range(4):
+            P[i, j] -= K*HP[j]
+
+
+def _accel_kernel(kind, time, value, accuracy, velocity, distance, x, P, state, P0,
+                  gps_var_factor, pressure_var, accel_noise, altitude_noise, altitude_rate_noise,
+                  pressure_noise, bias_noise, exponent, factor, gate, mode, dof, out_gps,
+                  out_pressure):
+    # AltitudeAccelFilter.on_gps and on_pressure written out for the standard covariance and
+    # atmosphere. The state, the covariance and the filter variables held in state (started, last
+    # GPS altitude, last time and its acceleration integrals) are updated in place.
+    started = state[0] != 0.0
+    last_altitude, last_time, v0, d0 = state[1], state[2], state[3], state[4]
+    H = np.zeros(4)
+    F = np.identity(4)
+    FP = np.zeros((4, 4))
+    updates = 0
+    ig = ip = 0
+    for k in range(len(kind)):
+        if kind[k] == EVENT_GPS:
+            last_altitude = value[k]
+            if started:
+                H[:] = 0.0
+                H[0] = 1.0
+                _accel_update(x, P, H, value[k] - x[0], accuracy[k]*accuracy[k]*gps_var_factor,
+                              gate, 0, dof)
+                updates += 1
+            out_gps[ig, 0] = x[0]
+            out_gps[ig, 1] = P[0, 0]
+            ig += 1
+            continue
+        if not started and last_altitude != 0.0:
+            ratio, _ = _pressure_ratio(last_altitude, exponent, factor)
+            x[0] = last_altitude
+            x[1] = 0.0
+            x[2] = value[k]/ratio
+            x[3] = 0.0
+            P[:, :] = P0
+            last_time, v0, d0 = time[k], velocity[k], distance[k]
+            started = True
+        elif started:
+            dt = abs(time[k] - last_time)/1000.0
+            v1, d1 = velocity[k], distance[k]
+            F[0, 1] = dt
+            F[0, 3] = -0.5*dt*dt
+            F[1, 3] = -dt
+            for i in range(4):
+                for j in range(4):
+                    FP[i, j] = 0.0
+                    for m in range(4):
+                        FP[i, j] += F[i, m]*P[m, j]
+            for i in range(4):
+                for j in range(4):
+                    P[i, j] = 0.0
+                    for m in range(4):
+                        P[i, j] += FP[i, m]*F[j, m]
+            qa = accel_noise*dt
+            P[0, 0] += altitude_noise*dt + qa*dt*dt/12.0 + 0.25*qa*dt*dt
+            P[0, 1] += 0.5*qa*dt
+            P[1, 0] += 0.5*qa*dt
+            P[1, 1] += altitude_rate_noise*dt + qa
+            P[2, 2] += pressure_noise*dt
+            P[3, 3] += bias_noise*dt
+            x[0] += dt*x[1] - 0.5*dt*dt*x[3] + d1 - d0 - v0*dt
+            x[1] += v1 - v0 - dt*x[3]
+            v0, d0, last_time = v1, d1, time[k]
+
+            ratio, slope = _pressure_ratio(x[0], exponent, factor)
+            H[0] = x[2]*slope
+            H[2] = ratio
+            _accel_update(x, P, H, value[k] - x[2]*ratio, pressure_var, gate, mode, dof)
+            updates += 1
+        out_pressure[ip, 0] = x[0]
+        out_pressure[ip, 1] = P[0, 0]
+        out_pressure[ip, 2] = x[1]
+        out_pressure[ip, 3] = x[2]
+        out_pressure[ip, 4] = x[3]
+        ip += 1
+    state[0] = 1.0 if started else 0.0
+    state[1], state[2], state[3], state[4] = last_altitude, last_time, v0, d0
+    return updates
+
+
+if njit is not None:
+    _accel_update = njit(cache=True)(_accel_update)
+    _accel_kernel = njit(cache=True)(_accel_kernel)
+
+
+class AltitudeAccelFilter(FilterBase):
+    PRESSURE_EXPONENT = PRESSURE_EXPONENT
+    PRESSURE_FACTOR = PRESSURE_FACTOR
+
+    # Altitude, altitude rate, MSL pressure and accelerometer bias. Vertical acceleration drives
+    # the prediction between pressure samples. All accelerometer samples of a prediction step are
+    # integrated at once from precomputed cumulative integrals, so the filter loop runs at the
+    # pressure rate whatever the accelerometer rate is. The loop is compiled with numba when it is
+    # installed.
+
+    def __init__(self, gps_var_factor=6.0**2, pressure_var=0.3**2, accel_noise=0.1,
+                 altitude_noise=1e-3, altitude_rate_noise=1e-4, pressure_noise=1e-5,
+                 bias_noise=1e-6, P0=np.diag([200.0, 50.0, 2.0, 0.1]),
+                 gravity_time_constant=1.0, outlier_gate=3.0, outlier_mode='huber',
+                 outlier_dof=4.0, covariance='standard', atmosphere=None):
+        if outlier_mode not in OUTLIER_MODES:
+            raise ValueError('Unknown outlier mode: %s' % outlier_mode)
+        self._gps_var_factor = gps_var_factor
+        self._pressure_var = pressure_var
+        self._accel_noise = accel_noise
+        self._altitude_noise = altitude_noise
+        self._altitude_rate_noise = altitude_rate_noise
+        self._pressure_noise = pressure_noise
+        self._bias_noise = bias_noise
+        self._P0 = P0
+        self._gravity_time_constant = gravity_time_constant
+        self._outlier_gate = outlier_gate
+        self._outlier_mode = outlier_mode
+        self._outlier_dof = outlier_dof
+
+        self._altitude_gps = list()
+        self._altitude_sd_gps = list()
+        self._altitude = list()
+        self._altitude_sd = list()
+        self._altitude_rate = list()
+        self._pressure_msl = list()
+        self._accel_bias = list()
+
+        self._x = np.ones(4)*np.NaN
+        self._P = make_covariance(np.ones((4, 4))*np.NaN, covariance)
+        self._atmosphere = make_atmosphere(atmosphere)
+
+        self._accel_time = np.zeros(0)
+        self._accel = np.zeros(0)
+        self._velocity = np.zeros(0)
+        self._distance = np.zeros(0)
+
+        self._started = False
+        self._last_time = None
+        self._last_integrals = None
+        self._last_altitude = None
+
+    def altitude_gps(self):
+        return np.array(self._altitude_gps)
+
+    def altitude_sd_gps(self):
+        return np.array(self._altitude_sd_gps)
+
+    def altitude(self):
+        return np.array(self._altitude)
+
+    def altitude_sd(self):
+        return np.array(self._altitude_sd)
+
+    def altitude_rate(self):
+        return np.array(self._altitude_rate)
+
+    def pressure_msl(self):
+        return np.array(self._pressure_msl)
+
+    def accel_bias(self):
+        return np.array(self._accel_bias)
+
+    def execute(self, gps_events, pressure_events, accel_events=None, gyro_events=None):
+        if accel_events is not None and len(accel_events) > 1:
+            with profiling.span('vertical_acceleration'):
+                time, a = vertical_acceleration(accel_events, gyro_events,
+                                                self._gravity_time_constant)
+            # Integrals of the acceleration held constant between samples
+            tau = np.diff(time) / 1000.0
+            velocity = np.concatenate(([0.0], np.cumsum(a[:-1]*tau)))
+            distance = np.concatenate(([0.0], np.cumsum(velocity[:-1]*tau + 0.5*a[:-1]*tau**2)))
+            self._accel_time, self._accel = time, a
+            self._velocity, self._distance = velocity, distance
+        # The compiled kernel covers the standard covariance and atmosphere, the UD form and other
+        # atmospheres run the per-event methods
+        if (njit is not None and isinstance(self._P, StandardCovariance) and
+                isinstance(self._atmosphere, StandardAtmosphere)):
+            self._execute_compiled(gps_events, pressure_events)
+        else:
+            FilterBase.execute(self, gps_events, pressure_events)
+
+    @profiling.method_span('execute')
+    def _execute_compiled(self, gps_events, pressure_events):
+        kind, time, value, accuracy = merge_events(gps_events, pressure_events)
+        velocity, distance = self._integrals_array(time)
+        x = np.array(self._x, dtype=float)
+        P = self._P.matrix()
+        v0, d0 = self._last_integrals if self._started else (0.0, 0.0)
+        state = np.array([1.0 if self._started else 0.0, self._last_altitude or 0.0,
+                          self._last_time if self._started else 0.0, v0, d0])
+        out_gps = np.empty((len(gps_events), 2))
+        out_pressure = np.empty((len(pressure_events), 5))
+        updates = _accel_kernel(kind, time, value, accuracy, velocity, distance, x, P, state,
+                                np.asarray(self._P0, dtype=float), float(self._gps_var_factor),
+                                float(self._pressure_var), float(self._accel_noise),
+                                float(self._altitude_noise), float(self._altitude_rate_noise),
+                                float(self._pressure_noise), float(self._bias_noise),
+                                self._atmosphere.exponent(), self._atmosphere.factor(),
+                                float(self._outlier_gate), OUTLIER_MODES.index(self._outlier_mode),
+                                float(self._outlier_dof), out_gps, out_pressure)
+        profiling.count('kalman.update', updates)
+
+        self._x = x
+        self._P.set(P)
+        if len(gps_events):
+            self._last_altitude = state[1]
+        self._started = state[0] != 0.0
+        if self._started:
+            self._last_time = state[2]
+            self._last_integrals = (state[3], state[4])
+        self._altitude_gps.extend(out_gps[:, 0].tolist())
+        self._altitude_sd_gps.extend(out_gps[:, 1].tolist())
+        self._altitude.extend(out_pressure[:, 0].tolist())
+        self._altitude_sd.extend(out_pressure[:, 1].tolist())
+        self._altitude_rate.extend(out_pressure[:, 2].tolist())
+        self._pressure_msl.extend(out_pressure[:, 3].tolist())
+        self._accel_bias.extend(out_pressure[:, 4].tolist())
+
+    def on_gps(self, time, altitude, accuracy):
+        self._last_altitude = altitude
+        if self._started:
+            H = np.array([1.0, 0.0, 0.0, 0.0])
+            MR = np.array([accuracy*accuracy*self._gps_var_factor])
+            self._on_measurement(altitude - self._x[0], H, MR)
+        self._altitude_gps.append(self._x[0])
+        self._altitude_sd_gps.append(self._P.variance(0))
+
+    def on_pressure(self, time, pressure):
+        if not self._started and self._last_altitude:
+            # Filter initialization
+            altitude_msl = self._last_altitude
+            self._atmosphere.update(time)
+            pressure_msl = self._atmosphere.pressure_msl(pressure, altitude_msl)
+            self._x = np.array([altitude_msl, 0.0, pressure_msl, 0.0])
+            self._P.set(self._P0)
+            self._last_time = time
+            self._last_integrals = self._integrals(time)
+            self._started = True
+        elif self._started:
+            # Filter update operation
+            dt = abs(time - self._last_time) / 1000.0
+            v0, d0 = self._last_integrals
+            v1, d1 = self._last_integrals = self._integrals(time)
+
+            F = np.array([[1.0,  dt, 0.0, -0.5*dt*dt],
+                          [0.0, 1.0, 0.0, -dt],
+                          [0.0, 0.0, 1.0, 0.0],
+                          [0.0, 0.0, 0.0, 1.0]])
+
+            # Random walks of the states and white acceleration noise integrated over the step,
+            # the latter split as qa dt^3/12 on the altitude and qa dt [dt/2, 1] [dt/2, 1]^T
+            qa = self._accel_noise
+            q = np.array([self._altitude_noise*dt + qa*dt**3/12.0, self._altitude_rate_noise*dt,
+                          self._pressure_noise*dt, self._bias_noise*dt])
+            rank_one = ((qa*dt, (0.5*dt, 1.0, 0.0, 0.0)),)
+
+            # A priori state and covariance estimation
+            self._x = F.dot(self._x)
+            self._x[0] += d1 - d0 - v0*dt
+            self._x[1] += v1 - v0
+            self._P.predict(F, q, rank_one)
+
+            # Pressure measurement operation
+            self._atmosphere.update(time)
+            z, zd, p_msl, bias = self._x
+            ratio, slope = self._atmosphere.ratio(z)
+            H = np.array([p_msl*slope, 0.0, ratio, 0.0])
+            MR = np.array([self._pressure_var])
+            self._on_measurement(pressure - p_msl*ratio, H, MR, robust=True)
+            self._last_time = time
+
+        # Append the measurement
+        self._altitude.append(self._x[0])
+        self._altitude_sd.append(self._P.variance(0))
+        self._altitude_rate.append(self._x[1])
+        self._pressure_msl.append(self._x[2])
+        self._accel_bias.append(self._x[3])
+
+    def _integrals(self, time):
+        # Velocity and distance integrals of the vertical acceleration at the given time
+        i = np.searchsorted(self._accel_time, time, side='right') - 1
+        if i < 0:
+            return 0.0, 0.0
+        tau = (time - self._accel_time[i]) / 1000.0
+        a = self._accel[i] if i + 1 < len(self._accel) else 0.0
+        v = self._velocity[i]
+        return v + a*tau, self._distance[i] + v*tau + 0.5*a*tau*tau
+
+    def _integrals_array(self, time):
+        # _integrals at an array of times
+        if len(self._accel_time) == 0:
+            return np.zeros(len(time)), np.zeros(len(time))
+        i = np.searchsorted(self._accel_time, time, side='right') - 1
+        k = np.maximum(i, 0)
+        tau = (time - self._accel_time[k]) / 1000.0
+        a = np.where(i + 1 < len(self._accel), self._accel[k], 0.0)
+        v = self._velocity[k]
+        before = i < 0
+        return (np.where(before, 0.0, v + a*tau),
+                np.where(before, 0.0, self._distance[k] + v*tau + 0.5*a*tau*tau))
+
+    def _on_measurement(self, r, H, MR, robust=False):
+        if robust:
+            # Statistically gated update in place of discarding large pressure jumps
+            K, _ = self._P.update(H, MR[0], lambda HPH, R: robust_variance(
+                r, HPH, R, self._outlier_gate, self._outlier_mode, self._outlier_dof))
+        else:
+            K, _ = self._P.update(H, MR[0])
+        self._x += K.dot(r)
@@ -14,17 +14,19 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
-from .filter_base import FilterBase
+from .atmosphere import PRESSURE_EXPONENT, PRESSURE_FACTOR, make_atmosphere
+from .filter_base import FilterBase, SteadyState, STEADY_RUN_FACTOR, make_covariance
 import numpy as np
 
 
 class AltitudeFilter(FilterBase):
-
-    PRESSURE_EXPONENT = 5.25588
-    PRESSURE_FACTOR = 0.0000225577
+    PRESSURE_EXPONENT = PRESSURE_EXPONENT
+    PRESSURE_FACTOR = PRESSURE_FACTOR
 
     def __init__(self, gps_var_factor=100.0, pressure_var=0.01, pressure_smooth=0.5,
-                 altitude_noise=1e4, pressure_noise=1e-5, P0=np.diag([200.0, 2.0])):
+                 altitude_noise=1e4, pressure_noise=1e-5, P0=np.diag([200.0, 2.0]),
+                 steady_state=False, steady_resolution=0.005, steady_tolerance=1e-4,
+                 steady_min_run=16, covariance='ud', atmosphere=None):
         self._gps_var_factor = gps_var_factor
         self._pressure_var = pressure_var
         self._pressure_smooth = pressure_smooth
@@ -37,9 +39,15 @@ class AltitudeFilter(FilterBase):
         self._altitude_sd = list()
         self._pressure_msl = list()
         self._P0 = P0
+        self._steady_state = steady_state
+        self._steady_resolution = steady_resolution
+        self._steady_tolerance = steady_tolerance
+        self._steady_min_run = steady_min_run
+        self._steady = SteadyState(steady_resolution, steady_tolerance, steady_min_run)
 
         self._x = np.ones(2) * np.NaN
-        self._P = np.ones((2, 2)) * np.NaN
+        self._P = make_covariance(np.ones((2, 2)) * np.NaN, covariance)
+        self._atmosphere = make_atmosphere(atmosphere)
 
         self._started = False
         self._last_time = None
@@ -60,6 +68,15 @@ class AltitudeFilter(FilterBase):
     def pressure_msl(self):
         return np.array(self._pressure_msl)
 
+    def execute(self, gps_events, pressure_events):
+        # Steady-state batches are used only when GPS fixes are sparse, frequent fixes restart
+        # the convergence of the gain before a batch pays off
+        run = len(pressure_events) / (len(gps_events) + 1)
+        if self._steady_state and run >= STEADY_RUN_FACTOR*self._steady_min_run:
+            self.execute_runs(gps_events, pressure_events)
+        else:
+            FilterBase.execute(self, gps_events, pressure_events)
+
     def on_gps(self, time, altitude, accuracy):
         self._last_altitude = altitude
         if self._started:
@@ -68,42 +85,69 @@ class AltitudeFilter(FilterBase):
             MR = np.array([accuracy*accuracy*self._gps_var_factor])
             self._on_measurement(altitude - self._x[0], H, MR)
         self._altitude_gps.append(self._x[0])
-        self._altitude_sd_gps.append(self._P[0, 0])
+        self._altitude_sd_gps.append(self._P.variance(0))
 
     def on_pressure(self, time, pressure):
         if not self._started and self._last_altitude:
             # Filter initialization
             altitude_msl = self._last_altitude
-            pressure_msl = pressure / pow(1.0 - self.PRESSURE_FACTOR * altitude_msl,
-                                          self.PRESSURE_EXPONENT)
+            self._atmosphere.update(time)
+            pressure_msl = self._atmosphere.pressure_msl(pressure, altitude_msl)
             self._x = np.array([altitude_msl, pressure_msl])
-            self._P = self._P0
+            self._P.set(self._P0)
             self._last_time = time
             self._started = True
         elif self._started:
             # Filter update operation
             dt = abs(time - self._last_time) / 1000.0
-            Q = np.diag([self._altitude_noise, self._pressure_noise])
+            q = np.array([self._altitude_noise, self._pressure_noise])
 
             # A priori covariance estimation
-            self._P += Q * dt
+            self._P.predict(None, q * dt)
 
             # Pressure measurement operation
             weight = self._pressure_smooth*dt
-            e, f = self.PRESSURE_EXPONENT, self.PRESSURE_FACTOR
-            z, p_msl = self._x
-            H = np.array([-p_msl*e*f*pow(1.0 - f*z, e-1.0), pow(1.0 - f*z, e)])
+            h, H = self._pressure_model(time, self._x)
             MR = np.array([self._pressure_var])
 
-            self._on_measurement(weight*(pressure - p_msl*pow(1.0 - f*z, e)), H, MR)
+            K = self._on_measurement(weight*(pressure - h), H, MR)
             self._last_time = time
+            if self._steady_state:
+                self._steady.track(dt, H, K, self._steady_model)
 
         # Append the measurement
         self._altitude.append(self._x[0])
-        self._altitude_sd.append(self._P[0, 0])
+        self._altitude_sd.append(self._P.variance(0))
         self._pressure_msl.append(self._x[1])
 
+    def _pressure_model(self, time, x):
+        self._atmosphere.update(time)
+        z, p_msl = x
+        ratio, slope = self._atmosphere.ratio(z)
+        H = np.array([p_msl*slope, ratio])
+        return p_msl*ratio, H
+
+    def _steady_model(self, dt, H, K):
+        u = K*(self._pressure_smooth*dt)
+        A = np.identity(2) - np.outer(K, H)
+        Q = np.diag([self._altitude_noise, self._pressure_noise])*dt
+        W = A.dot(Q).dot(A.T) + self._pressure_var*np.outer(K, K)
+        return np.identity(2) - np.outer(u, H), u, A, W
+
+    def _steady_current(self):
+        if not self._started:
+            return None
+        return self._last_time, self._x, self._P, self._pressure_var
+
+    def _steady_advance(self, time, x, variance, P):
+        self._altitude.extend(x[:, 0].tolist())
+        self._altitude_sd.extend(variance.tolist())
+        self._pressure_msl.extend(x[:, 1].tolist())
+        self._x = x[-1].copy()
+        self._P.set(P)
+        self._last_time = time
+
     def _on_measurement(self, r, H, MR):
-        K = self._P.dot(H) / (H.dot(self._P.dot(H)) + MR)
+        K, _ = self._P.update(H, MR[0])
         self._x += K.dot(r)
-        self._P = (np.identity(2) - np.outer(K, H)).dot(self._P)
+        return K
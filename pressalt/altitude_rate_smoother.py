@@ -14,18 +14,22 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
-from .filter_base import SmootherBase
+from .atmosphere import PRESSURE_EXPONENT, PRESSURE_FACTOR, make_atmosphere
+from .filter_base import SmootherBase, OUTLIER_MODES, robust_variance, \
+    make_covariance
 import numpy as np
 
 
 class AltitudeRateSmoother(SmootherBase):
-
-    PRESSURE_EXPONENT = 5.25588
-    PRESSURE_FACTOR = 0.0000225577
+    PRESSURE_EXPONENT = PRESSURE_EXPONENT
+    PRESSURE_FACTOR = PRESSURE_FACTOR
 
     def __init__(self, gps_var_factor=6.0**2, pressure_var=0.3**2, pressure_smooth=1.0,
                  altitude_noise=1e-2, altitude_rate_noise=1e-4, pressure_noise=2e-5,
-                 P0=np.diag([200.0, 50.0, 2.0])):
+                 P0=np.diag([200.0, 50.0, 2.0]), outlier_gate=3.0, outlier_mode='huber',
+                 outlier_dof=4.0, covariance='standard', atmosphere=None):
+        if outlier_mode not in OUTLIER_MODES:
+            raise ValueError('Unknown outlier mode: %s' % outlier_mode)
         self._gps_var_factor = gps_var_factor
         self._pressure_var = pressure_var
         self._pressure_smooth = pressure_smooth
@@ -33,6 +37,9 @@ class AltitudeRateSmoother(SmootherBase):
         self._altitude_rate_noise = altitude_rate_noise
         self._pressure_noise = pressure_noise
         self._P0 = P0
+        self._outlier_gate = outlier_gate
+        self._outlier_mode = outlier_mode
+        self._outlier_dof = outlier_dof
 
         self._altitude_gps = list()
         self._altitude_gps_sd = list()
@@ -41,12 +48,12 @@ class AltitudeRateSmoother(SmootherBase):
         self._pressure_msl = list()
 
         self._x = np.ones(3) * np.NaN
-        self._P = np.ones((3, 3)) * np.NaN
+        self._P = make_covariance(np.ones((3, 3))*np.NaN, covariance)
+        self._atmosphere = make_atmosphere(atmosphere)
 
         self._started = False
         self._last_time = None
         self._last_altitude = None
-        self._last_pressure = None
         self._skip = 0
 
     def altitude_gps(self):
@@ -69,6 +76,7 @@ class AltitudeRateSmoother(SmootherBase):
         self._altitude_gps.reverse()
         self._altitude_gps_sd.reverse()
         self._altitude.reverse()
+        self._altitude_sd.reverse()
         self._pressure_msl.reverse()
 
     def on_gps(self, time, altitude, accuracy, backward):
@@ -79,58 +87,55 @@ class AltitudeRateSmoother(SmootherBase):
             self._on_measurement(altitude - self._x[0], H, MR)
         if backward:
             self._altitude_gps.append(self._x[0])
-            self._altitude_gps_sd.append(self._P[0, 0])
+            self._altitude_gps_sd.append(self._P.variance(0))
 
     def on_pressure(self, time, pressure, backward):
-        # Simple filter for discarding very noisy pressure measurements, this
-        # is more like a hack and requires improvement.
-        if self._last_pressure is None or abs(self._last_pressure - pressure) < 2.0:
-            if not self._started and self._last_altitude:
-                # Filter initialization
-                altitude_msl = self._last_altitude
-                pressure_msl = pressure/pow(1.0 - self.PRESSURE_FACTOR*altitude_msl,
-                                            self.PRESSURE_EXPONENT)
-                self._x = np.array([altitude_msl, 0.0, pressure_msl])
-                self._P = self._P0
-                self._last_time = time
-                self._started = True
-            elif self._started:
-                # Filter update operation
-                dt = abs(time - self._last_time) / 1000.0
-
-                F = np.array([[1.0, dt, 0.0],
-                              [0.0, 1.0, 0.0],
-                              [0.0, 0.0, 1.0]])
-
-                Q = np.diag([self._altitude_noise,
-                             self._altitude_rate_noise,
-                             self._pressure_noise])
-
-                # A priori state and covariance estimation
-                self._x = F.dot(self._x)
-                self._P = F.dot(self._P.dot(F.T)) + Q*dt
-
-                # Pressure measurement operation
-                e, f = self.PRESSURE_EXPONENT, self.PRESSURE_FACTOR
-                z, zd, p_msl = self._x
-                H = np.array([-p_msl*e*f*pow(1.0 - f*z, e - 1.0),
-                              0.0,
-                              pow(1.0 - f*z, e)])
-                MR = np.array([self._pressure_var])
-
-                self._on_measurement(pressure - p_msl*pow(1.0 - f*z, e), H, MR)
-                self._last_time = time
-
-        # Update last pressure
-        self._last_pressure = pressure
+        if not self._started and self._last_altitude:
+            # Filter initialization
+            altitude_msl = self._last_altitude
+            self._atmosphere.update(time)
+            pressure_msl = self._atmosphere.pressure_msl(pressure, altitude_msl)
+            self._x = np.array([altitude_msl, 0.0, pressure_msl])
+            self._P.set(self._P0)
+            self._last_time = time
+            self._started = True
+        elif self._started:
+            # Filter update operation
+            dt = abs(time - self._last_time) / 1000.0
+
+            F = np.array([[1.0, dt, 0.0],
+                          [0.0, 1.0, 0.0],
+                          [0.0, 0.0, 1.0]])
+
+            q = np.array([self._altitude_noise,
+                          self._altitude_rate_noise,
+                          self._pressure_noise])
+
+            # A priori state and covariance estimation
+            self._x = F.dot(self._x)
+            self._P.predict(F, q*dt)
+
+            # Pressure measurement operation
+            self._atmosphere.update(time)
+            z, zd, p_msl = self._x
+            ratio, slope = self._atmosphere.ratio(z)
+            H = np.array([p_msl*slope, 0.0, ratio])
+            MR = np.array([self._pressure_var])
+
+            self._on_measurement(pressure - p_msl*ratio, H, MR, robust=True)
+            self._last_time = time
 
         # Append the measurement
         if backward:
             self._altitude.append(self._x[0])
-            self._altitude_sd.append(self._P[0, 0])
+            self._altitude_sd.append(self._P.variance(0))
             self._pressure_msl.append(self._x[2])
 
-    def _on_measurement(self, r, H, MR):
-        K = self._P.dot(H) / (H.dot(self._P.dot(H)) + MR)
+    def _on_measurement(self, r, H, MR, robust=False):
+        if robust:
+            # Statistically gated update in place of discarding large pressure jumps
+            K, _ = self._P.update(H, MR[0], lambda HPH, R: robust_variance(
+                r, HPH, R, self._outlier_gate, self._outlier_mode, self._outlier_dof))
+        else:
+            K, _ = self._P.update(H, MR[0])
         self._x += K.dot(r)
-        self._P = (np.identity(3) - np.outer(K, H)).dot(self._P)
@@ -0,0 +1,367 @@
+# -*- coding: utf-8 -*-
+#
+#  (C) Copyright 2013, 2016 Wojciech Mruczkiewicz
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from .record_readers import *
+import json
+import uuid
+import zipfile
+import numpy as np
+
+ARCHIVE_MAGIC = 'PressAltArchive'
+ARCHIVE_VERSION = 1
+
+ARCHIVE_COMPRESSION = {'store': zipfile.ZIP_STORED,
+                       'deflate': zipfile.ZIP_DEFLATED,
+                       'bzip2': zipfile.ZIP_BZIP2,
+                       'lzma': zipfile.ZIP_LZMA}
+
+# Columns of every stream kind. Times are encoded as delta-of-delta, floating point columns are
+# quantized to integers whenever it can be done without any loss.
+ARCHIVE_SCHEMA = {
+    'sensor': (('time', 'time'), ('timestamp', 'time'), ('values', 'values')),
+    'accuracy': (('time', 'time'), ('accuracy', 'int'), ('resolution', 'f4'), ('maximum', 'f4')),
+    'gps': (('time', 'time'), ('latitude', 'f8'), ('longitude', 'f8'), ('altitude', 'f8'),
+            ('bearing', 'f4'), ('speed', 'f4'), ('accuracy', 'f4'), ('timestamp', 'time')),
+    'battery': (('time', 'time'), ('percentage', 'f4'), ('voltage', 'int'),
+                ('temperature', 'int')),
+    'nmea': (('time', 'time'), ('timestamp', 'time'), ('nmea', 'bytes')),
+    'ble': (('time', 'time'), ('uuid', 'bytes'), ('value', 'bytes')),
+    'end': (('time', 'time'), ('end_time', 'time'), ('version', 'int'), ('duration', 'int'),
+            ('moving_time', 'int'), ('distance', 'f8')),
+    'corrupted': (('start', 'int'), ('end', 'int')),
+}
+
+
+class ArchiveWriter(RecordReader):
+
+    def __init__(self, compression='deflate'):
+        RecordReader.__init__(self)
+        if compression not in ARCHIVE_COMPRESSION:
+            raise ValueError('Unknown compression: %s' % compression)
+        self._compression = compression
+        self._start = None
+        self._order = list()
+        self._streams = list()
+        self._stream_index = dict()
+        self._columns = list()
+
+    def on_start(self, time, start_time, version):
+        if version < 1200:
+            raise RecordReaderError('Archive requires a recording version 1200 or newer')
+        self._start = (time, start_time, version)
+
+    def on_end(self, time, end_time, version, duration, moving_time, distance):
+        self._append(('end', None, None), time, end_time, version, duration, moving_time,
+                     distance)
+
+    def on_sensor(self, type, device, time, timestamp, values):
+        self._append(('sensor', type, device), time, timestamp, values)
+
+    def on_sensor_accuracy(self, type, device, time, accuracy, resolution, maximum):
+        self._append(('accuracy', type, device), time, accuracy, resolution, maximum)
+
+    def on_gps(self, millisecond, latitude, longitude, altitude_geoid, bearing, speed, accuracy,
+               time):
+        self._append(('gps', None, None), millisecond, latitude, longitude, altitude_geoid,
+                     bearing, speed, accuracy, time)
+
+    def on_battery(self, millisecond, percent, voltage, temperature):
+        self._append(('battery', None, None), millisecond, percent, voltage, temperature)
+
+    def on_nmea(self, millisecond, timestamp, nmea):
+        self._append(('nmea', None, None), millisecond, timestamp, nmea)
+
+    def on_ble(self, device, millisecond, ble_uuid, value):
+        self._append(('ble', None, device), millisecond, ble_uuid.bytes, value)
+
+    def on_corrupted(self, start, end):
+        self._append(('corrupted', None, None), start, end)
+
+    def save(self, file):
+        if self._start is None:
+            raise RecordReaderError('No recording to archive')
+        compress_type = ARCHIVE_COMPRESSION[self._compression]
+        streams = list()
+        with zipfile.ZipFile(file, 'w') as zf:
+            for index, (kind, type, device) in enumerate(self._streams):
+                columns = dict()
+                for (name, encoding), values in zip(ARCHIVE_SCHEMA[kind], self._columns[index]):
+                    for suffix, array, meta in _encode_column(encoding, values):
+                        member = '%d/%s%s' % (index, name, suffix)
+                        _write_array(zf, member, array, compress_type)
+                        columns[name + suffix] = meta
+                streams.append({'kind': kind, 'type': type, 'device': device,
+                                'length': len(self._columns[index][0]), 'columns': columns})
+            order, meta = _encode_integers(np.array(self._order, dtype=np.int64), 0)
+            _write_array(zf, 'order', order, compress_type)
+            header = {'magic': ARCHIVE_MAGIC, 'version': ARCHIVE_VERSION, 'start': self._start,
+                      'order': meta, 'streams': streams}
+            zf.writestr('header.json', json.dumps(header), compress_type)
+
+    def _append(self, key, *values):
+        index = self._stream_index.get(key)
+        if index is None:
+            index = len(self._streams)
+            self._stream_index[key] = index
+            self._streams.append(key)
+            self._columns.append(tuple(list() for _ in values))
+        for column, value in zip(self._columns[index], values):
+            column.append(value)
+        self._order.append(index)
+
+
+class Archive:
+
+    def __init__(self, file):
+        self._zf = zipfile.ZipFile(file, 'r')
+        self._header = json.loads(self._zf.read('header.json').decode('utf-8'))
+        if self._header.get('magic') != ARCHIVE_MAGIC:
+            raise RecordReaderError('Archive format not recognized')
+        if self._header['version'] != ARCHIVE_VERSION:
+            raise RecordReaderError('Archive version unknown: %d' % self._header['version'])
+
+    def close(self):
+        self._zf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def start(self):
+        return tuple(self._header['start'])
+
+    def streams(self):
+        return [(s['kind'], s['type'], s['device']) for s in self._header['streams']]
+
+    def find_stream(self, kind, type=None, device=None):
+        for index, s in enumerate(self._header['streams']):
+            if s['kind'] == kind and s['type'] == type and s['device'] == device:
+                return index
+        return None
+
+    def columns(self, index):
+        stream = self._header['streams'][index]
+        return {name: self._decode_column(index, name, encoding, stream)
+                for name, encoding in ARCHIVE_SCHEMA[stream['kind']]}
+
+    def column(self, index, name):
+        stream = self._header['streams'][index]
+        encoding = dict(ARCHIVE_SCHEMA[stream['kind']])[name]
+        return self._decode_column(index, name, encoding, stream)
+
+    def gps_events(self):
+        index = self.find_stream('gps')
+        if index is None:
+            return np.empty((0, 3))
+        return np.column_stack((self.column(index, 'time'), self.column(index, 'altitude'),
+                                self.column(index, 'accuracy')))
+
+    def press_events(self, device=0):
+        index = self.find_stream('sensor', 6, device)
+        if index is None:
+            return np.empty((0, 2))
+        values = self.column(index, 'values')
+        return np.column_stack((self.column(index, 'time'), values[:, 0]))
+
+    def replay(self, reader):
+        reader.on_start(*self._header['start'])
+
+        dispatch = list()
+        for index, s in enumerate(self._header['streams']):
+            columns = self.columns(index)
+            rows = [self._as_list(columns[name], encoding)
+                    for name, encoding in ARCHIVE_SCHEMA[s['kind']]]
+            dispatch.append(self._callback(reader, s['kind'], s['type'], s['device'],
+                                           list(zip(*rows))))
+
+        for index in self._decode_order().tolist():
+            dispatch[index]()
+        return reader
+
+    def _decode_order(self):
+        return _decode_integers(self._read_array('order'), self._header['order'])
+
+    def _decode_column(self, index, name, encoding, stream):
+        columns = stream['columns']
+        member = lambda suffix: '%d/%s%s' % (index, name, suffix)
+        if encoding == 'values':
+            if name + '.counts' in columns:
+                counts = _decode_integers(self._read_array(member('.counts')),
+                                          columns[name + '.counts'])
+                flat = _decode_floats(self._read_array(member('')), columns[name])
+                return np.split(flat, np.cumsum(counts)[:-1])
+            width = columns[name]['width']
+            values = [_decode_floats(self._read_array(member('.%d' % i)),
+                                     columns['%s.%d' % (name, i)]) for i in range(width)]
+            if values:
+                return np.column_stack(values)
+            return np.empty((stream['length'], 0), dtype=np.float32)
+        elif encoding == 'bytes':
+            lengths = _decode_integers(self._read_array(member('.lengths')),
+                                       columns[name + '.lengths'])
+            data = self._read_array(member('')).tobytes()
+            offsets = np.concatenate(([0], np.cumsum(lengths))).tolist()
+            return [data[offsets[i]:offsets[i + 1]] for i in range(len(lengths))]
+        elif encoding in ('time', 'int'):
+            return _decode_integers(self._read_array(member('')), columns[name])
+        else:
+            return _decode_floats(self._read_array(member('')), columns[name])
+
+    def _read_array(self, member):
+        with self._zf.open(member + '.npy') as f:
+            return np.lib.format.read_array(f, allow_pickle=False)
+
+    @staticmethod
+    def _as_list(values, encoding):
+        if encoding == 'values':
+            if isinstance(values, list):
+                return [tuple(v.tolist()) for v in values]
+            return [tuple(v) for v in values.tolist()]
+        elif encoding == 'bytes':
+            return values
+        return values.tolist()
+
+    @staticmethod
+    def _callback(reader, kind, type, device, rows):
+        events = iter(rows)
+        if kind == 'sensor':
+            return lambda: reader.on_sensor(type, device, *next(events))
+        elif kind == 'accuracy':
+            return lambda: reader.on_sensor_accuracy(type, device, *next(events))
+        elif kind == 'gps':
+            return lambda: reader.on_gps(*next(events))
+        elif kind == 'battery':
+            return lambda: reader.on_battery(*next(events))
+        elif kind == 'nmea':
+            return lambda: reader.on_nmea(*next(events))
+        elif kind == 'ble':
+            def on_ble():
+                time, ble_uuid, value = next(events)
+                reader.on_ble(device, time, uuid.UUID(bytes=ble_uuid), value)
+            return on_ble
+        elif kind == 'end':
+            return lambda: reader.on_end(*next(events))
+        elif kind == 'corrupted':
+            return lambda: reader.on_corrupted(*next(events))
+        raise RecordReaderError('Archive stream unknown: %s' % kind)
+
+
+def write_archive(log_file, archive_file, compression='deflate'):
+    writer = read_binary(log_file, ArchiveWriter(compression))
+    writer.save(archive_file)
+    return writer
+
+
+def read_archive(archive_file, reader):
+    with Archive(archive_file) as archive:
+        return archive.replay(reader)
+
+
+def _write_array(zf, member, array, compress_type):
+    info = zipfile.ZipInfo(member + '.npy')
+    info.compress_type = compress_type
+    with zf.open(info, 'w', force_zip64=True) as f:
+        np.lib.format.write_array(f, np.ascontiguousarray(array), allow_pickle=False)
+
+
+def _encode_column(encoding, values):
+    # Yields the member suffix, the stored array and its decoding metadata.
+    if encoding == 'time':
+        yield ('',) + _encode_integers(np.array(values, dtype=np.int64), 2)
+    elif encoding == 'int':
+        yield ('',) + _encode_integers(np.array(values, dtype=np.int64), 1)
+    elif encoding in ('f4', 'f8'):
+        yield ('',) + _encode_floats(np.array(values, dtype=encoding))
+    elif encoding == 'bytes':
+        lengths = np.array([len(v) for v in values], dtype=np.int64)
+        yield ('.lengths',) + _encode_integers(lengths, 1)
+        yield '', np.frombuffer(b''.join(values), dtype=np.uint8), {}
+    elif encoding == 'values':
+        counts = {len(v) for v in values}
+        if len(counts) == 1:
+            width = counts.pop()
+            matrix = np.array(values, dtype=np.float32).reshape(len(values), width)
+            yield '', np.empty(0, dtype=np.uint8), {'width': width}
+            for i in range(width):
+                yield ('.%d' % i,) + _encode_floats(matrix[:, i])
+        else:
+            counts = np.array([len(v) for v in values], dtype=np.int64)
+            flat = np.array([x for v in values for x in v], dtype=np.float32)
+            yield ('.counts',) + _encode_integers(counts, 1)
+            yield ('',) + _encode_floats(flat)
+
+
+def _encode_integers(values, order):
+    # Differences of the given order are stored with the smallest fitting integer type, the
+    # leading values needed for reconstruction are kept in the metadata.
+    head = list()
+    for _ in range(order):
+        if len(values) == 0:
+            break
+        head.append(int(values[0]))
+        values = np.diff(values)
+    for dtype in (np.int8, np.int16, np.int32):
+        info = np.iinfo(dtype)
+        if len(values) == 0 or (values.min() >= info.min and values.max() <= info.max):
+            return values.astype(dtype), {'head': head}
+    return values, {'head': head}
+
+
+def _decode_integers(values, meta):
+    values = values.astype(np.int64)
+    for head in reversed(meta['head']):
+        values = np.concatenate(([head], np.int64(head) + np.cumsum(values)))
+    return values
+
+
+def _encode_floats(values):
+    # Floating point values are stored as integer multiples of a decimal or a binary step
+    # whenever they can be restored bit exactly, otherwise they are stored unchanged.
+    dtype = values.dtype
+    if len(values) > 0 and np.all(np.isfinite(values)) and not np.any(np.signbit(values) &
+                                                                       (values == 0.0)):
+        exact = values.astype(np.float64)
+        for decimals in range(7):
+            scale = 10.0 ** decimals
+            q = np.round(exact * scale)
+            if np.max(np.abs(q)) < 2.0 ** 53 and np.array_equal((q / scale).astype(dtype),
+                                                                values):
+                ints, meta = _encode_integers(q.astype(np.int64), 1)
+                meta.update({'dtype': dtype.str, 'decimals': decimals})
+                return ints, meta
+        nonzero = exact[exact != 0.0]
+        if len(nonzero) > 0:
+            exponents = np.frexp(nonzero)[1]
+            step = int(exponents.min()) - np.finfo(dtype).nmant - 1
+            if int(exponents.max()) - step < 63:
+                q = np.ldexp(exact, -step)
+                if np.array_equal(q, np.round(q)):
+                    ints, meta = _encode_integers(q.astype(np.int64), 1)
+                    meta.update({'dtype': dtype.str, 'step': step})
+                    return ints, meta
+    return values, {'dtype': dtype.str}
+
+
+def _decode_floats(values, meta):
+    dtype = np.dtype(meta['dtype'])
+    if 'decimals' in meta:
+        return (_decode_integers(values, meta) / 10.0 ** meta['decimals']).astype(dtype)
+    elif 'step' in meta:
+        return np.ldexp(_decode_integers(values, meta).astype(np.float64),
+                        meta['step']).astype(dtype)
+    return values.astype(dtype)
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+#
+#  (C) Copyright 2013, 2016 Wojciech Mruczkiewicz
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from bisect import bisect_right
+
+PRESSURE_EXPONENT = 5.25588
+PRESSURE_FACTOR = 0.0000225577
+
+STANDARD_LAPSE_RATE = 0.0065
+CELSIUS_ZERO = 273.15
+
+
+def pressure_ratio(altitude, exponent=PRESSURE_EXPONENT, factor=PRESSURE_FACTOR):
+    # Ratio p/p_msl = (1 - f z)^e and its altitude derivative. The derivative follows from the
+    # ratio, e x^(e-1) = e x^e / x, so both take a single pow. Compiled kernels use this too.
+    x = 1.0 - factor*altitude
+    value = x**exponent
+    return value, -factor*exponent*value/x
+
+
+class StandardAtmosphere:
+    # Pressure of the standard atmosphere, p = p_msl (1 - f z)^e, at altitude z. Filters ask for
+    # the ratio p/p_msl together with its altitude derivative.
+
+    def __init__(self, exponent=PRESSURE_EXPONENT, factor=PRESSURE_FACTOR):
+        self._exponent = exponent
+        self._factor = factor
+
+    def exponent(self):
+        return self._exponent
+
+    def factor(self):
+        return self._factor
+
+    def update(self, time):
+        pass
+
+    def ratio(self, altitude):
+        return pressure_ratio(altitude, self._exponent, self._factor)
+
+    def pressure_msl(self, pressure, altitude):
+        return pressure / self.ratio(altitude)[0]
+
+    def altitude(self, pressure, pressure_msl):
+        return (1.0 - pow(pressure/pressure_msl, 1.0/self._exponent)) / self._factor
+
+
+class LapseRateAtmosphere:
+    # Hypsometric model with the air temperature T measured at the current altitude and a constant
+    # lapse rate L below it, p = p_msl (T / (T + L z))^e. The temperature is linearly interpolated
+    # between the events (millisecond, celsius) recorded by the on_temp stream.
+
+    def __init__(self, temperature_events, lapse_rate=STANDARD_LAPSE_RATE):
+        if len(temperature_events) == 0:
+            raise ValueError('No temperature events for the atmosphere model')
+        events = sorted(temperature_events)
+        self._time = [float(e[0]) for e in events]
+        self._temperature = [e[1] + CELSIUS_ZERO for e in events]
+        self._lapse_rate = lapse_rate
+        # Exponent g M / (R L) of the standard atmosphere scaled to the lapse rate
+        self._exponent = PRESSURE_EXPONENT*STANDARD_LAPSE_RATE/lapse_rate
+        self._last_time = None
+        self._factor = None
+        self.update(self._time[0])
+
+    def temperature(self):
+        return self._lapse_rate / self._factor - CELSIUS_ZERO
+
+    def update(self, time):
+        if time == self._last_time:
+            return
+        self._last_time = time
+        i = bisect_right(self._time, time)
+        if i == 0:
+            temperature = self._temperature[0]
+        elif i == len(self._time):
+            temperature = self._temperature[-1]
+        else:
+            t0, t1 = self._time[i - 1], self._time[i]
+            T0, T1 = self._temperature[i - 1], self._temperature[i]
+            temperature = T0 + (T1 - T0)*(time - t0)/(t1 - t0)
+        self._factor = self._lapse_rate / temperature
+
+    def ratio(self, altitude):
+        x = 1.0 + self._factor*altitude
+        value = pow(x, -self._exponent)
+        return value, -self._factor*self._exponent*value/x
+
+    def pressure_msl(self, pressure, altitude):
+        return pressure / self.ratio(altitude)[0]
+
+    def altitude(self, pressure, pressure_msl):
+        return (pow(pressure/pressure_msl, -1.0/self._exponent) - 1.0) / self._factor
+
+
+def make_atmosphere(atmosphere):
+    return StandardAtmosphere() if atmosphere is None else atmosphere
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+#
+#  (C) Copyright 2013, 2016 Wojciech Mruczkiewicz
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from .route_alignment import arc_length
+from . import profiling
+import numpy as np
+
+
+def route_positions(reference_reader, reader, cutoff=10.0, align=True):
+    # Distance along the GPS track of the reference reader for every pressure sample of the
+    # reader, NaN where the ride is off the route. GPS points are aligned to the reference track
+    # and pressure samples interpolated between them.
+    s = arc_length(reference_reader.gps_points())
+    match = reader.align_points if align else reader.match_points
+    ind, _, _ = match(reference_reader.gps_coordinates(), cutoff)
+    gps_position = np.full(len(ind), np.nan)
+    matched = ind < len(s)
+    gps_position[matched] = s[ind[matched]]
+    gps_time = reader.gps_time()
+    press_time = reader.press_time()
+    if len(gps_time) == 0:
+        return np.full(len(press_time), np.nan)
+    position = np.interp(press_time, gps_time, gps_position)
+    position[(press_time < gps_time[0]) | (press_time > gps_time[-1])] = np.nan
+    return position
+
+
+class ConsensusProfile:
+    # Joint weighted least squares estimate of the altitude profile of a route, sampled in bins
+    # of the distance along it, and of the altitude offset and drift of every ride. Altitudes z
+    # of a ride at the route position s and time t are modelled as
+    #   z = h[bin(s)] + offset + drift (t - t_ride)
+    # with t_ride the mean time of the ride in hours. Offsets and drifts have zero mean priors,
+    # which fix the level of the profile to the mean of the rides, and second differences of the
+    # profile have a prior too, which bridges the bins no ride has passed.
+    #
+    # Rides are added one at a time and reduced to their contribution to the normal equations:
+    # the diagonal of the profile block, the 2x2 block of the ride and the coupling with the bins
+    # the ride has passed. The sparse system is assembled and solved by the preconditioned
+    # conjugate gradients, so memory grows with the number of bins passed by every ride only.
+
+    def __init__(self, length, bin_size=10.0, drift=True, offset_sd=10.0, drift_sd=10.0,
+                 curvature_sd=1.0):
+        self._bin_size = bin_size
+        self._bins = int(np.ceil(length / bin_size)) + 1
+        self._parameters = 2 if drift else 1
+        self._prior = np.array([offset_sd**-2, drift_sd**-2][:self._parameters])
+        self._curvature_weight = curvature_sd**-2 if curvature_sd else 0.0
+
+        self._diagonal = np.zeros(self._bins)
+        self._rhs = np.zeros(self._bins)
+        self._ride_bins = list()
+        self._ride_coupling = list()
+        self._ride_blocks = list()
+        self._ride_rhs = list()
+        self._ride_times = list()
+
+        self._profile = None
+        self._ride_parameters = None
+        self._iterations = None
+
+    def bins(self):
+        return self._bins
+
+    def positions(self):
+        return np.arange(self._bins) * self._bin_size
+
+    def rides(self):
+        return len(self._ride_blocks)
+
+    def weights(self):
+        # Sum of the sample weights in every bin, zero for bins no ride has passed
+        return np.array(self._diagonal)
+
+    def add_ride(self, position, altitude, altitude_sd, time=None):
+        # Adds samples of a ride at route positions in metres, with times in seconds needed for
+        # the drift. Samples with non-finite values are ignored. Returns the index of the ride.
+        position = np.asarray(position, dtype=float)
+        altitude = np.asarray(altitude, dtype=float)
+        altitude_sd = np.broadcast_to(np.asarray(altitude_sd, dtype=float), altitude.shape)
+        time = np.zeros(len(altitude)) if time is None else np.asarray(time, dtype=float)
+        valid = np.isfinite(position) & np.isfinite(altitude) & np.isfinite(time) & \
+            (altitude_sd > 0.0) & np.isfinite(altitude_sd)
+        b = np.clip(np.rint(position[valid] / self._bin_size).astype(int), 0, self._bins - 1)
+        w = altitude_sd[valid]**-2
+        z = altitude[valid]
+        t = time[valid] / 3600.0
+        t_ride = np.average(t, weights=w) if len(w) > 0 else 0.0
+        basis = np.column_stack((np.ones(len(w)), t - t_ride))[:, :self._parameters]
+
+        # Sums per bin of the weights and of the weighted basis of the ride parameters
+        bins = np.unique(b)
+        k = np.searchsorted(bins, b)
+        coupling = np.column_stack([np.bincount(k, w*basis[:, i], len(bins))
+                                    for i in range(self._parameters)])
+        self._diagonal[bins] += coupling[:, 0]
+        self._rhs += np.bincount(b, w*z, self._bins)
+        wb = basis * w[:, np.newaxis]
+        self._ride_bins.append(bins.astype(np.int32))
+        self._ride_coupling.append(coupling)
+        self._ride_blocks.append(basis.T.dot(wb) + np.diag(self._prior))
+        self._ride_rhs.append(wb.T.dot(z))
+        self._ride_times.append(t_ride)
+        self._profile = None
+        return len(self._ride_blocks) - 1
+
+    def normal_equations(self):
+        # Sparse normal matrix and right hand side of the profile bins followed by the parameters
+        # of every ride
+        import scipy.sparse
+        B, p, R = self._bins, self._parameters, len(self._ride_blocks)
+        rows, cols, values = [np.arange(B)], [np.arange(B)], [self._diagonal]
+        if self._curvature_weight > 0.0 and B > 2:
+            second = scipy.sparse.diags([1.0, -2.0, 1.0], [0, 1, 2], shape=(B - 2, B))
+            curvature = (second.T.dot(second) * self._curvature_weight).tocoo()
+            rows.append(curvature.row)
+            cols.append(curvature.col)
+            values.append(curvature.data)
+        for r in range(R):
+            bins, coupling = self._ride_bins[r], self._ride_coupling[r]
+            first = B + r*p
+            for i in range(p):
+                rows += [bins, np.full(len(bins), first + i)]
+                cols += [np.full(len(bins), first + i), bins]
+                values += [coupling[:, i], coupling[:, i]]
+            block = np.indices((p, p)).reshape(2, -1) + first
+            rows.append(block[0])
+            cols.append(block[1])
+            values.append(self._ride_blocks[r].ravel())
+        N = scipy.sparse.csr_matrix((np.concatenate(values),
+                                     (np.concatenate(rows), np.concatenate(cols))),
+                                    shape=(B + R*p, B + R*p))
+        rhs = np.concatenate([self._rhs] + self._ride_rhs)
+        return N, rhs
+
+    def solve(self, tolerance=1e-10, max_iterations=None):
+        with profiling.span('ConsensusProfile.solve'):
+            N, rhs = self.normal_equations()
+            # Bins without samples take part only through the curvature prior
+            active = N.diagonal() > 0.0
+            index = np.flatnonzero(active)
+            N = N[index][:, index]
+            x = np.full(len(rhs), np.nan)
+            x[index], self._iterations = self._conjugate_gradients(N, rhs[index], tolerance,
+                                                                   max_iterations)
+        self._profile = x[:self._bins]
+        self._ride_parameters = x[self._bins:].reshape(-1, self._parameters)
+        return self._profile
+
+    def _conjugate_gradients(self, N, rhs, tolerance, max_iterations):
+        # Conjugate gradients with the Jacobi preconditioner, stopping at the relative residual
+        # tolerance. Returns the solution and the number of iterations.
+        import scipy.sparse.linalg as linalg
+        inverse_diagonal = 1.0 / N.diagonal()
+        M = linalg.LinearOperator(N.shape, matvec=lambda r: inverse_diagonal * r.ravel(),
+                                  dtype=float)
+        iterations = [0]
+
+        def count(x):
+            iterations[0] += 1
+
+        try:
+            x, _ = linalg.cg(N, rhs, rtol=tolerance, atol=0.0, maxiter=max_iterations, M=M,
+                             callback=count)
+        except TypeError:
+            # Before scipy 1.12 the relative tolerance was tol
+            x, _ = linalg.cg(N, rhs, tol=tolerance, atol=0.0, maxiter=max_iterations, M=M,
+                             callback=count)
+        return x, iterations[0]
+
+    def iterations(self):
+        return self._iterations
+
+    def profile(self):
+        if self._profile is None:
+            self.solve()
+        return np.array(self._profile)
+
+    def offsets(self):
+        if self._profile is None:
+            self.solve()
+        return np.array(self._ride_parameters[:, 0])
+
+    def drifts(self):
+        # Drifts of the rides in metres per hour, zero without the drift
+        if self._profile is None:
+            self.solve()
+        if self._parameters < 2:
+            return np.zeros(len(self._ride_parameters))
+        return np.array(self._ride_parameters[:, 1])
+
+    def ride_correction(self, ride, time):
+        # Correction to subtract from the altitudes of a ride at times in seconds
+        if self._profile is None:
+            self.solve()
+        correction = np.full(np.shape(time), self._ride_parameters[ride, 0])
+        if self._parameters > 1:
+            correction += self._ride_parameters[ride, 1] * \
+                (np.asarray(time) / 3600.0 - self._ride_times[ride])
+        return correction
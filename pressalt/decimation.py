@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+#
+#  (C) Copyright 2013, 2016 Wojciech Mruczkiewicz
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import numpy as np
+
+DECIMATION_METHODS = ['none', 'm4', 'lttb']
+
+
+def m4_indices(x, ys, buckets):
+    # Indices of the first, last, minimum and maximum sample of every one of the equally wide
+    # x buckets, for all the series ys sharing x. With a bucket per pixel column the rasterized
+    # line is the same as for all samples. Samples with non-finite x are dropped, the indices
+    # are returned in the original order.
+    x = np.asarray(x, dtype=float)
+    index = np.flatnonzero(np.isfinite(x))
+    if len(index) <= 4*buckets:
+        return index
+    x = x[index]
+    x_min, x_max = np.min(x), np.max(x)
+    if x_max <= x_min:
+        return index[[0, -1]]
+    bucket = np.minimum(((x - x_min) * (buckets / (x_max - x_min))).astype(int), buckets - 1)
+    if np.any(bucket[1:] < bucket[:-1]):
+        order = np.argsort(bucket, kind='stable')
+        index, bucket = index[order], bucket[order]
+    first = np.flatnonzero(np.r_[True, bucket[1:] != bucket[:-1]])
+    last = np.r_[first[1:], len(bucket)] - 1
+    counts = last - first + 1
+    selected = [index[first], index[last]]
+    for y in ys:
+        y = np.asarray(y, dtype=float)[index]
+        for extreme in (np.fmin, np.fmax):
+            values = np.repeat(extreme.reduceat(y, first), counts)
+            selected.append(index[_first_in_bucket(np.flatnonzero(y == values), bucket)])
+        # A NaN of every bucket keeps the gaps of the line
+        selected.append(index[_first_in_bucket(np.flatnonzero(np.isnan(y)), bucket)])
+    return np.unique(np.concatenate(selected))
+
+
+def _first_in_bucket(positions, bucket):
+    b = bucket[positions]
+    return positions[np.r_[True, b[1:] != b[:-1]]] if len(positions) > 0 else positions
+
+
+def m4(x, y, buckets):
+    i = m4_indices(x, [y], buckets)
+    return np.asarray(x)[i], np.asarray(y)[i]
+
+
+def lttb_indices(x, y, n):
+    # Largest-Triangle-Three-Buckets selection of n samples. The first and last sample are kept
+    # and every bucket in between contributes the sample forming the largest triangle with the
+    # previously selected one and the mean of the next bucket.
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    length = len(x)
+    if n >= length or n < 3:
+        return np.arange(length)
+    edges = np.linspace(1, length - 1, n - 1).astype(int)
+    counts = np.diff(edges)
+    mean_x = np.append(np.add.reduceat(x[1:-1], edges[:-1] - 1) / counts, x[-1])
+    mean_y = np.append(np.add.reduceat(y[1:-1], edges[:-1] - 1) / counts, y[-1])
+    selected = np.empty(n, dtype=int)
+    selected[0] = a = 0
+    for i in range(n - 2):
+        start, stop = edges[i], edges[i + 1]
+        area = np.abs((x[a] - mean_x[i + 1])*(y[start:stop] - y[a]) -
+                      (x[a] - x[start:stop])*(mean_y[i + 1] - y[a]))
+        a = start + np.argmax(area)
+        selected[i + 1] = a
+    selected[-1] = length - 1
+    return selected
+
+
+def lttb(x, y, n):
+    i = lttb_indices(x, y, n)
+    return np.asarray(x)[i], np.asarray(y)[i]
+
+
+def decimation_indices(method, x, ys, buckets):
+    # Samples to plot for the series ys sharing x on a line of the given width in pixels. LTTB
+    # selects twice as many samples as pixels and uses the first series only.
+    if method == 'm4':
+        return m4_indices(x, ys, buckets)
+    elif method == 'lttb':
+        return lttb_indices(x, ys[0], 2*buckets)
+    elif method is None or method == 'none':
+        return np.arange(len(x))
+    raise ValueError('Unknown decimation method: %s' % method)
+
+
+class MinMaxPyramid:
+    # Levels of detail of the series ys sharing x, for drawing any x range at the resolution of
+    # the screen. Level k keeps the samples with the minimum and maximum of every series in the
+    # groups of 2^k consecutive samples, so the number of samples drawn from the right level
+    # depends on the width in pixels and not on the length of the recording. Samples with
+    # non-finite x are dropped.
+
+    def __init__(self, x, ys):
+        x = np.asarray(x, dtype=float)
+        index = np.flatnonzero(np.isfinite(x))
+        if np.any(x[index[1:]] < x[index[:-1]]):
+            index = index[np.argsort(x[index], kind='stable')]
+        self._index = index
+        self._x = x[index]
+        ys = [np.asarray(y, dtype=float)[index] for y in ys]
+
+        # Levels hold sorted positions in the x order, level 0 holds all of them
+        positions = np.arange(len(index))
+        extremes = [(positions, positions) for _ in ys]
+        self._levels = [positions]
+        while len(self._levels[-1]) > 2*len(ys) and len(extremes[0][0]) > 1:
+            extremes = [(_pair_extremes(y, low, np.less), _pair_extremes(y, high, np.greater))
+                        for y, (low, high) in zip(ys, extremes)]
+            self._levels.append(np.unique(np.concatenate([p for e in extremes for p in e])))
+
+    def levels(self):
+        return len(self._levels)
+
+    def level(self, count, width):
+        # Coarsest level keeping at least two groups per pixel for count samples
+        if count <= 2*width:
+            return 0
+        return min(int(np.ceil(np.log2(count / (2.0*width)))), len(self._levels) - 1)
+
+    def indices(self, x_min, x_max, width):
+        # Indices of the samples to draw for the range x_min to x_max on width pixels. A sample
+        # on both sides of the range is included so that lines reach the edges.
+        start = max(np.searchsorted(self._x, x_min, 'left') - 1, 0)
+        stop = min(np.searchsorted(self._x, x_max, 'right') + 1, len(self._x))
+        if stop <= start:
+            return self._index[:0]
+        level = self.level(stop - start, max(width, 1.0))
+        size = 1 << level
+        points = self._levels[level]
+        lo = np.searchsorted(points, start // size * size)
+        hi = np.searchsorted(points, -(-stop // size) * size)
+        return self._index[points[lo:hi]]
+
+
+def _pair_extremes(y, positions, better):
+    # Extremes of the groups twice as large from the extremes of the neighbouring groups
+    if len(positions) % 2:
+        positions = np.append(positions, positions[-1])
+    a, b = positions[0::2], positions[1::2]
+    return np.where(better(y[b], y[a]) | np.isnan(y[a]), b, a)
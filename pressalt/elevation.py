@@ -21,6 +21,8 @@ import pyproj
 from osgeo import osr
 from scipy import interpolate
 
+from . import profiling
+
 
 class GeoFile:
     
@@ -35,6 +37,10 @@ class GeoFile:
         band = self.dataset.GetRasterBand(band)
         
     def values(self, x, y, proj=pyproj.Proj('+init=EPSG:4326'), geoid=None):
+        with profiling.span('GeoFile.values'):
+            return self._values(x, y, proj, geoid)
+
+    def _values(self, x, y, proj, geoid):
         assert(len(x) == len(y))
         
         pixels_x = np.empty(len(x))
@@ -0,0 +1,403 @@
+# -*- coding: utf-8 -*-
+#
+#  (C) Copyright 2013, 2016 Wojciech Mruczkiewicz
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from math import log, pi, sqrt
+import inspect
+import warnings
+import numpy as np
+
+from .altitude_rate_filter import AltitudeRateFilter
+from .atmosphere import PRESSURE_EXPONENT, PRESSURE_FACTOR, pressure_ratio
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+if njit is not None:
+    _pressure_ratio = njit(inline='always')(pressure_ratio)
+else:
+    _pressure_ratio = pressure_ratio
+
+# Whether the fallback to the interpreted kernels was reported
+_interpreted_warned = False
+
+ESTIMATED_PARAMETERS = ('gps_var_factor', 'pressure_var', 'altitude_noise', 'altitude_rate_noise',
+                        'pressure_noise')
+
+LIKELIHOOD_OUTLIER_MODES = {None: 0, 'huber': 1, 'student': 2}
+
+EVENT_GPS = 0
+EVENT_PRESSURE = 1
+
+
+def merge_events(gps_events, pressure_events):
+    # Events as arrays of kinds, times, values and accuracies, in the order of FilterBase.execute
+    gps = np.array(gps_events, dtype=float).reshape(-1, 3)
+    pressure = np.array(pressure_events, dtype=float).reshape(-1, 2)
+    n = len(gps) + len(pressure)
+    gps_index = np.arange(len(gps)) + np.searchsorted(pressure[:, 0], gps[:, 0], side='right')
+    pressure_index = np.arange(len(pressure)) + np.searchsorted(gps[:, 0], pressure[:, 0],
+                                                                side='left')
+    kind = np.empty(n, dtype=np.int8)
+    time = np.empty(n)
+    value = np.empty(n)
+    accuracy = np.zeros(n)
+    kind[gps_index], kind[pressure_index] = EVENT_GPS, EVENT_PRESSURE
+    time[gps_index], time[pressure_index] = gps[:, 0], pressure[:, 0]
+    value[gps_index], value[pressure_index] = gps[:, 1], pressure[:, 1]
+    accuracy[gps_index] = gps[:, 2]
+    return kind, time, value, accuracy
+
+
+def _likelihood_kernel(kind, time, value, accuracy, gps_var_factor, pressure_var, altitude_noise,
+                       altitude_rate_noise, pressure_noise, P0, gate, mode, dof):
+    # AltitudeRateFilter written out on scalars with the symmetric covariance entries
+    e, f = PRESSURE_EXPONENT, PRESSURE_FACTOR
+    started = False
+    have_altitude = False
+    last_altitude = 0.0
+    last_time = 0.0
+    x0 = x1 = x2 = 0.0
+    P00 = P01 = P02 = P11 = P12 = P22 = 0.0
+    result = 0.0
+    for k in range(len(kind)):
+        if kind[k] == 0:
+            last_altitude = value[k]
+            have_altitude = True
+            if not started:
+                continue
+            r = value[k] - x0
+            v0, v1, v2 = P00, P01, P02
+            S = P00 + accuracy[k]*accuracy[k]*gps_var_factor
+        elif not started:
+            if have_altitude and last_altitude != 0.0:
+                x0 = last_altitude
+                x1 = 0.0
+                x2 = value[k]/(1.0 - f*last_altitude)**e
+                P00, P01, P02 = P0[0, 0], P0[0, 1], P0[0, 2]
+                P11, P12, P22 = P0[1, 1], P0[1, 2], P0[2, 2]
+                last_time = time[k]
+                started = True
+            continue
+        else:
+            dt = abs(time[k] - last_time)/1000.0
+            last_time = time[k]
+            x0 += dt*x1
+            P00 += dt*(2.0*P01 + dt*P11) + altitude_noise*dt
+            P01 += dt*P11
+            P02 += dt*P12
+            P11 += altitude_rate_noise*dt
+            P22 += pressure_noise*dt
+
+            h2, slope = _pressure_ratio(x0, e, f)
+            h0 = x2*slope
+            r = value[k] - x2*h2
+            v0 = P00*h0 + P02*h2
+            v1 = P01*h0 + P12*h2
+            v2 = P02*h0 + P22*h2
+            HPH = h0*v0 + h2*v2
+            S = HPH + pressure_var
+            nu2 = r*r/S
+            if mode == 1:
+                if nu2 > gate*gate:
+                    S *= sqrt(nu2)/gate
+            elif mode == 2:
+                S = HPH + pressure_var*((dof + nu2)/(dof + 1.0))
+
+        result -= 0.5*(log(2.0*pi*S) + r*r/S)
+        x0 += v0*r/S
+        x1 += v1*r/S
+        x2 += v2*r/S
+        P00 -= v0*v0/S
+        P01 -= v0*v1/S
+        P02 -= v0*v2/S
+        P11 -= v1*v1/S
+        P12 -= v1*v2/S
+        P22 -= v2*v2/S
+    return result
+
+
+if njit is not None:
+    _likelihood_kernel = njit(cache=True)(_likelihood_kernel)
+
+
+def _warn_interpreted():
+    # Without numba the kernels run as plain Python, which is far too slow for fitting
+    global _interpreted_warned
+    if njit is None and not _interpreted_warned:
+        _interpreted_warned = True
+        warnings.warn('numba is not available, the likelihood kernels run interpreted and fits '
+                      'take minutes instead of seconds', RuntimeWarning, stacklevel=3)
+
+
+def filter_defaults(filter_class=AltitudeRateFilter):
+    parameters = inspect.signature(filter_class.__init__).parameters
+    return {name: p.default for name, p in parameters.items()
+            if p.default is not inspect.Parameter.empty}
+
+
+class LikelihoodModel:
+    # Innovation log-likelihood of AltitudeRateFilter for a recording. Events are merged once and
+    # the filter loop runs in a scalar kernel, compiled with numba when it is installed.
+
+    def __init__(self, gps_events, pressure_events, **params):
+        _warn_interpreted()
+        self._events = merge_events(gps_events, pressure_events)
+        self._gps = np.array(gps_events, dtype=float).reshape(-1, 3)
+        self._pressure = np.array(pressure_events, dtype=float).reshape(-1, 2)
+        self._params = filter_defaults()
+        self.update(**params)
+
+    def params(self):
+        return dict(self._params)
+
+    def update(self, **params):
+        for name in params:
+            if name not in self._params:
+                raise ValueError('Unknown filter parameter: %s' % name)
+        self._params.update(params)
+        if self._params['outlier_mode'] not in LIKELIHOOD_OUTLIER_MODES:
+            raise ValueError('Unknown outlier mode: %s' % self._params['outlier_mode'])
+
+    def log_likelihood(self, **params):
+        p = dict(self._params, **params)
+        return _likelihood_kernel(*self._events, float(p['gps_var_factor']),
+                                  float(p['pressure_var']), float(p['altitude_noise']),
+                                  float(p['altitude_rate_noise']), float(p['pressure_noise']),
+                                  np.asarray(p['P0'], dtype=float), float(p['outlier_gate']),
+                                  LIKELIHOOD_OUTLIER_MODES[p['outlier_mode']],
+                                  float(p['outlier_dof']))
+
+    def fit(self, parameters=ESTIMATED_PARAMETERS, bounds=(1e-9, 1e4), method='L-BFGS-B',
+            options=None):
+        # Maximum likelihood estimate of positive parameters, searched on a logarithmic scale
+        import scipy.optimize
+        initial = np.log([self._params[name] for name in parameters])
+
+        def objective(y):
+            value = -self.log_likelihood(**dict(zip(parameters, np.exp(y))))
+            return value if np.isfinite(value) else 1e300
+
+        result = scipy.optimize.minimize(objective, initial, method=method,
+                                         bounds=[np.log(bounds)]*len(parameters),
+                                         options=options)
+        self.update(**dict(zip(parameters, np.exp(result.x).tolist())))
+        return self.params(), result
+
+    def fit_em(self, iterations=100, tolerance=1e-6, parameters=ESTIMATED_PARAMETERS):
+        # EM on the smoothed statistics of the filter model. The E step is a Rauch-Tung-Striebel
+        # pass, which unlike the forward-backward AltitudeRateSmoother provides the lag-one
+        # covariances needed by the process noise update. Gating is not applied in the E step.
+        p = self._params
+        history = list()
+        for _ in range(iterations):
+            stats = _smoother_kernel(*self._events, float(p['gps_var_factor']),
+                                     float(p['pressure_var']), float(p['altitude_noise']),
+                                     float(p['altitude_rate_noise']), float(p['pressure_noise']),
+                                     np.asarray(p['P0'], dtype=float))
+            history.append(stats[-1])
+            steps, pressures, fixes = max(stats[3], 1.0), max(stats[5], 1.0), max(stats[7], 1.0)
+            estimate = {'altitude_noise': stats[0]/steps,
+                        'altitude_rate_noise': stats[1]/steps,
+                        'pressure_noise': stats[2]/steps,
+                        'pressure_var': stats[4]/pressures,
+                        'gps_var_factor': stats[6]/fixes}
+            self.update(**{name: max(float(estimate[name]), 1e-12) for name in parameters})
+            if len(history) > 1 and abs(history[-1] - history[-2]) <= tolerance*abs(history[-2]):
+                break
+        return self.params(), history
+
+
+def _inverse3(A, out):
+    out[0, 0] = A[1, 1]*A[2, 2] - A[1, 2]*A[2, 1]
+    out[0, 1] = A[0, 2]*A[2, 1] - A[0, 1]*A[2, 2]
+    out[0, 2] = A[0, 1]*A[1, 2] - A[0, 2]*A[1, 1]
+    out[1, 0] = A[1, 2]*A[2, 0] - A[1, 0]*A[2, 2]
+    out[1, 1] = A[0, 0]*A[2, 2] - A[0, 2]*A[2, 0]
+    out[1, 2] = A[0, 2]*A[1, 0] - A[0, 0]*A[1, 2]
+    out[2, 0] = A[1, 0]*A[2, 1] - A[1, 1]*A[2, 0]
+    out[2, 1] = A[0, 1]*A[2, 0] - A[0, 0]*A[2, 1]
+    out[2, 2] = A[0, 0]*A[1, 1] - A[0, 1]*A[1, 0]
+    det = A[0, 0]*out[0, 0] + A[0, 1]*out[1, 0] + A[0, 2]*out[2, 0]
+    for i in range(3):
+        for j in range(3):
+            out[i, j] /= det
+
+
+def _multiply3(A, B, out, transpose):
+    # out = A B or, with transpose set, out = A B^T
+    for i in range(3):
+        for j in range(3):
+            s = 0.0
+            for k in range(3):
+                s += A[i, k]*(B[j, k] if transpose else B[k, j])
+            out[i, j] = s
+
+
+def _smoother_kernel(kind, time, value, accuracy, gps_var_factor, pressure_var, altitude_noise,
+                     altitude_rate_noise, pressure_noise, P0):
+    # Filter pass storing predicted and filtered moments of every pressure time, followed by the
+    # Rauch-Tung-Striebel pass accumulating the expected squared process and measurement noises.
+    # GPS fixes update the state of the preceding pressure time, as in the filter. The transition
+    # only adds dt times the rate to the altitude, which is written out below.
+    e, f = PRESSURE_EXPONENT, PRESSURE_FACTOR
+    N = len(kind)
+    xf = np.zeros((N, 3))
+    Pf = np.zeros((N, 3, 3))
+    xp = np.zeros((N, 3))
+    Pp = np.zeros((N, 3, 3))
+    steps = np.zeros(N)
+    pressure = np.zeros(N)
+    gps_state = np.zeros(N, dtype=np.int64)
+    gps_value = np.zeros(N)
+    gps_accuracy = np.zeros(N)
+    q = np.array([altitude_noise, altitude_rate_noise, pressure_noise])
+    H = np.zeros(3)
+    v = np.zeros(3)
+    x = np.zeros(3)
+    P = np.zeros((3, 3))
+    have_altitude = False
+    last_altitude = 0.0
+    last_time = 0.0
+    log_likelihood = 0.0
+    m = -1
+    fixes = 0
+    for k in range(N):
+        if kind[k] == 0:
+            last_altitude = value[k]
+            have_altitude = True
+            if m < 0:
+                continue
+            H[0], H[1], H[2] = 1.0, 0.0, 0.0
+            r = value[k] - x[0]
+            R = accuracy[k]*accuracy[k]*gps_var_factor
+            gps_state[fixes] = m
+            gps_value[fixes] = value[k]
+            gps_accuracy[fixes] = accuracy[k]
+            fixes += 1
+        elif m < 0:
+            if have_altitude and last_altitude != 0.0:
+                x[0], x[1] = last_altitude, 0.0
+                x[2] = value[k]/(1.0 - f*last_altitude)**e
+                for i in range(3):
+                    for j in range(3):
+                        P[i, j] = P0[i, j]
+                last_time = time[k]
+                m = 0
+                xf[0] = x
+                Pf[0] = P
+            continue
+        else:
+            dt = abs(time[k] - last_time)/1000.0
+            last_time = time[k]
+            x[0] += dt*x[1]
+            for j in range(3):
+                P[0, j] += dt*P[1, j]
+            for i in range(3):
+                P[i, 0] += dt*P[i, 1]
+            for i in range(3):
+                P[i, i] += q[i]*dt
+            m += 1
+            xp[m] = x
+            Pp[m] = P
+            steps[m] = dt
+            pressure[m] = value[k]
+            ratio, slope = _pressure_ratio(x[0], e, f)
+            H[0], H[1], H[2] = x[2]*slope, 0.0, ratio
+            r = value[k] - x[2]*ratio
+            R = pressure_var
+
+        S = R
+        for i in range(3):
+            v[i] = P[i, 0]*H[0] + P[i, 1]*H[1] + P[i, 2]*H[2]
+            S += H[i]*v[i]
+        log_likelihood -= 0.5*(log(2.0*pi*S) + r*r/S)
+        for i in range(3):
+            x[i] += v[i]*r/S
+            for j in range(3):
+                P[i, j] -= v[i]*v[j]/S
+        xf[m] = x
+        Pf[m] = P
+
+    stats = np.zeros(9)
+    stats[8] = log_likelihood
+    G = np.zeros((3, 3))
+    A = np.zeros((3, 3))
+    B = np.zeros((3, 3))
+    xs = np.zeros(3)
+    Ps = np.zeros((3, 3))
+    for k in range(m - 1, -1, -1):
+        # Smoothed moments overwrite the filtered ones, G = Pf[k] F^T Pp[k+1]^-1
+        dt = steps[k + 1]
+        _inverse3(Pp[k + 1], B)
+        for i in range(3):
+            for j in range(3):
+                A[i, j] = Pf[k, i, j]
+            A[i, 0] += dt*Pf[k, i, 1]
+        _multiply3(A, B, G, False)
+        for i in range(3):
+            v[i] = xf[k + 1, i] - xp[k + 1, i]
+        for i in range(3):
+            xs[i] = xf[k, i] + G[i, 0]*v[0] + G[i, 1]*v[1] + G[i, 2]*v[2]
+        for i in range(3):
+            for j in range(3):
+                B[i, j] = Pf[k + 1, i, j] - Pp[k + 1, i, j]
+        _multiply3(G, B, A, False)
+        _multiply3(A, G, Ps, True)
+        for i in range(3):
+            for j in range(3):
+                Ps[i, j] += Pf[k, i, j]
+
+        # Diagonal of E[w w^T] for w = x[k+1] - F x[k], with Cov(x[k+1], x[k]) = Pf[k+1] G^T
+        C00, C01, C11, C22 = 0.0, 0.0, 0.0, 0.0
+        for j in range(3):
+            C00 += Pf[k + 1, 0, j]*G[0, j]
+            C01 += Pf[k + 1, 0, j]*G[1, j]
+            C11 += Pf[k + 1, 1, j]*G[1, j]
+            C22 += Pf[k + 1, 2, j]*G[2, j]
+        w0 = xf[k + 1, 0] - xs[0] - dt*xs[1]
+        w1 = xf[k + 1, 1] - xs[1]
+        w2 = xf[k + 1, 2] - xs[2]
+        stats[0] += (w0*w0 + Pf[k + 1, 0, 0] - 2.0*(C00 + dt*C01) + Ps[0, 0] +
+                     2.0*dt*Ps[0, 1] + dt*dt*Ps[1, 1])/dt
+        stats[1] += (w1*w1 + Pf[k + 1, 1, 1] - 2.0*C11 + Ps[1, 1])/dt
+        stats[2] += (w2*w2 + Pf[k + 1, 2, 2] - 2.0*C22 + Ps[2, 2])/dt
+        stats[3] += 1.0
+
+        ratio, slope = _pressure_ratio(xf[k + 1, 0], e, f)
+        H[0], H[1], H[2] = xf[k + 1, 2]*slope, 0.0, ratio
+        r = pressure[k + 1] - xf[k + 1, 2]*ratio
+        stats[4] += r*r
+        for i in range(3):
+            for j in range(3):
+                stats[4] += H[i]*Pf[k + 1, i, j]*H[j]
+        stats[5] += 1.0
+        xf[k] = xs
+        Pf[k] = Ps
+
+    for i in range(fixes):
+        j = gps_state[i]
+        r = gps_value[i] - xf[j, 0]
+        stats[6] += (r*r + Pf[j, 0, 0])/(gps_accuracy[i]*gps_accuracy[i])
+        stats[7] += 1.0
+    return stats
+
+
+if njit is not None:
+    _inverse3 = njit(cache=True)(_inverse3)
+    _multiply3 = njit(cache=True)(_multiply3)
+    _smoother_kernel = njit(cache=True)(_smoother_kernel)
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+#
+#  (C) Copyright 2013, 2016 Wojciech Mruczkiewicz
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from .resampling import Resampler, uniform_grid
+import inspect
+import json
+import os
+import numpy as np
+
+# pyarrow is needed for the tables and pandas only for the data frames, both are imported by the
+# functions using them.
+
+EXPORT_METADATA_KEY = b'pressalt'
+
+# Filter accessors exported on the pressure clock and on the GPS clock with their column names.
+# The filters keep variances in the accessors named sd.
+FILTER_COLUMNS = (('altitude', 'altitude'), ('altitude_sd', 'altitude_variance'),
+                  ('altitude_rate', 'altitude_rate'), ('pressure_msl', 'pressure_msl'))
+FILTER_GPS_COLUMNS = (('altitude_gps', 'altitude'), ('altitude_sd_gps', 'altitude_variance'),
+                      ('altitude_gps_sd', 'altitude_variance'))
+
+
+def filter_parameters(filter):
+    # Arguments of the filter constructor as kept by the filter, those without a JSON form are
+    # left out
+    parameters = dict()
+    for name in inspect.signature(type(filter).__init__).parameters:
+        if not hasattr(filter, '_' + name):
+            continue
+        value = getattr(filter, '_' + name)
+        if isinstance(value, np.ndarray):
+            value = value.tolist()
+        elif isinstance(value, np.generic):
+            value = value.item()
+        try:
+            json.dumps(value)
+        except TypeError:
+            continue
+        parameters[name] = value
+    return parameters
+
+
+def reader_columns(reader):
+    # Column stores of a GpsPressureReader by table
+    gps = {'time': reader.gps_time(),
+           'latitude': reader.gps_latitude(),
+           'longitude': reader.gps_longitude(),
+           'altitude': reader.gps_altitude(),
+           'bearing': reader.gps_bearing(),
+           'speed': reader.gps_speed()}
+    pressure = {'time': reader.press_time(),
+                'pressure': reader.press_pressure(),
+                'altitude': reader.press_altitude()}
+    if len(gps['time']) > 1:
+        gps['distance'] = reader.gps_distance()
+        pressure['distance'] = reader.press_distance()
+    return {'gps': gps, 'pressure': pressure}
+
+
+def filter_columns(filter, press_time, gps_time, smoothed=None):
+    # Column stores of the filter results on the pressure and on the GPS clock, with the smoothed
+    # altitude on the pressure clock
+    def accessor_columns(time, accessors):
+        columns = {'time': np.asarray(time)}
+        for accessor, name in accessors:
+            if hasattr(filter, accessor) and name not in columns:
+                values = getattr(filter, accessor)()
+                if len(values) == len(time):
+                    columns[name] = values
+        return columns
+
+    result = accessor_columns(press_time, FILTER_COLUMNS)
+    if smoothed is not None:
+        result['altitude_smoothed'] = np.asarray(smoothed, dtype=float)
+    return {'filter': result, 'filter_gps': accessor_columns(gps_time, FILTER_GPS_COLUMNS)}
+
+
+def heart_rate_columns(heart_rate):
+    time, rr = heart_rate.expand_rr_intervals()
+    return {'heart_rate': {'time': np.array(heart_rate.milliseconds, dtype=np.int64),
+                           'heart_rate': np.array(heart_rate.values, dtype=float)},
+            'rr_interval': {'time': np.rint(np.asarray(time) * 1000.0 + heart_rate.start_time)
+                            .astype(np.int64), 'rr_interval': np.array(rr, dtype=float)}}
+
+
+def aligned_columns(tables, step, start=None, end=None, max_gap=None):
+    # All columns of the tables linearly resampled on a uniform grid of the step in milliseconds,
+    # named table.column. Grid points in gaps longer than max_gap are NaN.
+    times = [np.asarray(c['time']) for c in tables.values() if len(c['time']) > 0]
+    if not times:
+        return {'time': np.zeros(0, dtype=np.int64)}
+    start = min(t.min() for t in times) if start is None else start
+    end = max(t.max() for t in times) if end is None else end
+    resampler = Resampler(uniform_grid(start, end, step), max_gap=max_gap)
+    columns = {'time': resampler.grid().astype(np.int64)}
+    for table, table_columns in tables.items():
+        for name, values in table_columns.items():
+            if name != 'time':
+                columns['%s.%s' % (table, name)] = resampler.resample(table_columns['time'],
+                                                                      values)
+    return columns
+
+
+def recording_columns(reader, filter=None, smoothed=None, heart_rate=None, aligned_step=None,
+                      max_gap=None):
+    # Column stores of the raw, filtered and smoothed series of a recording by table, with the
+    # series aligned on a common grid when aligned_step is given
+    tables = reader_columns(reader)
+    if filter is not None:
+        tables.update(filter_columns(filter, reader.press_time(), reader.gps_time(), smoothed))
+    if heart_rate is not None:
+        tables.update(heart_rate_columns(heart_rate))
+    if aligned_step is not None:
+        tables['aligned'] = aligned_columns(tables, aligned_step, max_gap=max_gap)
+    return tables
+
+
+def export_metadata(reader, filter=None, smoothing=None, **metadata):
+    # Description of the export stored with the schema of every table
+    metadata = dict(metadata)
+    metadata['start_time'] = reader.start_time
+    metadata['end_time'] = reader.end_time
+    if filter is not None:
+        metadata['filter'] = type(filter).__name__
+        metadata['parameters'] = filter_parameters(filter)
+    if smoothing is not None:
+        metadata['smoothing'] = smoothing
+    return metadata
+
+
+def arrow_table(columns, metadata=None):
+    # Arrow table of the numpy columns, numeric columns without nulls share the numpy buffers.
+    # NaN stays a floating point value and is not turned into a null.
+    import pyarrow as pa
+    names = list(columns)
+    arrays = [pa.array(np.ascontiguousarray(columns[name])) for name in names]
+    table = pa.Table.from_arrays(arrays, names=names)
+    if metadata is not None:
+        table = table.replace_schema_metadata(
+            {EXPORT_METADATA_KEY: json.dumps(metadata, sort_keys=True, default=float)})
+    return table
+
+
+def arrow_tables(tables, metadata=None):
+    return {name: arrow_table(columns, dict(metadata, table=name) if metadata is not None
+                              else None)
+            for name, columns in tables.items()}
+
+
+def table_metadata(table):
+    # Export metadata of an Arrow table or of a Parquet schema, None without it
+    metadata = table.schema.metadata if hasattr(table, 'schema') else table.metadata
+    if not metadata or EXPORT_METADATA_KEY not in metadata:
+        return None
+    return json.loads(metadata[EXPORT_METADATA_KEY].decode('utf-8'))
+
+
+def data_frames(tables):
+    # pandas data frames of the Arrow tables
+    return {name: table.to_pandas() for name, table in tables.items()}
+
+
+def write_dataset(tables, directory, recording, compression='zstd'):
+    # Writes the Arrow tables as a Parquet dataset partitioned by table and recording in the hive
+    # layout, directory/table/recording=name/part-0.parquet, so that a dataset of a table reads
+    # all recordings with the recording column. Exporting a recording again replaces its files.
+    import pyarrow.parquet as pq
+    paths = list()
+    for name, table in tables.items():
+        path = os.path.join(directory, name, 'recording=%s' % recording)
+        os.makedirs(path, exist_ok=True)
+        paths.append(os.path.join(path, 'part-0.parquet'))
+        pq.write_table(table, paths[-1], compression=compression)
+    return paths
@@ -14,6 +14,220 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+from math import sqrt
+import collections
+import numpy as np
+
+from . import profiling
+
+OUTLIER_MODES = (None, 'huber', 'student')
+
+COVARIANCE_FORMS = ('standard', 'ud')
+
+# Relative change of the measurement Jacobian for which a cached steady-state entry is rebuilt
+STEADY_JACOBIAN_TOLERANCE = 1e-3
+STEADY_MODEL_TOLERANCE = 1e-2
+# Gain components smaller than this part of the largest one are compared relative to it
+STEADY_GAIN_FLOOR = 1e-2
+# Runs of pressure events between GPS fixes, in multiples of the shortest batch, on which batches
+# pay off on average
+STEADY_RUN_FACTOR = 6
+
+
+def robust_variance(r, HPH, R, gate, mode, dof):
+    # Returns the innovation variance H P H^T + R of a residual r, with the measurement variance
+    # inflated so that measurements failing the normalized innovation test r^2/S <= gate^2 have
+    # a bounded influence (Huber) or are weighted as under Student-t distributed noise.
+    S = HPH + R
+    nu2 = r*r/S
+    if mode == 'huber':
+        if nu2 > gate*gate:
+            return S*(sqrt(nu2)/gate)
+    elif mode == 'student':
+        return HPH + R*((dof + nu2)/(dof + 1.0))
+    return S
+
+
+def steady_state_tf(M, u):
+    # Transfer functions of the recurrence x[k] = M x[k-1] + u c[k] from the input c and, for
+    # every component of the initial state x[-1], from a unit impulse. The inverse of I - M z^-1
+    # is sum B[k] z^-k over the characteristic polynomial of M, with B[k] = M B[k-1] + den[k] I
+    # by the Faddeev-LeVerrier recursion.
+    n = len(u)
+    den = np.real(np.poly(M))
+    B = [np.identity(n)]
+    for k in range(1, n):
+        B.append(M.dot(B[-1]) + den[k]*np.identity(n))
+    num = np.array([b.dot(u) for b in B]).T
+    num0 = np.array([b.dot(M) for b in B]).transpose(2, 1, 0)
+    return num, num0, den
+
+
+def linear_response(tf, c, x0):
+    # States x[0..n-1] of the recurrence described by steady_state_tf for x[-1] = x0.
+    import scipy.signal as signal
+    num, num0, den = tf
+    impulse = np.zeros(len(c))
+    impulse[0] = 1.0
+    x = np.empty((len(c), len(x0)))
+    for i in range(len(x0)):
+        x[:, i] = signal.lfilter(num[i], den, c) + signal.lfilter(x0.dot(num0[:, i]), den, impulse)
+    return x
+
+
+def ud_factor(P):
+    # Factors P = U diag(d) U^T with U unit upper triangular, columns of zero pivots are zero
+    P = np.array(P, dtype=float)
+    n = len(P)
+    U = np.identity(n)
+    d = np.zeros(n)
+    for j in range(n - 1, -1, -1):
+        d[j] = P[j, j] - (U[j, j+1:]**2).dot(d[j+1:])
+        if d[j] > 0.0:
+            U[:j, j] = (P[:j, j] - (U[:j, j+1:]*d[j+1:]).dot(U[j, j+1:])) / d[j]
+    return U, d
+
+
+class StandardCovariance:
+    # Covariance matrix updated in the conventional (I - K H) P form.
+
+    def __init__(self, P):
+        self._P = np.array(P, dtype=float)
+
+    def matrix(self):
+        return self._P.copy()
+
+    def variance(self, i):
+        return self._P[i, i]
+
+    def set(self, P):
+        self._P = np.array(P, dtype=float)
+
+    def predict(self, F, q, rank_one=()):
+        Q = np.diag(q)
+        for c, a in rank_one:
+            Q += c*np.outer(a, a)
+        if F is None:
+            self._P = self._P + Q
+        else:
+            self._P = F.dot(self._P.dot(F.T)) + Q
+
+    def update(self, H, R, variance=None):
+        profiling.count('kalman.update')
+        PH = self._P.dot(H)
+        HPH = H.dot(PH)
+        S = HPH + R if variance is None else variance(HPH, R)
+        K = PH / S
+        self._P = (np.identity(len(H)) - np.outer(K, H)).dot(self._P)
+        return K, S
+
+
+class UDCovariance:
+    # Covariance matrix kept as P = U diag(d) U^T with U unit upper triangular. Measurements use
+    # the Bierman scalar update and process noise is added with Agee-Turner rank-one updates, so
+    # P stays symmetric and positive definite however long the filter runs. Transition matrices
+    # have to be unit upper triangular, which holds for the constant rate models of this package.
+    # Factors are kept in Python lists, which are faster than small numpy arrays here.
+
+    def __init__(self, P):
+        self.set(P)
+
+    def matrix(self):
+        U = np.array(self._U)
+        return (U * self._d).dot(U.T)
+
+    def variance(self, i):
+        U, d = self._U[i], self._d
+        return sum(U[k]*U[k]*d[k] for k in range(i, len(d)))
+
+    def set(self, P):
+        U, d = ud_factor(P)
+        if (d <= 0.0).any():
+            raise ValueError('Covariance matrix is not positive definite')
+        self._U = U.tolist()
+        self._d = d.tolist()
+
+    def predict(self, F, q, rank_one=()):
+        # Process noise is diag(q) plus the c a a^T terms of rank_one
+        U, d = self._U, self._d
+        n = len(d)
+        if F is not None:
+            # Rows of F U computed in place, F - I is strictly upper triangular
+            F = F.tolist()
+            for i in range(n):
+                if F[i][i] != 1.0 or any(F[i][:i]):
+                    raise ValueError('UD covariance requires a unit upper triangular transition')
+                Ui = U[i]
+                for k in range(i + 1, n):
+                    c = F[i][k]
+                    if c != 0.0:
+                        Uk = U[k]
+                        for j in range(k, n):
+                            Ui[j] += c*Uk[j]
+        noise = [(m, c, None) for m, c in enumerate(q.tolist())]
+        for c, a in rank_one:
+            # Scaled to a = column + e_m with m the last nonzero entry
+            a = list(a)
+            m = max(i for i in range(n) if a[i] != 0.0)
+            noise.append((m, c*a[m]*a[m], [a[i]/a[m] for i in range(m)]))
+        for m, c, column in noise:
+            if c > 0.0:
+                # Agee-Turner update of U D U^T + c a a^T
+                if column is None:
+                    a = [-U[i][m] for i in range(m)]
+                else:
+                    a = [column[i] - U[i][m] for i in range(m)]
+                dm = d[m] + c
+                beta = c/dm
+                c *= d[m]/dm
+                d[m] = dm
+                for i in range(m):
+                    U[i][m] += beta*a[i]
+                for j in range(m - 1, -1, -1):
+                    s = a[j]
+                    dj = d[j] + c*s*s
+                    beta = c*s/dj
+                    c *= d[j]/dj
+                    d[j] = dj
+                    for i in range(j):
+                        a[i] -= s*U[i][j]
+                        U[i][j] += beta*a[i]
+
+    def update(self, H, R, variance=None):
+        profiling.count('kalman.update')
+        U, d = self._U, self._d
+        n = len(d)
+        f = H.tolist()
+        for j in range(n - 1, 0, -1):
+            for i in range(j):
+                f[j] += U[i][j]*f[i]
+        g = [d[j]*f[j] for j in range(n)]
+        HPH = 0.0
+        for j in range(n):
+            HPH += f[j]*g[j]
+        if variance is not None:
+            R = variance(HPH, R) - HPH
+        alpha = float(R)
+        b = g[:]
+        for j in range(n):
+            previous = alpha
+            alpha += f[j]*g[j]
+            d[j] *= previous/alpha
+            p = -f[j]/previous
+            for i in range(j):
+                Uij = U[i][j]
+                U[i][j] = Uij + b[i]*p
+                b[i] += Uij*g[j]
+        return np.array(b)/alpha, alpha
+
+
+def make_covariance(P, form):
+    if form == 'standard':
+        return StandardCovariance(P)
+    elif form == 'ud':
+        return UDCovariance(P)
+    raise ValueError('Unknown covariance form: %s' % form)
+
 
 class FilterBase:
 
@@ -23,6 +237,7 @@ class FilterBase:
     def on_pressure(self, time, pressure):
         pass
 
+    @profiling.method_span('execute')
     def execute(self, gps_events, pressure_events):
         ia, ip = 0, 0
         while True:
@@ -44,6 +259,207 @@ class FilterBase:
             else:
                 break
 
+    @profiling.method_span('execute')
+    def execute_runs(self, gps_events, pressure_events):
+        # Processes events in the same order as execute, but passes all pressure events between
+        # consecutive GPS fixes to on_pressure_run at once.
+        ip = 0
+        for gps_event in gps_events:
+            stop = ip
+            while stop < len(pressure_events) and pressure_events[stop][0] <= gps_event[0]:
+                stop += 1
+            if stop > ip:
+                self.on_pressure_run(pressure_events, ip, stop)
+            ip = stop
+            self.on_gps(*gps_event)
+            self._steady.reset()
+        if ip < len(pressure_events):
+            self.on_pressure_run(pressure_events, ip, len(pressure_events))
+
+    def on_pressure_run(self, pressure_events, start, stop):
+        steady = self._steady
+        if not steady.enable(stop - start):
+            for i in range(start, stop):
+                self.on_pressure(*pressure_events[i])
+            return
+        i = start
+        while i < stop:
+            n = steady.batch(self, pressure_events, i, stop)
+            if n == 0:
+                self.on_pressure(*pressure_events[i])
+                n = 1
+            i += n
+
+    # Hooks of the steady-state gain mode. Filters using it keep a SteadyState in _steady, pass
+    # the gain of every pressure update to its track method and implement:
+    #   _pressure_model(time, x): the measurement and its Jacobian at the state x
+    #   _steady_model(dt, H, K): M and u of the linearized update x[k] = M x[k-1] + u c[k], and
+    #       A and W of the covariance after it, P[k] = A P[k-1] A^T + W
+    #   _steady_current(): time, state, covariance and pressure variance of the last update, None
+    #       before the start
+    #   _steady_advance(time, x, variance, P): sets the states x of a batch, the altitude
+    #       variances of its samples and the covariance P at its end
+
+
+class SteadyState:
+    # Steady-state gains of a filter by quantized time step. Pressure alone does not separate
+    # altitude from the MSL pressure, so between GPS fixes the covariance grows along that
+    # direction while the gain converges. Gains are compared min_run updates apart, since the
+    # consecutive ones of a slowly converging gain agree long before it settles. A gain is
+    # converged when this change is below the tolerance and, while the changes shrink
+    # geometrically, so is the rest of the change they sum to. Changes which don't shrink follow
+    # the drift of the Jacobian, which the batches are limited by. A converged gain is cached
+    # with the transfer functions of the linearized update, and runs of pressure events with the
+    # same time step are then filtered at once with scipy.signal.lfilter. The covariance follows
+    # the Joseph form for the cached gain, which is insensitive to its error in the first order,
+    # so that the gains after a batch agree with the full filter. A batch ends where the
+    # Jacobian of the measurement drifts from the one of the cached gain or the measurement stops
+    # being linear, and full updates converge the gain again from there.
+
+    def __init__(self, resolution, tolerance, min_run):
+        self._resolution = resolution
+        self._tolerance = tolerance
+        self._min_run = min_run
+        # Gains are tracked only on the runs enabled by execute_runs
+        self._enabled = False
+        self._entries = dict()
+        self._span = None
+        # Updates the gain took to converge after a reset, at least, when it did not converge
+        self._settle = 0
+        self._updates = 0
+        self._bucket = None
+        self._gains = collections.deque(maxlen=2*min_run + 1)
+        self._converged = False
+        # Events left before a batch is tried again after a failed one
+        self._hold = 0
+
+    def enable(self, run):
+        # Tracks the gain over a run of events only when it may converge early enough for a batch
+        # to pay off. Skipped runs lower the estimate, so that tracking is retried after a few.
+        self._enabled = run >= self._settle + self._min_run
+        if not self._enabled:
+            self._settle = max(self._settle - max(self._min_run // 4, 1), 0)
+        return self._enabled
+
+    def reset(self):
+        if not self._converged:
+            self._settle = max(self._settle, self._updates)
+        self._updates = 0
+        self._bucket = None
+        self._gains.clear()
+        self._converged = False
+        self._hold = 0
+
+    def _step_bucket(self, dt):
+        return int(round(dt / self._resolution))
+
+    def _scale(self, K):
+        # Components are compared relative to their own size, down to a part of the largest one
+        K = np.abs(K)
+        return np.maximum(K, STEADY_GAIN_FLOOR*K.max())
+
+    def _matches(self, K0, K1):
+        return (np.abs(K0 - K1) / self._scale(K0)).max() <= self._tolerance
+
+    def _settled(self, K):
+        gains = self._gains
+        if len(gains) < gains.maxlen:
+            return False
+        scale = self._scale(K)
+        change = (np.abs(gains[-1] - gains[self._min_run]) / scale).max()
+        previous = (np.abs(gains[self._min_run] - gains[0]) / scale).max()
+        if change > self._tolerance:
+            return False
+        if change < previous:
+            ratio = change / previous
+            return change*ratio/(1.0 - ratio) <= self._tolerance
+        return True
+
+    def track(self, dt, H, K, model):
+        if not self._enabled:
+            return
+        bucket = self._step_bucket(dt)
+        if bucket != self._bucket:
+            self.reset()
+            self._bucket = bucket
+        self._updates += 1
+        self._gains.append(K)
+        # Convergence is checked every min_run updates, and at every one while it holds
+        if not self._converged and self._updates % self._min_run:
+            return
+        if not self._settled(K):
+            self._converged = False
+            return
+        if not self._converged:
+            self._settle = self._updates
+            self._converged = True
+        entry = self._entries.get(bucket)
+        if entry is None or not self._matches(K, entry[0]):
+            M, u, A, W = model(bucket * self._resolution, H, K)
+            self._entries[bucket] = K, H, steady_state_tf(M, u), A, W
+
+    def batch(self, filter, pressure_events, start, stop):
+        # Filters the events from start with the cached gain, returns their number
+        if self._hold > 0:
+            self._hold -= 1
+            return 0
+        state = filter._steady_current()
+        if not self._enabled or not self._converged or state is None:
+            return 0
+        time, x0, P, R = state
+        bucket = self._step_bucket((pressure_events[start][0] - time) / 1000.0)
+        entry = self._entries.get(bucket)
+        if entry is None or bucket != self._bucket or not self._matches(entry[0], self._gains[-1]):
+            return 0
+        if self._span is not None:
+            stop = min(stop, start + self._span)
+        end = start + 1
+        while end < stop and bucket == self._step_bucket(
+                (pressure_events[end][0] - pressure_events[end - 1][0]) / 1000.0):
+            end += 1
+        if end - start < self._min_run:
+            return 0
+
+        # Linearization of the measurement at the current state, with the Jacobian of the gain
+        _, H, tf, A, W = entry
+        h, H0 = filter._pressure_model(pressure_events[start][0], x0)
+        if not self._jacobian_matches(H, H0):
+            self._hold = self._min_run
+            return 0
+        pressure = np.array([pressure_events[i][1] for i in range(start, end)])
+        c = pressure - h + H.dot(x0)
+        x = linear_response(tf, c, x0)
+        # Runs are shortened until the measurement model at their end, where the altitude or the
+        # atmosphere may have changed, still agrees with the linearization and the gain
+        n = len(x)
+        while n > 0:
+            h1, H1 = filter._pressure_model(pressure_events[start + n - 1][0], x[n - 1])
+            if abs(h1 - h - H.dot(x[n - 1] - x0)) <= STEADY_MODEL_TOLERANCE*sqrt(R) and \
+                    self._jacobian_matches(H, H1):
+                break
+            n //= 2
+        # Shortened runs limit the length of the following ones, which grows back otherwise
+        if n < len(x):
+            self._span = max(2*n, self._min_run)
+        elif self._span is not None:
+            self._span *= 2
+        if n < self._min_run:
+            self._hold = self._min_run
+            return 0
+
+        profiling.count('kalman.steady', n)
+        P = P.matrix()
+        variance = np.empty(n)
+        AT = A.T
+        for i in range(n):
+            P = A.dot(P).dot(AT) + W
+            variance[i] = P[0, 0]
+        filter._steady_advance(pressure_events[start + n - 1][0], x[:n], variance, P)
+        return n
+
+    def _jacobian_matches(self, H0, H1):
+        return np.abs(H1 - H0).max() <= STEADY_JACOBIAN_TOLERANCE*np.abs(H0).max()
+
 
 class SmootherBase:
 
@@ -53,6 +469,7 @@ class SmootherBase:
     def on_pressure(self, time, pressure, backward):
         pass
 
+    @profiling.method_span('execute')
     def execute(self, gps_events, pressure_events):
         # Forward events traversal
         ia, ip = 0, 0
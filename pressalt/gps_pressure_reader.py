@@ -15,28 +15,41 @@
 #   limitations under the License.
 
 from .record_readers import *
-import matplotlib.mlab as ml
+from . import profiling
+from .atmosphere import PRESSURE_EXPONENT, PRESSURE_FACTOR, make_atmosphere
+from .resampling import Resampler
+from .route_alignment import ALIGNMENT_RADIUS, align_points
+from .smoothing import dpss_window, smooth, swt_window
+from collections import OrderedDict
+import hashlib
 import numpy as np
-import scipy.signal as signal
-import scipy.spatial
-import scipy.optimize
-import scipy.interpolate
-import pyproj
-import pywt
-from simplekml import Kml
+import warnings
 from math import *
 
+# Heavy optional dependencies are imported by the methods using them, so reading recordings
+# doesn't pay for scipy, pyproj or pywt.
+
 
 class GpsPressureReader(RecordReader):
 
-    PRESSURE_EXPONENT = 5.25588
-    PRESSURE_FACTOR = 0.0000225577
+    PRESSURE_EXPONENT = PRESSURE_EXPONENT
+    PRESSURE_FACTOR = PRESSURE_FACTOR
+
+    # Number of track trees kept by track_tree
+    TRACK_TREE_CACHE_SIZE = 8
 
-    def __init__(self):
+    def __init__(self, atmosphere=None):
+        # Pressure altitudes follow the atmosphere model, the standard one by default. Models
+        # using the temperature take the temperature events of an earlier read of the recording.
         RecordReader.__init__(self)
+        self._atmosphere = make_atmosphere(atmosphere)
 
         self.gps_events = list()
         self.press_events = list()
+        self.accel_events = list()
+        self.gyro_events = list()
+        self.magn_events = list()
+        self.temp_events = list()
 
         self._gps_time = list()
         self._gps_bearing = list()
@@ -57,9 +70,11 @@ class GpsPressureReader(RecordReader):
 
         self._proj_src = None
         self._proj_dst = None
+        self._gps_tree = None
+        self._track_trees = OrderedDict()
 
     def on_start(self, time, start_time, version):
-        self.__init__()
+        self.__init__(self._atmosphere)
 
     def on_gps(self, millisecond, latitude, longitude, altitude_geoid, bearing, speed, accuracy,
                time):
@@ -79,9 +94,21 @@ class GpsPressureReader(RecordReader):
         self._press_time.append(millisecond)
         self._press_pressure.append(pressure)
 
-        ap = self._find_altitude_pressure(pressure)
+        ap = self._find_altitude_pressure(millisecond, pressure)
         self._press_altitude.append(ap if ap else np.NaN)
 
+    def on_accel(self, millisecond, ax, ay, az):
+        self.accel_events.append((millisecond, ax, ay, az))
+
+    def on_gyro(self, millisecond, avx, avy, avz):
+        self.gyro_events.append((millisecond, avx, avy, avz))
+
+    def on_magn(self, millisecond, mx, my, mz):
+        self.magn_events.append((millisecond, mx, my, mz))
+
+    def on_temp(self, millisecond, temp):
+        self.temp_events.append((millisecond, temp))
+
     def gps_distance(self):
         if self._gps_distance is None:
             gps_points = self.gps_points()
@@ -138,9 +165,8 @@ class GpsPressureReader(RecordReader):
 
     def press_distance(self):
         if self._press_distance is None:
-            f = scipy.interpolate.interp1d(self.gps_time(), self.gps_distance(),
-                                           bounds_error=False)
-            self._press_distance = f(self.press_time())
+            self._press_distance = Resampler(self.press_time()).resample(self.gps_time(),
+                                                                         self.gps_distance())
         return self._press_distance
 
     def translated_position_test(self):
@@ -152,41 +178,91 @@ class GpsPressureReader(RecordReader):
 
     @staticmethod
     def project_coordinates(coords, proj_src=None, proj_dst=None):
+        import pyproj
+        coords = np.asarray(coords, dtype=float).reshape(-1, 2)
         if not proj_src:
-            proj_src = pyproj.Proj('+init=EPSG:4326')
+            proj_src = pyproj.Proj(proj='latlong', datum='WGS84')
         if not proj_dst:
             lat_0 = np.mean(coords[:, 0])
             lon_0 = np.mean(coords[:, 1])
             proj_dst = pyproj.Proj('+proj=aeqd +lat_0=%.8f +lon_0=%.8f' % (lat_0, lon_0))
-        points = [pyproj.transform(proj_src, proj_dst, lon, lat) for (lat, lon) in coords]
-        return np.array(points), proj_src, proj_dst
-
-    def match_points(self, coords, cutoff):
-        gps_points = self.gps_points()
-        points, _, _ = self.project_coordinates(coords, self._proj_src, self._proj_dst)
-        tree = scipy.spatial.cKDTree(points)
-        dist = list()
-        ind = list()
-        for p in gps_points:
-            (d, i) = tree.query(p, distance_upper_bound=cutoff)
-            dist.append(d)
-            ind.append(i)
-
-        ind = np.array(ind)
-        return ind, ml.find(ind == coords.shape[0]), np.array(dist)
+        with profiling.span('project_coordinates'):
+            # Whole arrays are transformed at once, pyproj older than 2.1 lacks the Transformer
+            if hasattr(pyproj, 'Transformer'):
+                transform = pyproj.Transformer.from_proj(proj_src, proj_dst, always_xy=True)
+                x, y = transform.transform(coords[:, 1], coords[:, 0])
+            else:
+                x, y = pyproj.transform(proj_src, proj_dst, coords[:, 1], coords[:, 0])
+        return np.column_stack((x, y)), proj_src, proj_dst
+
+    def gps_tree(self):
+        if self._gps_tree is None:
+            import scipy.spatial
+            self._gps_tree = scipy.spatial.cKDTree(self.gps_points())
+        return self._gps_tree
+
+    def track_tree(self, coords):
+        # Tree of a track projected as the GPS points of this reader. Trees of the recently used
+        # coordinates are cached, so aligning a ride again skips the projection and the
+        # construction.
+        import scipy.spatial
+        coords = np.ascontiguousarray(coords, dtype=float)
+        key = (coords.shape, hashlib.sha1(coords.tobytes()).hexdigest())
+        trees = self._track_trees
+        tree = trees.get(key)
+        if tree is None:
+            self.gps_points()
+            points, _, _ = self.project_coordinates(coords, self._proj_src, self._proj_dst)
+            tree = trees[key] = scipy.spatial.cKDTree(points)
+            if len(trees) > self.TRACK_TREE_CACHE_SIZE:
+                trees.popitem(last=False)
+        else:
+            trees.move_to_end(key)
+        return tree
+
+    def match_points(self, coords, cutoff, bidirectional=False):
+        # Nearest points of the track coords for the GPS points of this reader, with the length
+        # of coords as the index of points having none within the cutoff. Bidirectional matching
+        # keeps only pairs of points nearest to each other.
+        with profiling.span('match_points'):
+            tree = self.track_tree(coords)
+            n = tree.n
+            dist, ind = tree.query(self.gps_points(), distance_upper_bound=cutoff, workers=-1)
+            if bidirectional:
+                _, back = self.gps_tree().query(tree.data, workers=-1)
+                matched = np.flatnonzero(ind < n)
+                lost = matched[back[ind[matched]] != matched]
+                ind[lost] = n
+                dist[lost] = np.inf
+        return ind, np.flatnonzero(ind == n), dist
+
+    def align_points(self, coords, cutoff, radius=ALIGNMENT_RADIUS):
+        # Index map of the track coords to the GPS points of this reader in the format of
+        # match_points, following both routes in order with dynamic time warping
+        points = self.track_tree(coords).data
+        return align_points(self.gps_points(), points, radius, cutoff)
+
+    def offset_statistics(self, i, iw, a0, a1):
+        # Mean offset, mean squared offset and variance of the offsets a0 - a1[i] of the matched
+        # points, all from a single array of the differences
+        matched = np.ones(len(i), dtype=bool)
+        matched[iw] = False
+        d = a0[matched] - a1[i[matched]]
+        m = np.mean(d)
+        r = d - m
+        return m, np.dot(d, d) / len(d), np.dot(r, r) / len(d)
 
     def mean_offset(self, i, iw, a0, a1):
-        return np.mean(np.delete(a0 - a1[i], iw))
+        return self.offset_statistics(i, iw, a0, a1)[0]
 
     def mean_offset2(self, i, iw, a0, a1):
-        return np.mean(np.delete(a0 - a1[i], iw)**2)
+        return self.offset_statistics(i, iw, a0, a1)[1]
 
     def mean_sd(self, i, iw, a0, a1):
         return sqrt(self.mean_sd2(i, iw, a0, a1))
 
     def mean_sd2(self, i, iw, a0, a1):
-        m = self.mean_offset(i, iw, a0, a1)
-        return np.mean(np.delete(a0 - a1[i] + m, iw)**2)
+        return self.offset_statistics(i, iw, a0, a1)[2]
 
     def statistics(self, a):
         a_min = a[0]
@@ -209,27 +285,19 @@ class GpsPressureReader(RecordReader):
         return a_min, a_max, a_gain, a_loss, a[-1]-a[0]
 
     def smooth(self, a, filter_n=51, width=0.5):
-        W = signal.slepian(filter_n, width=width)
-        W = W/np.sum(W)
-        s = signal.convolve(a, W, mode='valid')
-        return np.hstack([[s[0]]*(filter_n//2), s, [s[-1]]*(filter_n//2)])
-
-    def smooth_wavelet(self, data, levels=8, w='sym4', mode=pywt.MODES.sp1):
-        w = pywt.Wavelet(w)
-        a = data
+        return smooth(a, dpss_window(filter_n, width))
 
-        for i in range(levels):
-            (a, d) = pywt.dwt(a, w, mode)
-
-        coeff_list = [a, None] + [None] * (levels-1)
-        rec = pywt.waverec(coeff_list, w)
-
-        if len(data) == len(rec):
-            return rec
-        else:
-            return rec[1:len(data)-len(rec)+1]
+    def smooth_wavelet(self, data, levels=8, w='sym4', mode=None):
+        # Approximation of the stationary wavelet transform at the level, the same length as
+        # the data; StreamingSmoother(swt_window(w, levels)) gives it for data in chunks. The
+        # ends use the part of the kernel inside the data, so the boundary mode is not used.
+        if mode is not None:
+            warnings.warn('The mode argument of smooth_wavelet is ignored and will be removed',
+                          DeprecationWarning, stacklevel=2)
+        return smooth(data, swt_window(w, levels))
 
     def export_to_kml(self, file_name):
+        from simplekml import Kml
         coords = list()
         for i in range(len(self._gps_latitude)):
             coords.append((self._gps_longitude[i], self._gps_latitude[i]))
@@ -240,14 +308,13 @@ class GpsPressureReader(RecordReader):
         lin.style.linestyle.width = 2           # 10 pixels
         kml.save(file_name)
 
-    def _find_altitude_pressure(self, pressure):
+    def _find_altitude_pressure(self, millisecond, pressure):
+        self._atmosphere.update(millisecond)
         if not self._pressure_msl:
             if self._last_altitude:
-                self._pressure_msl = pressure/pow(1.0 - self.PRESSURE_FACTOR * self._last_altitude,
-                                                  self.PRESSURE_EXPONENT)
+                self._pressure_msl = self._atmosphere.pressure_msl(pressure, self._last_altitude)
                 return self._last_altitude
             else:
                 return None
         else:
-            e = pow(pressure/self._pressure_msl, 1.0/self.PRESSURE_EXPONENT)
-            return (1.0 - e)/self.PRESSURE_FACTOR
+            return self._atmosphere.altitude(pressure, self._pressure_msl)
@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+#
+#  (C) Copyright 2013, 2016 Wojciech Mruczkiewicz
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from .record_readers import *
+from . import profiling
+import numpy as np
+
+# User equivalent range error in metres, the vertical standard deviation of a fix is VDOP times it
+NMEA_UERE = 5.0
+
+# Sentences of one fix are reported within this delay in milliseconds
+NMEA_EPOCH_DELAY = 50
+
+KNOT = 1852.0 / 3600.0
+
+NMEA_GGA_DTYPE = np.dtype([('time', 'i8'), ('utc', 'f8'), ('latitude', 'f8'),
+                           ('longitude', 'f8'), ('quality', 'i1'), ('satellites', 'i2'),
+                           ('hdop', 'f4'), ('altitude', 'f8'), ('geoid_separation', 'f4')])
+NMEA_GSA_DTYPE = np.dtype([('time', 'i8'), ('fix', 'i1'), ('pdop', 'f4'), ('hdop', 'f4'),
+                           ('vdop', 'f4')])
+NMEA_RMC_DTYPE = np.dtype([('time', 'i8'), ('utc', 'f8'), ('valid', '?'), ('latitude', 'f8'),
+                           ('longitude', 'f8'), ('speed', 'f4'), ('course', 'f4'),
+                           ('date', 'i4')])
+NMEA_FIX_DTYPE = np.dtype(NMEA_GGA_DTYPE.descr + [('pdop', 'f4'), ('vdop', 'f4')])
+
+
+def _float_column(values):
+    # Floating point column of the field values, NaN for the empty or malformed ones
+    a = np.array(values, dtype=bytes)
+    out = np.full(len(a), np.nan)
+    present = a != b''
+    try:
+        out[present] = a[present].astype(float)
+    except ValueError:
+        for i in np.flatnonzero(present):
+            try:
+                out[i] = float(a[i])
+            except ValueError:
+                pass
+    return out
+
+
+def _int_column(values, missing=0):
+    out = _float_column(values)
+    return np.where(np.isfinite(out), out, missing).astype(int)
+
+
+def _utc_column(values):
+    # Seconds of the day of hhmmss.ss times
+    t = _float_column(values)
+    hours, rest = np.divmod(t, 10000.0)
+    minutes, seconds = np.divmod(rest, 100.0)
+    return hours*3600.0 + minutes*60.0 + seconds
+
+
+def _angle_column(values, hemispheres, negative):
+    # Degrees of the (d)ddmm.mmmm angles, negative on the southern or western hemisphere
+    v = _float_column(values)
+    degrees, minutes = np.divmod(v, 100.0)
+    angle = degrees + minutes/60.0
+    return np.where(np.array(hemispheres, dtype=bytes) == negative, -angle, angle)
+
+
+def _parse_gga(time, fields, count):
+    out = np.zeros(len(time), dtype=NMEA_GGA_DTYPE)
+    out['time'] = time
+    out['utc'] = _utc_column(fields[0::count])
+    out['latitude'] = _angle_column(fields[1::count], fields[2::count], b'S')
+    out['longitude'] = _angle_column(fields[3::count], fields[4::count], b'W')
+    out['quality'] = _int_column(fields[5::count])
+    out['satellites'] = _int_column(fields[6::count])
+    out['hdop'] = _float_column(fields[7::count])
+    out['altitude'] = _float_column(fields[8::count])
+    out['geoid_separation'] = _float_column(fields[10::count])
+    return out
+
+
+def _parse_gsa(time, fields, count):
+    out = np.zeros(len(time), dtype=NMEA_GSA_DTYPE)
+    out['time'] = time
+    out['fix'] = _int_column(fields[1::count], 1)
+    out['pdop'] = _float_column(fields[14::count])
+    out['hdop'] = _float_column(fields[15::count])
+    out['vdop'] = _float_column(fields[16::count])
+    return out
+
+
+def _parse_rmc(time, fields, count):
+    out = np.zeros(len(time), dtype=NMEA_RMC_DTYPE)
+    out['time'] = time
+    out['utc'] = _utc_column(fields[0::count])
+    out['valid'] = np.array(fields[1::count], dtype=bytes) == b'A'
+    out['latitude'] = _angle_column(fields[2::count], fields[3::count], b'S')
+    out['longitude'] = _angle_column(fields[4::count], fields[5::count], b'W')
+    out['speed'] = _float_column(fields[6::count]) * KNOT
+    out['course'] = _float_column(fields[7::count])
+    out['date'] = _int_column(fields[8::count])
+    return out
+
+
+# Parsers of the sentence types, with the dtype and the least number of fields they need
+NMEA_SENTENCES = {'GGA': (NMEA_GGA_DTYPE, 11, _parse_gga),
+                  'GSA': (NMEA_GSA_DTYPE, 17, _parse_gsa),
+                  'RMC': (NMEA_RMC_DTYPE, 9, _parse_rmc)}
+
+_HEX = np.full(256, -1, dtype=int)
+_HEX[np.frombuffer(b'0123456789ABCDEF', dtype=np.uint8)] = np.arange(16)
+_HEX[np.frombuffer(b'abcdef', dtype=np.uint8)] = np.arange(10, 16)
+
+
+def _sentence_code(kind):
+    return int.from_bytes(kind.encode() if isinstance(kind, str) else kind, 'big')
+
+
+def nmea_checksum(sentence):
+    # Checksum of a sentence, the exclusive or of the characters between $ and *
+    if isinstance(sentence, str):
+        sentence = sentence.encode()
+    body = sentence[1:sentence.rindex(b'*')] if b'*' in sentence else sentence[1:]
+    return int(np.bitwise_xor.reduce(np.frombuffer(body, dtype=np.uint8), initial=0))
+
+
+def parse_nmea(time, sentences):
+    # Parses sentences received at the times in milliseconds into a structured array for every
+    # type of NMEA_SENTENCES, in the order received. Sentences with a bad checksum, the other
+    # types and the ones with fewer fields than needed are skipped. Returns the arrays by type and
+    # the number of sentences failing the checksum.
+    #
+    # All sentences are joined into one buffer: the checksums, types and field counts are computed
+    # on it at once and the fields of every type are split from a single joined string, so that
+    # the work per sentence in Python is a slice.
+    with profiling.span('parse_nmea'):
+        time = np.asarray(time, dtype=np.int64)
+        result = {kind: np.zeros(0, dtype=dtype) for kind, (dtype, _, _) in NMEA_SENTENCES.items()}
+        if len(sentences) == 0:
+            return result, 0
+        try:
+            joined = b'\n'.join(sentences)
+        except TypeError:
+            sentences = [s.encode() if isinstance(s, str) else s for s in sentences]
+            joined = b'\n'.join(sentences)
+        buf = np.frombuffer(joined, dtype=np.uint8)
+        length = np.fromiter(map(len, sentences), dtype=np.int64, count=len(sentences))
+        start = np.concatenate(([0], np.cumsum(length + 1)[:-1]))
+        end = start + length
+
+        # Last * of every sentence
+        stars = np.flatnonzero(buf == ord('*'))
+        owner = np.searchsorted(start, stars, 'right') - 1
+        last = np.r_[owner[1:] != owner[:-1], True] if len(stars) > 0 else stars.astype(bool)
+        star = np.full(len(sentences), -1, dtype=np.int64)
+        star[owner[last]] = stars[last]
+
+        framed = (length > 7) & (star > start + 6) & (star + 2 < end)
+        framed[framed] = buf[start[framed]] == ord('$')
+        index = np.flatnonzero(framed)
+        bounds = np.column_stack((start[index] + 1, star[index])).ravel()
+        checksum = np.bitwise_xor.reduceat(buf, bounds)[0::2]
+        expected = _HEX[buf[star[index] + 1]] * 16 + _HEX[buf[star[index] + 2]]
+        valid = checksum == expected
+        invalid = int(len(sentences) - np.count_nonzero(valid))
+        index = index[valid]
+
+        # Sentence type after the two characters of the talker and field counts
+        s = start[index]
+        code = (buf[s + 3].astype(np.int64) << 16) | (buf[s + 4].astype(np.int64) << 8) | buf[s + 5]
+        bounds = np.column_stack((s + 6, star[index])).ravel()
+        fields = np.add.reduceat(buf == ord(','), bounds, dtype=np.int64)[0::2]
+        for kind, (dtype, needed, parser) in NMEA_SENTENCES.items():
+            mask = (code == _sentence_code(kind)) & (fields >= needed) & (buf[s + 6] == ord(','))
+            selected, counts = index[mask], fields[mask]
+            parts = list()
+            for count in np.unique(counts):
+                group = selected[counts == count]
+                body = b','.join([joined[a:b] for a, b in zip(start[group] + 7, star[group])])
+                parts.append((group, parser(time[group], body.split(b','), count)))
+            if parts:
+                order = np.argsort(np.concatenate([g for g, _ in parts]), kind='stable')
+                result[kind] = np.concatenate([p for _, p in parts])[order]
+        return result, invalid
+
+
+class NmeaReader(RecordReader):
+    # Collects the NMEA sentences of a recording and parses them in bulk on the first access.
+    # Fixes are the GGA sentences with the dilutions of precision of the nearest GSA sentence.
+
+    def __init__(self):
+        RecordReader.__init__(self)
+        self._time = list()
+        self._sentences = list()
+        self._parsed = None
+        self._invalid = 0
+
+    def on_start(self, time, start_time, version):
+        self.__init__()
+
+    def on_nmea(self, millisecond, timestamp, nmea):
+        self.update_time(millisecond)
+        self._time.append(millisecond)
+        self._sentences.append(nmea)
+        self._parsed = None
+
+    def _parse(self):
+        if self._parsed is None:
+            self._parsed, self._invalid = parse_nmea(self._time, self._sentences)
+        return self._parsed
+
+    def sentence_count(self):
+        return len(self._sentences)
+
+    def invalid_count(self):
+        self._parse()
+        return self._invalid
+
+    def sentences(self, kind):
+        return np.array(self._parse()[kind])
+
+    def fixes(self, max_delay=NMEA_EPOCH_DELAY):
+        parsed = self._parse()
+        gga, gsa = parsed['GGA'], parsed['GSA']
+        out = np.zeros(len(gga), dtype=NMEA_FIX_DTYPE)
+        for name in NMEA_GGA_DTYPE.names:
+            out[name] = gga[name]
+        out['pdop'] = out['vdop'] = np.nan
+        if len(gsa) > 0 and len(gga) > 0:
+            # Nearest GSA in time, GSA times are sorted as received
+            order = np.argsort(gsa['time'], kind='stable')
+            t = gsa['time'][order]
+            i = np.clip(np.searchsorted(t, gga['time']), 1, len(t)) - 1
+            j = np.minimum(i + 1, len(t) - 1)
+            nearest = np.where(np.abs(t[j] - gga['time']) < np.abs(t[i] - gga['time']), j, i)
+            close = np.abs(t[nearest] - gga['time']) <= max_delay
+            matched = gsa[order[nearest[close]]]
+            out['pdop'][close] = matched['pdop']
+            out['vdop'][close] = matched['vdop']
+        return out
+
+    def gps_events(self, uere=NMEA_UERE, max_delay=NMEA_EPOCH_DELAY):
+        # Events of the filters from the fixes: time, altitude above the geoid and the vertical
+        # standard deviation VDOP times the range error, HDOP times it without a GSA sentence. The
+        # filters use accuracy^2 gps_var_factor as the variance, so gps_var_factor is 1 for these.
+        f = self.fixes(max_delay)
+        dop = np.where(np.isfinite(f['vdop']), f['vdop'], f['hdop']).astype(float)
+        valid = (f['quality'] > 0) & np.isfinite(f['altitude']) & (dop > 0.0)
+        return list(zip(f['time'][valid].tolist(), f['altitude'][valid].tolist(),
+                        (dop[valid] * uere).tolist()))
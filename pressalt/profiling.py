@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+#
+#  (C) Copyright 2013, 2016 Wojciech Mruczkiewicz
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from collections import Counter
+import functools
+import json
+import os
+import sys
+import threading
+import time
+
+# Active profiler, instrumented code checks it before doing any work
+_profiler = None
+
+
+class _NullSpan:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+
+    def __init__(self, profiler, name):
+        self._profiler = profiler
+        self._name = name
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._profiler.spans.append((self._name, self._start, time.perf_counter(),
+                                     threading.get_ident()))
+        return False
+
+
+class Profiler:
+    # Collects timed spans and event counters of a run. Spans nest, so the breakdown reports the
+    # total time of every stage including the stages it contains.
+
+    def __init__(self):
+        self.spans = list()
+        self.counters = Counter()
+        self._start = time.perf_counter()
+
+    def span(self, name):
+        return _Span(self, name)
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def stages(self):
+        stages = dict()
+        for name, start, end, _ in self.spans:
+            calls, total = stages.get(name, (0, 0.0))
+            stages[name] = (calls + 1, total + end - start)
+        return stages
+
+    def report(self, file=sys.stderr):
+        wall = time.perf_counter() - self._start
+        stages = self.stages()
+        print('%-40s %8s %10s %7s' % ('stage', 'calls', 'seconds', '%'), file=file)
+        for name in sorted(stages, key=lambda n: -stages[n][1]):
+            calls, total = stages[name]
+            print('%-40s %8d %10.4f %7.1f' % (name, calls, total, 100.0*total/wall), file=file)
+        if self.counters:
+            print('%-40s %8s' % ('counter', 'count'), file=file)
+            for name in sorted(self.counters):
+                print('%-40s %8d' % (name, self.counters[name]), file=file)
+
+    def write_trace(self, file_name):
+        # Chrome trace event format, viewable in chrome://tracing or Perfetto
+        pid = os.getpid()
+        events = [{'name': name, 'ph': 'X', 'pid': pid, 'tid': tid,
+                   'ts': (start - self._start)*1e6, 'dur': (end - start)*1e6}
+                  for name, start, end, tid in self.spans]
+        if self.counters:
+            events.append({'name': 'counters', 'ph': 'C', 'pid': pid, 'tid': 0,
+                           'ts': (time.perf_counter() - self._start)*1e6,
+                           'args': dict(self.counters)})
+        with open(file_name, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+def enable(profiler=None):
+    global _profiler
+    _profiler = profiler if profiler is not None else Profiler()
+    return _profiler
+
+
+def disable():
+    global _profiler
+    profiler, _profiler = _profiler, None
+    return profiler
+
+
+def active():
+    return _profiler
+
+
+def span(name):
+    if _profiler is None:
+        return _NULL_SPAN
+    return _profiler.span(name)
+
+
+def count(name, n=1):
+    if _profiler is not None:
+        _profiler.counters[name] += n
+
+
+def method_span(name):
+    # Decorator of a method run in the span name.<class of the instance>
+    def decorate(method):
+        @functools.wraps(method)
+        def spanned(self, *args, **kwargs):
+            if _profiler is None:
+                return method(self, *args, **kwargs)
+            with _profiler.span(name + '.' + type(self).__name__):
+                return method(self, *args, **kwargs)
+        return spanned
+    return decorate
+
+
+class _CountingReader:
+    # Forwards the callbacks of the decoders to a reader and counts them per frame type
+
+    def __init__(self, reader, counters):
+        self._reader = reader
+        self._counters = counters
+
+    def __getattr__(self, name):
+        attribute = getattr(self._reader, name)
+        if not name.startswith('on_'):
+            return attribute
+        counters = self._counters
+        if name in ('on_sensor', 'on_sensor_accuracy'):
+            key = 'decoded.' + name[3:] + '_%d'
+
+            def counted(type, *args):
+                counters[key % type] += 1
+                return attribute(type, *args)
+        else:
+            key = 'decoded.' + name[3:]
+
+            def counted(*args):
+                counters[key] += 1
+                return attribute(*args)
+        setattr(self, name, counted)
+        return counted
+
+
+def counting_reader(reader):
+    if _profiler is None:
+        return reader
+    return _CountingReader(reader, _profiler.counters)
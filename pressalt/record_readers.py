@@ -15,10 +15,13 @@
 #   limitations under the License.
 
 import codecs
+import mmap
 import struct
 import uuid
 import sys
 
+from . import profiling
+
 
 class RecordReaderError(Exception):
 
@@ -62,11 +65,27 @@ class RecordReader:
         # TODO: Support the remaining sensors
         if type == 6:
             self.on_pressure(time, values[0])
+        elif type == 1 and len(values) >= 3:
+            self.on_accel(time, values[0], values[1], values[2])
+        elif type == 4 and len(values) >= 3:
+            self.on_gyro(time, values[0], values[1], values[2])
+        elif type == 2 and len(values) >= 3:
+            self.on_magn(time, values[0], values[1], values[2])
+        elif type == 13:
+            self.on_temp(time, values[0])
             
     def on_sensor_accuracy(self, type, device, time, accuracy, resolution, maximum):
         # TODO: Support the remaining sensors accuracies
         if type == 6:
             self.on_pressure_accuracy(time, accuracy, resolution, maximum)
+        elif type == 1:
+            self.on_accel_accuracy(time, accuracy, resolution, maximum)
+        elif type == 4:
+            self.on_gyro_accuracy(time, accuracy, resolution, maximum)
+        elif type == 2:
+            self.on_magn_accuracy(time, accuracy, resolution, maximum)
+        elif type == 13:
+            self.on_temp_accuracy(time, accuracy, resolution, maximum)
             
     def on_start(self, time, start_time, version):
         pass
@@ -135,6 +154,9 @@ class RecordReader:
     def on_ble(self, device, millisecond, ble_uuid, value):
         pass
 
+    def on_corrupted(self, start, end):
+        pass
+
 
 class RecordToText(RecordReader):
     
@@ -285,6 +307,16 @@ class RecordNmeaToText(RecordReader):
         print("nmea\t%d\t%d\t%s" % (millisecond, timestamp, nmea), file=self.file)
         
 
+def __read_bytes(f, length):
+    # Variable length field of a frame, the length is checked as in the version 12 frames
+    if length < 0 or length > V12_MAX_LENGTH:
+        raise RecordReaderError('Binary data corruption (length=%d)' % length)
+    data = f.read(length)
+    if len(data) != length:
+        raise RecordReaderError('Binary data truncated')
+    return data
+
+
 def __read_binary_v10(millisecond, data_type, f, reader):
     if data_type == 1:
         (latitude, longitude, altitude_geoid, bearing, speed, accuracy, time)\
@@ -344,8 +376,8 @@ def __read_binary_v10(millisecond, data_type, f, reader):
         reader.on_battery(millisecond, pct, voltage, temp)
     elif data_type == 19:
         length, = struct.unpack('!i', f.read(4))
-        nmea = f.read(length)[:-1]
-        reader.on_nmea(millisecond, nmea)
+        nmea = __read_bytes(f, length)[:-1]
+        reader.on_nmea(millisecond, 0, nmea)
     else:
         raise RecordReaderError('Binary data corruption (dt=%d)' % data_type)
 
@@ -408,7 +440,7 @@ def __read_binary_v11(ms, data_type, f, reader):
         reader.on_battery(ms, pct, voltage, temp)
     elif data_type == 19:
         (ts, length) = struct.unpack('!qi', f.read(12))
-        nmea = f.read(length)[:-1]
+        nmea = __read_bytes(f, length)[:-1]
         reader.on_nmea(ms, 0, nmea)
     else:
         raise RecordReaderError('Binary data corruption (dt=%d)' % data_type)
@@ -453,12 +485,114 @@ def __read_binary_v12(type, device, version, f, reader):
             reader.on_sensor(type, device, time, timestamp, values)
     else:
         raise RecordReaderError('Binary data corruption (type=%d)' % type)
+    return time
+
+
+# Limits of a plausible version 12 frame, used when resynchronizing a corrupted stream.
+V12_MAX_DEVICE = 255
+V12_MAX_VALUES = 64
+V12_MAX_LENGTH = 65536
+V12_TIME_BACKWARD = 600000
+V12_TIME_FORWARD = 86400000
+
+__header_v12 = struct.Struct('!hh')
+__length_v12 = struct.Struct('!i')
+__values_v12 = struct.Struct('!h')
+__time_v12 = struct.Struct('!q')
+
+
+def __frame_v12(data, pos, version):
+    # Returns the size and the time of a frame starting at pos or (None, None) when the frame
+    # header is not valid or the frame does not fit in the data.
+    end = len(data)
+    if pos + 12 > end:
+        return None, None
+    type, device = __header_v12.unpack_from(data, pos)
+    if device < 0 or device > V12_MAX_DEVICE:
+        return None, None
+    time_offset = 4
+    if type == -7:
+        if pos + 24 > end:
+            return None, None
+        length, = __length_v12.unpack_from(data, pos + 20)
+        if length < 0 or length > V12_MAX_LENGTH:
+            return None, None
+        size = 24 + length
+    elif type == -6:
+        size = 56
+    elif type == -5:
+        size = 24
+    elif type == -8:
+        if pos + 32 > end:
+            return None, None
+        length, = __length_v12.unpack_from(data, pos + 28)
+        if length < 0 or length > V12_MAX_LENGTH:
+            return None, None
+        size = 32 + length
+    elif type == -3:
+        magic_word = b'SensorsRecord'
+        if pos + 21 > end or struct.unpack_from('!i%ds' % len(magic_word), data, pos + 4)\
+                != (len(magic_word), magic_word):
+            return None, None
+        size = 52 + len(magic_word)
+        time_offset = 25
+    elif type > 0:
+        if type % 2 == 1:
+            size = 24 if version >= 1300 else 16
+        else:
+            if pos + 22 > end:
+                return None, None
+            length, = __values_v12.unpack_from(data, pos + 20)
+            if length < 0 or length > V12_MAX_VALUES:
+                return None, None
+            size = 22 + 4 * length
+    else:
+        return None, None
+    if pos + size > end:
+        return None, None
+    time, = __time_v12.unpack_from(data, pos + time_offset)
+    return size, time
+
+
+def __time_plausible(time, last_time):
+    return last_time - V12_TIME_BACKWARD <= time <= last_time + V12_TIME_FORWARD
+
+
+def __resync_v12(data, pos, version, last_time):
+    # Frame times are close to the last valid one, so candidates are located by searching for
+    # the high bytes of the time. A candidate is accepted only when it is followed by another
+    # valid frame or by the end of data.
+    prefixes = {struct.pack('!q', last_time - V12_TIME_BACKWARD)[:4],
+                struct.pack('!q', last_time + V12_TIME_FORWARD)[:4]}
+    search = pos + 4
+    while True:
+        found = [i for i in (data.find(prefix, search) for prefix in prefixes) if i >= 0]
+        if not found:
+            return len(data)
+        index = min(found)
+        for candidate in (index - 4, index - 25):
+            if candidate < pos:
+                continue
+            size, time = __frame_v12(data, candidate, version)
+            if size is None or not __time_plausible(time, last_time):
+                continue
+            if candidate + size == len(data):
+                return candidate
+            next_size, next_time = __frame_v12(data, candidate + size, version)
+            if next_size is not None and __time_plausible(next_time, time):
+                return candidate
+        search = index + 1
 
 
-def read_binary(log_file, reader, legacy=False):
+def read_binary(log_file, reader, legacy=False, recover=True):
+    # Decoders call the reader through a counting proxy when profiling is enabled
+    result, reader = reader, profiling.counting_reader(reader)
 
-    def read_legacy(time, version, read_fun):
+    def read_legacy(time, version, read_fun, data_type=None):
         reader.on_start(time, 0, version)
+        if data_type is not None:
+            # Version 10 recordings have no header and start with the first frame
+            read_fun(time, data_type, f, reader)
         binary = f.read(10)
         while binary:
             data_type, time = struct.unpack('!hq', binary)
@@ -467,15 +601,41 @@ def read_binary(log_file, reader, legacy=False):
             
     def read_new(time, start_time, version, read_fun):
         reader.on_start(time, start_time, version)
-        binary = f.read(4)
-        while binary:
-            type, device = struct.unpack('!hh', binary)
-            read_fun(type, device, version, f, reader)
-            binary = f.read(4)
-        
+        # Every frame header is checked before the frame is decoded: its length is within the
+        # limits and fits in the file and its time is plausible after the last valid frame.
+        # Invalid frames raise without recovery and are skipped up to the next valid frame and
+        # reported through on_corrupted otherwise. Frames are located in a map of the file and
+        # decoded from the file itself.
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            last_time, pos = time, f.tell()
+            while pos < len(data):
+                size, frame_time = __frame_v12(data, pos, version)
+                valid = size is not None and __time_plausible(frame_time, last_time)
+                if valid:
+                    type, device = struct.unpack('!hh', f.read(4))
+                    try:
+                        read_fun(type, device, version, f, reader)
+                    except (RecordReaderError, struct.error, ValueError):
+                        if not recover:
+                            raise
+                        valid = False
+                if not valid:
+                    if not recover:
+                        raise RecordReaderError('Binary data corruption (position=%d)' % pos)
+                    start = pos
+                    pos = __resync_v12(data, pos + 1, version, last_time)
+                    reader.on_corrupted(start, pos)
+                    f.seek(pos)
+                    continue
+                last_time = frame_time
+                pos += size
+        finally:
+            data.close()
+
     magic_word = b'SensorsRecord'
     
-    with open(log_file, 'rb') as f:
+    with profiling.span('read_binary'), open(log_file, 'rb') as f:
         data_type, = struct.unpack('!h', f.read(2))
         if data_type == -1:
             # Check the validity of a starting frame.
@@ -494,10 +654,9 @@ def read_binary(log_file, reader, legacy=False):
             if data_type == 0:
                 time, version = struct.unpack('!qi', f.read(12))
             else:
-                time = struct.unpack('!q', f.read(8))
+                time, = struct.unpack('!q', f.read(8))
             if version == 1000:
-                __read_binary_v10(time, data_type, f, reader)
-                read_legacy(time, version, __read_binary_v10)
+                read_legacy(time, version, __read_binary_v10, data_type)
             elif version == 1100:
                 read_legacy(time, version, __read_binary_v11)
             else:
@@ -505,11 +664,12 @@ def read_binary(log_file, reader, legacy=False):
         else:
             raise RecordReaderError('Invalid binary file format')
 
-    return reader
+    return result
 
 
 def read_text(log_file, sensors_reader):
-    with open(log_file, 'r') as f:
+    result, sensors_reader = sensors_reader, profiling.counting_reader(sensors_reader)
+    with profiling.span('read_text'), open(log_file, 'r') as f:
         for line in f:
             values = line[:-1].split('\t')
             
@@ -558,4 +718,4 @@ def read_text(log_file, sensors_reader):
                     pass
             except ValueError:
                 pass
-    return sensors_reader
+    return result
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+#
+#  (C) Copyright 2013, 2016 Wojciech Mruczkiewicz
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import hashlib
+import numpy as np
+
+RESAMPLING_METHODS = ['linear', 'previous', 'nearest']
+
+# Grid points inside a gap longer than max_gap are NaN, hold the value before the gap or are
+# interpolated over it
+GAP_POLICIES = ['nan', 'hold', 'interpolate']
+
+
+def uniform_grid(start, end, step):
+    # Times from start to end, inclusive when end is on the grid
+    return start + step * np.arange(int(np.floor((end - start) / step + 1e-9)) + 1)
+
+
+def event_grid(*times):
+    # Sorted union of the event times of several streams
+    times = [np.asarray(t, dtype=float).ravel() for t in times]
+    return np.unique(np.concatenate(times)) if times else np.zeros(0)
+
+
+class IndexMap:
+    # Samples of a stream at the times of a grid: for every grid point the indices of the
+    # samples before and after it and the weight of the one after. Grid points outside of the
+    # stream are NaN. Streams with unsorted times are sorted, the indices refer to the original
+    # order.
+
+    def __init__(self, time, grid, method='linear', max_gap=None, gap_policy='nan'):
+        if method not in RESAMPLING_METHODS:
+            raise ValueError('Unknown resampling method: %s' % method)
+        if gap_policy not in GAP_POLICIES:
+            raise ValueError('Unknown gap policy: %s' % gap_policy)
+        time = np.asarray(time, dtype=float)
+        grid = np.asarray(grid, dtype=float)
+        order = None
+        if np.any(time[1:] < time[:-1]):
+            order = np.argsort(time, kind='stable')
+            time = time[order]
+        n = len(time)
+        if n == 0:
+            self._left = self._right = np.zeros(len(grid), dtype=int)
+            self._weight = np.zeros(len(grid))
+            self._valid = np.zeros(len(grid), dtype=bool)
+            return
+
+        # With duplicate times the last one is on the left, so the interval is never empty
+        left = np.searchsorted(time, grid, 'right') - 1
+        valid = (left >= 0) & (grid <= time[-1])
+        left = np.clip(left, 0, n - 1)
+        right = np.minimum(left + 1, n - 1)
+        dt = time[right] - time[left]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            weight = np.where(dt > 0.0, (grid - time[left]) / dt, 0.0)
+        weight[~valid] = 0.0
+
+        if max_gap is not None and gap_policy != 'interpolate':
+            gap = valid & (dt > max_gap) & (weight > 0.0)
+            if gap_policy == 'nan':
+                valid &= ~gap
+            weight[gap] = 0.0
+        if method == 'previous':
+            weight[:] = 0.0
+        elif method == 'nearest':
+            weight = np.where(weight >= 0.5, 1.0, 0.0)
+
+        if order is not None:
+            left, right = order[left], order[right]
+        self._left = left
+        self._right = right
+        self._weight = weight
+        self._valid = valid
+
+    def valid(self):
+        return np.array(self._valid)
+
+    def indices(self):
+        # Index of the sample nearer by weight to every grid point, -1 outside of the stream
+        return np.where(self._valid, np.where(self._weight >= 0.5, self._right, self._left), -1)
+
+    def apply(self, values):
+        # Values of the stream at the grid, along the first axis of values. NaN samples affect
+        # only the grid points having them with a non-zero weight.
+        values = np.asarray(values, dtype=float)
+        if len(values) == 0:
+            return np.full((len(self._left),) + values.shape[1:], np.nan)
+        out = values[self._left]
+        blend = np.flatnonzero(self._weight > 0.0)
+        w = self._weight[blend].reshape((-1,) + (1,) * (values.ndim - 1))
+        out[blend] += w * (values[self._right[blend]] - out[blend])
+        out[~self._valid] = np.nan
+        return out
+
+
+class Resampler:
+    # Aligns the columns of streams sampled on different clocks to a common grid. Index maps are
+    # cached by the stream times, so all the columns of a stream and the repeated calls for the
+    # same stream share one search of the grid.
+
+    def __init__(self, grid, method='linear', max_gap=None, gap_policy='nan'):
+        self._grid = np.asarray(grid, dtype=float)
+        self._method = method
+        self._max_gap = max_gap
+        self._gap_policy = gap_policy
+        self._maps = dict()
+
+    def grid(self):
+        return np.array(self._grid)
+
+    def index_map(self, time, method=None, max_gap=None, gap_policy=None):
+        method = self._method if method is None else method
+        max_gap = self._max_gap if max_gap is None else max_gap
+        gap_policy = self._gap_policy if gap_policy is None else gap_policy
+        time = np.ascontiguousarray(time, dtype=float)
+        key = (hashlib.sha1(time).hexdigest(), len(time), method, max_gap, gap_policy)
+        if key not in self._maps:
+            self._maps[key] = IndexMap(time, self._grid, method, max_gap, gap_policy)
+        return self._maps[key]
+
+    def resample(self, time, values, method=None, max_gap=None, gap_policy=None):
+        return self.index_map(time, method, max_gap, gap_policy).apply(values)
+
+    def resample_columns(self, columns, method=None, max_gap=None, gap_policy=None):
+        # Resampled columns of a dictionary of name: (time, values)
+        return {name: self.resample(time, values, method, max_gap, gap_policy)
+                for name, (time, values) in columns.items()}
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+#
+#  (C) Copyright 2013, 2016 Wojciech Mruczkiewicz
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from .export import filter_parameters
+from . import __version__, profiling
+import functools
+import hashlib
+import importlib
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+
+# Layout of the cached results, entries of other versions are never read
+RESULT_CACHE_VERSION = 1
+
+# Default bound of the cache size in bytes
+RESULT_CACHE_SIZE = 1 << 30
+
+# Filter results kept by the cache, the accessors of all filters read them from the attributes
+# with the underscore
+RESULT_ARRAYS = ('altitude', 'altitude_sd', 'altitude_gps', 'pressure_msl')
+
+# Modules every filter result depends on besides the module of the filter itself, the filter
+# base and atmosphere and the readers decoding the events of the recording
+_RESULT_MODULES = ('pressalt.filter_base', 'pressalt.atmosphere', 'pressalt.record_readers',
+                   'pressalt.gps_pressure_reader', 'pressalt.nmea')
+
+
+def file_digest(path, block_size=1 << 20):
+    # SHA-1 of the content of a file
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+@functools.lru_cache(maxsize=16)
+def code_digest(*modules):
+    # SHA-1 of the sources of the modules, so that results of a changed filter are not served
+    digest = hashlib.sha1()
+    for name in modules:
+        with open(importlib.import_module(name).__file__, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+class ResultCache:
+    # Content addressed store of the filter results on disk. The key is the digest of the
+    # recording, the filter class with its parameters, its covariance and atmosphere, the package
+    # version, the sources of the filter and reader modules and any other settings the results
+    # depend on. Every entry is a directory of .npy files which are served memory mapped and read
+    # only. Entries are evicted in the order of their last use when the cache grows over max_size
+    # bytes.
+
+    def __init__(self, directory, max_size=RESULT_CACHE_SIZE):
+        self._directory = directory
+        self._max_size = max_size
+        self._hits = 0
+        self._misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def hits(self):
+        return self._hits
+
+    def misses(self):
+        return self._misses
+
+    def key(self, recording, filter, **settings):
+        description = {'version': RESULT_CACHE_VERSION,
+                       'package': __version__,
+                       'recording': recording,
+                       'filter': type(filter).__name__,
+                       'parameters': filter_parameters(filter),
+                       'code': code_digest(type(filter).__module__, *_RESULT_MODULES),
+                       'settings': settings}
+        for name in ('atmosphere', 'P'):
+            if hasattr(filter, '_' + name):
+                description[name] = type(getattr(filter, '_' + name)).__name__
+        return hashlib.sha1(json.dumps(description, sort_keys=True, default=float)
+                            .encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self._directory, key)
+
+    def get(self, key):
+        # Arrays of the entry by name, None when not cached
+        path = self._path(key)
+        try:
+            arrays = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+                      for name in RESULT_ARRAYS}
+        except (OSError, ValueError):
+            self._misses += 1
+            return None
+        os.utime(path)
+        self._hits += 1
+        return arrays
+
+    def put(self, key, arrays):
+        # Entries are written into a temporary directory and renamed, so that concurrent
+        # processes never see a partial entry
+        path = self._path(key)
+        temporary = tempfile.mkdtemp(prefix='.' + key, dir=self._directory)
+        try:
+            for name in RESULT_ARRAYS:
+                np.save(os.path.join(temporary, name + '.npy'),
+                        np.asarray(arrays[name], dtype=float))
+            os.rename(temporary, path)
+        except OSError:
+            shutil.rmtree(temporary, ignore_errors=True)
+            if not os.path.isdir(path):
+                raise
+        self.evict()
+
+    def entries(self):
+        # Pairs of the key and the size in bytes of the entries, least recently used first
+        entries = list()
+        for entry in os.scandir(self._directory):
+            if entry.is_dir() and not entry.name.startswith('.'):
+                size = sum(f.stat().st_size for f in os.scandir(entry.path))
+                entries.append((entry.stat().st_mtime, entry.name, size))
+        return [(key, size) for _, key, size in sorted(entries)]
+
+    def size(self):
+        return sum(size for _, size in self.entries())
+
+    def evict(self, max_size=None):
+        # Removes the least recently used entries until the cache fits max_size. Arrays already
+        # mapped stay valid after their files are removed.
+        max_size = self._max_size if max_size is None else max_size
+        entries = self.entries()
+        total = sum(size for _, size in entries)
+        for key, size in entries:
+            if total <= max_size:
+                break
+            shutil.rmtree(self._path(key), ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        self.evict(0)
+
+    def execute(self, filter, recording, *events, **settings):
+        # Executes the filter on the events of the recording, given by its digest, unless its
+        # results are cached. Cached results are set to the filter, which serves them through
+        # its accessors; the other outputs of the filter are left empty. Returns whether the
+        # results were cached.
+        key = self.key(recording, filter, **settings)
+        with profiling.span('ResultCache.get'):
+            arrays = self.get(key)
+        if arrays is not None:
+            for name, values in arrays.items():
+                setattr(filter, '_' + name, values)
+            return True
+        filter.execute(*events)
+        with profiling.span('ResultCache.put'):
+            self.put(key, {name: getattr(filter, name)() for name in RESULT_ARRAYS})
+        return False
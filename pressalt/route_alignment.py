@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+#
+#  (C) Copyright 2013, 2016 Wojciech Mruczkiewicz
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from . import profiling
+import numpy as np
+
+ALIGNMENT_RADIUS = 200.0
+
+# Displacement in metres over the window of route_distance below which the points are taken as
+# stationary, above the jitter of a stationary GPS receiver
+ALIGNMENT_SPACING = 20.0
+# Points on each side of a step over which route_distance takes the displacement
+ALIGNMENT_WINDOW = 10
+
+
+def arc_length(points):
+    # Distance travelled along a polyline of projected points
+    d = np.hypot(*np.diff(points, axis=0).T)
+    return np.concatenate(([0.0], np.cumsum(d)))
+
+
+def route_distance(points, spacing=ALIGNMENT_SPACING, window=ALIGNMENT_WINDOW):
+    # Arc length of the polyline with the steps taken as the displacement over the window points
+    # around them, spread over the steps it spans, which averages out the jitter of the GPS. Steps
+    # whose displacement is below spacing metres are stops and don't add to the distance.
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    n = len(points)
+    if n < 2:
+        return np.zeros(n)
+    k = np.arange(n - 1)
+    first, last = np.maximum(k - window, 0), np.minimum(k + window + 1, n - 1)
+    displacement = np.hypot(*(points[last] - points[first]).T)
+    d = np.where(displacement >= spacing, displacement / (last - first), 0.0)
+    return np.concatenate(([0.0], np.cumsum(d)))
+
+
+def dtw_window(reference, points, radius=ALIGNMENT_RADIUS):
+    # Columns [lo, hi) of points allowed for every reference point. Both polylines are scaled to
+    # the same length and a point may be matched to the points within the radius in metres of
+    # the same relative distance along the route, so rides of different sampling rates and pauses
+    # stay on the band while an out and back route can't fold onto itself. The distances are
+    # taken by route_distance, since the jitter of the GPS while stopped would shift the rest of
+    # the ride off the band.
+    s = route_distance(reference)
+    t = route_distance(points)
+    if s[-1] > 0.0 and t[-1] > 0.0:
+        t = t * (s[-1] / t[-1])
+    else:
+        s = np.linspace(0.0, 1.0, len(reference))
+        t = np.linspace(0.0, 1.0, len(points))
+        radius = 1.0
+    lo = np.searchsorted(t, s - radius, 'left')
+    hi = np.searchsorted(t, s + radius, 'right')
+    # Every row overlaps the previous one, so that a path through the window exists
+    lo[0], hi[-1] = 0, len(points)
+    hi = np.maximum(hi, lo + 1)
+    lo = np.minimum(lo, np.concatenate(([0], hi[:-1])))
+    return lo, hi
+
+
+def dtw_path(reference, points, radius=ALIGNMENT_RADIUS):
+    # Dynamic time warping of two polylines with the distance of points as the cost, in the
+    # window of dtw_window. Returns the reference and point indices of the warping path and its
+    # total cost. Rows of the accumulated cost D are computed at once: with a[j] the best of the
+    # previous row, D[j] = c[j] + min(a[j], D[j-1]) equals C[j] + min_k<=j (a[k] - C[k-1]) for the
+    # cumulative sum C of the costs c, which is a minimum.accumulate.
+    reference = np.asarray(reference, dtype=float).reshape(-1, 2)
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    n, m = len(reference), len(points)
+    if n == 0 or m == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int), 0.0
+
+    with profiling.span('dtw_path'):
+        lo, hi = dtw_window(reference, points, radius)
+        rows = list()
+        previous, previous_lo = None, 0
+        for i in range(n):
+            l, h = lo[i], hi[i]
+            # Previous row on the columns l - 1 to h - 1, the first row starts from the corner
+            if i > 0:
+                shifted = np.full(h - l + 1, np.inf)
+                a, b = max(previous_lo, l - 1), min(previous_lo + len(previous), h)
+                shifted[a - l + 1:b - l + 1] = previous[a - previous_lo:b - previous_lo]
+                best = np.minimum(shifted[1:], shifted[:-1])
+            else:
+                best = np.full(h, np.inf)
+                best[0] = 0.0
+            c = np.hypot(points[l:h, 0] - reference[i, 0], points[l:h, 1] - reference[i, 1])
+            C = np.cumsum(c)
+            D = np.minimum.accumulate(best - (C - c)) + C
+            rows.append(D)
+            previous, previous_lo = D, l
+
+        # Backtracking from the last corner
+        path_i = np.empty(n + m, dtype=int)
+        path_j = np.empty(n + m, dtype=int)
+        i, j, k = n - 1, m - 1, 0
+        while True:
+            path_i[k], path_j[k] = i, j
+            k += 1
+            if i == 0 and j == 0:
+                break
+            up = rows[i - 1][j - lo[i - 1]] if i > 0 and lo[i - 1] <= j < hi[i - 1] else np.inf
+            diagonal = rows[i - 1][j - 1 - lo[i - 1]] \
+                if i > 0 and lo[i - 1] <= j - 1 < hi[i - 1] else np.inf
+            left = rows[i][j - 1 - lo[i]] if j > lo[i] else np.inf
+            if diagonal <= up and diagonal <= left:
+                i, j = i - 1, j - 1
+            elif up <= left:
+                i -= 1
+            else:
+                j -= 1
+    return path_i[k - 1::-1], path_j[k - 1::-1], float(rows[-1][-1])
+
+
+def align_points(reference, points, radius=ALIGNMENT_RADIUS, cutoff=None):
+    # Index map of the reference points in the format of GpsPressureReader.match_points: for
+    # every reference point the nearest of the points warped to it, with the number of points as
+    # the index of reference points farther than the cutoff, the indices of these and distances.
+    reference = np.asarray(reference, dtype=float).reshape(-1, 2)
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    m = len(points)
+    path_i, path_j, _ = dtw_path(reference, points, radius)
+    ind = np.full(len(reference), m)
+    dist = np.full(len(reference), np.inf)
+    if len(path_i) > 0:
+        d = np.hypot(*(reference[path_i] - points[path_j]).T)
+        order = np.lexsort((d, path_i))
+        first = order[np.r_[True, path_i[order][1:] != path_i[order][:-1]]]
+        ind[path_i[first]] = path_j[first]
+        dist[path_i[first]] = d[first]
+    if cutoff is not None:
+        far = dist > cutoff
+        ind[far] = m
+        dist[far] = np.inf
+    return ind, np.flatnonzero(ind == m), dist
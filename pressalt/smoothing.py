@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+#
+#  (C) Copyright 2013, 2016 Wojciech Mruczkiewicz
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import functools
+import numpy as np
+
+# Kernels longer than this are convolved through the FFT
+DIRECT_CONVOLUTION_LIMIT = 256
+
+# Smoothed samples need at least this part of the window weight on samples that are not missing
+SMOOTHING_MIN_WEIGHT = 0.5
+
+# Relative tolerance of the comparison with the minimum weight. Half of an even window weighs
+# exactly 0.5 but its sum rounds either way, as do the weights convolved through the FFT.
+SMOOTHING_WEIGHT_TOLERANCE = 1e-9
+
+
+@functools.lru_cache(maxsize=32)
+def dpss_window(n, width):
+    # Digital prolate spheroidal (Slepian) window of n samples normalized to unit sum. The width
+    # is the bandwidth of scipy.signal.slepian, which is the half bandwidth NW = n width / 4 of
+    # scipy.signal.windows.dpss. Windows are cached and returned read only.
+    import scipy.signal
+    if hasattr(scipy.signal, 'windows') and hasattr(scipy.signal.windows, 'dpss'):
+        w = scipy.signal.windows.dpss(n, n*width/4.0)
+    else:
+        w = scipy.signal.slepian(n, width=width)
+    w = np.abs(w)
+    w = w / np.sum(w)
+    w.flags.writeable = False
+    return w
+
+
+@functools.lru_cache(maxsize=32)
+def swt_window(wavelet='sym4', levels=8):
+    # Kernel of the stationary wavelet transform smoothing, the reconstruction of the level
+    # approximation with all the details set to zero. Without decimation the transform is shift
+    # invariant, so it is the convolution with its impulse response, computed here on a periodic
+    # impulse long enough for the support not to wrap. The kernel is centred with zero padding,
+    # normalized to unit sum and returned read only.
+    import pywt
+    wavelet = pywt.Wavelet(wavelet)
+    step = 1 << levels
+    support = 2 * (step - 1) * (wavelet.dec_len - 1)
+    n = step * -(-(2*support + 1) // step)
+    impulse = np.zeros(n)
+    impulse[0] = 1.0
+    coeffs = [(a, np.zeros_like(d)) for a, d in pywt.swt(impulse, wavelet, levels)]
+    response = pywt.iswt(coeffs, wavelet)
+    w = np.concatenate((response[n - support:], response[:support + 1]))
+    significant = np.flatnonzero(np.abs(w) > 1e-12 * np.max(np.abs(w)))
+    half = max(support - significant[0], significant[-1] - support)
+    w = w[support - half:support + half + 1]
+    w = w / np.sum(w)
+    w.flags.writeable = False
+    return w
+
+
+def convolve_valid(x, w):
+    # Convolution of the samples fully covered by the kernel, directly for short kernels and
+    # through the FFT, with overlap-add for long inputs, otherwise
+    if len(w) <= DIRECT_CONVOLUTION_LIMIT or len(x) <= DIRECT_CONVOLUTION_LIMIT:
+        return np.convolve(x, w, mode='valid')
+    import scipy.signal
+    if hasattr(scipy.signal, 'oaconvolve'):
+        return scipy.signal.oaconvolve(x, w, mode='valid')
+    return scipy.signal.fftconvolve(x, w, mode='valid')
+
+
+def _normalized(x, w, keep_gaps, min_weight, center):
+    # Convolution of x, with the missing samples given as NaN, normalized by the weight of the
+    # present samples. Both ends of x are padded by the caller, center are the samples of x at
+    # the centres of the output.
+    present = np.isfinite(x)
+    index = np.flatnonzero(present)
+    value = convolve_valid(np.where(present, x, 0.0), w)
+    if len(index) > 0 and index[-1] - index[0] + 1 == len(index):
+        # Without gaps inside, the weight is the window sum apart from the windows reaching the
+        # missing ends, which take a part of the cumulative sum of the window
+        cumulative = np.concatenate(([0.0], np.cumsum(w[::-1])))
+        weight = np.full(len(value), cumulative[-1])
+        start = np.r_[0:min(index[0], len(value)), max(index[-1] + 2 - len(w), 0):len(value)]
+        weight[start] = cumulative[np.clip(index[-1] + 1 - start, 0, len(w))] - \
+            cumulative[np.clip(index[0] - start, 0, len(w))]
+    else:
+        weight = convolve_valid(present.astype(float), w)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        s = value / weight
+    s[weight < min_weight*(1.0 - SMOOTHING_WEIGHT_TOLERANCE)] = np.nan
+    if keep_gaps:
+        s[~np.isfinite(center)] = np.nan
+    return s
+
+
+def smooth(a, window, keep_gaps=True, min_weight=SMOOTHING_MIN_WEIGHT):
+    # Centred convolution with the window normalized by the weight of the samples present under
+    # it, so that NaN gaps don't spread and the ends use the part of the window inside the
+    # signal. Samples with less than min_weight of the window present are NaN, as are the gaps
+    # themselves unless keep_gaps is false.
+    a = np.asarray(a, dtype=float)
+    n = len(window)
+    left = n // 2
+    padded = np.concatenate((np.full(left, np.nan), a, np.full(n - 1 - left, np.nan)))
+    return _normalized(padded, window, keep_gaps, min_weight, a)
+
+
+class StreamingSmoother:
+    # Overlap-save form of smooth for input arriving in chunks. Every chunk returns the smoothed
+    # samples whose window is complete, which lag the input by half of the window, and flush
+    # returns the rest. The concatenated output equals smooth of the whole input.
+
+    def __init__(self, window, keep_gaps=True, min_weight=SMOOTHING_MIN_WEIGHT):
+        self._window = np.asarray(window, dtype=float)
+        self._keep_gaps = keep_gaps
+        self._min_weight = min_weight
+        self._left = len(window) // 2
+        self._buffer = np.full(self._left, np.nan)
+
+    def process(self, chunk):
+        self._buffer = np.concatenate((self._buffer, np.asarray(chunk, dtype=float)))
+        n = len(self._window)
+        if len(self._buffer) < n:
+            return np.zeros(0)
+        count = len(self._buffer) - n + 1
+        # Centres of the output are the samples lagging the window start by half of it, the
+        # left padding is not part of the input and has no centre of its own
+        center = self._buffer[self._left:self._left + count]
+        s = _normalized(self._buffer, self._window, self._keep_gaps, self._min_weight, center)
+        self._buffer = self._buffer[count:]
+        return s
+
+    def flush(self):
+        n = len(self._window)
+        s = self.process(np.full(n - 1 - self._left, np.nan))
+        self._buffer = np.full(self._left, np.nan)
+        return s
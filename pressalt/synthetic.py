@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+#
+#  (C) Copyright 2013, 2016 Wojciech Mruczkiewicz
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from .atmosphere import pressure_ratio, STANDARD_LAPSE_RATE
+from .altitude_accel_filter import STANDARD_GRAVITY
+import struct
+import numpy as np
+
+SYNTHETIC_START_TIME = 1466000000000
+EARTH_RADIUS = 6371000.0
+MAGIC_WORD = b'SensorsRecord'
+
+
+def synthetic_terrain(x, y, base=250.0):
+    # Rolling hills in metres of east and north offsets, shared by the recordings and the DEM
+    return (base + 80.0*np.sin(x/1900.0) * np.cos(y/2300.0) + 25.0*np.sin((x + 2.0*y)/410.0) +
+            6.0*np.cos((3.0*x - y)/97.0))
+
+
+class SyntheticRecording:
+    # A ride over synthetic_terrain at a constant speed with slowly turning heading. Sensor streams
+    # are kept as arrays with millisecond times in the first column:
+    #   gps: time, latitude, longitude, altitude, bearing, speed, accuracy, GPS time
+    #   pressure: time, hPa
+    #   accel: time, x, y, z in m/s^2 with the device lying flat
+    #   temp: time, celsius
+
+    def __init__(self, duration=3600.0, gps_rate=1.0, pressure_rate=25.0, accel_rate=0.0,
+                 temp_rate=0.0, speed=8.0, latitude=50.06, longitude=19.94, seed=0,
+                 start_time=SYNTHETIC_START_TIME):
+        rng = np.random.RandomState(seed)
+        self.start_time = start_time
+        self.end_time = start_time + int(duration*1000)
+        self.latitude = latitude
+        self.longitude = longitude
+
+        def times(rate):
+            if rate <= 0.0:
+                return np.zeros(0)
+            return np.arange(0.0, duration, 1.0/rate)
+
+        def track(t):
+            heading = 0.6 + 0.8*np.sin(t/900.0)
+            # Positions follow the heading integrated in closed form for the sine above
+            s = speed*t
+            x = s*np.cos(0.6) - speed*0.8*900.0*(1.0 - np.cos(t/900.0))*np.sin(0.6)
+            y = s*np.sin(0.6) + speed*0.8*900.0*(1.0 - np.cos(t/900.0))*np.cos(0.6)
+            return x, y, heading
+
+        t = times(gps_rate)
+        x, y, heading = track(t)
+        altitude = synthetic_terrain(x, y)
+        self.gps = np.column_stack((
+            self._milliseconds(t), latitude + np.degrees(y/EARTH_RADIUS),
+            longitude + np.degrees(x/(EARTH_RADIUS*np.cos(np.radians(latitude)))),
+            altitude + 4.0*rng.randn(len(t)), np.degrees(heading) % 360.0,
+            np.full(len(t), speed), np.full(len(t), 5.0),
+            self._milliseconds(t)))
+
+        t = times(pressure_rate)
+        x, y, _ = track(t)
+        pressure_msl = 1013.25 + 2.0*np.sin(t/7200.0)
+        self.pressure = np.column_stack((
+            self._milliseconds(t),
+            pressure_msl*pressure_ratio(synthetic_terrain(x, y))[0] + 0.05*rng.randn(len(t))))
+
+        t = times(accel_rate)
+        if len(t) > 1:
+            x, y, _ = track(t)
+            vertical = np.gradient(np.gradient(synthetic_terrain(x, y), t), t)
+            self.accel = np.column_stack((
+                self._milliseconds(t), 0.2*rng.randn(len(t)), 0.2*rng.randn(len(t)),
+                STANDARD_GRAVITY + vertical + 0.2*rng.randn(len(t))))
+        else:
+            self.accel = np.zeros((0, 4))
+
+        t = times(temp_rate)
+        x, y, _ = track(t)
+        self.temp = np.column_stack((
+            self._milliseconds(t),
+            20.0 - STANDARD_LAPSE_RATE*synthetic_terrain(x, y) + 0.1*rng.randn(len(t))))
+
+    def _milliseconds(self, t):
+        return self.start_time + np.round(t*1000.0)
+
+    def write_v10(self, file):
+        # Legacy version 10 has no header, readers take the time of the first frame as the start
+        frames = self._frames((
+            (self.gps, struct.Struct('!hqdddfffq'), lambda t, r: (1, t) + r[1:7] + (int(r[7]),)),
+            (self.accel, struct.Struct('!hqfff'), lambda t, r: (2, t) + r[1:]),
+            (self.pressure, struct.Struct('!hqf'), lambda t, r: (8, t) + r[1:]),
+            (self.temp, struct.Struct('!hqf'), lambda t, r: (10, t) + r[1:])))
+        self._write(file, [frames])
+
+    def write_v11(self, file):
+        header = struct.pack('!hqi', 0, self.start_time, 1100)
+        frames = self._frames((
+            (self.gps, struct.Struct('!hqdddfffq'), lambda t, r: (1, t) + r[1:7] + (int(r[7]),)),
+            (self.accel, struct.Struct('!hqqfff'), lambda t, r: (2, t, t*1000) + r[1:]),
+            (self.pressure, struct.Struct('!hqqf'), lambda t, r: (8, t, t*1000) + r[1:]),
+            (self.temp, struct.Struct('!hqqf'), lambda t, r: (10, t, t*1000) + r[1:])))
+        self._write(file, [header, frames])
+
+    def write_v12(self, file, version=1301):
+        header = struct.pack('!hhi%dsiqq' % len(MAGIC_WORD), -1, 0, len(MAGIC_WORD), MAGIC_WORD,
+                             version, self.start_time, self.start_time)
+        frames = self._frames((
+            (self.gps, struct.Struct('!hhqdddfffq'), lambda t, r: (-6, 0, t) + r[1:7] +
+             (int(r[7]),)),
+            (self.accel, struct.Struct('!hhqqhfff'), lambda t, r: (2, 0, t, t*1000, 3) + r[1:]),
+            (self.pressure, struct.Struct('!hhqqhf'), lambda t, r: (12, 0, t, t*1000, 1) + r[1:]),
+            (self.temp, struct.Struct('!hhqqhf'), lambda t, r: (26, 0, t, t*1000, 1) + r[1:])))
+        duration = self.end_time - self.start_time
+        end = struct.pack('!hhi%dsiqqqqd' % len(MAGIC_WORD), -3, 0, len(MAGIC_WORD), MAGIC_WORD,
+                          version, self.end_time, self.end_time, duration, duration, 0.0)
+        self._write(file, [header, frames, end])
+
+    def write_text(self, file):
+        # Text logs of the recording application hold GPS fixes and pressure samples only
+        lines = self._merge((
+            (self.gps, ['%d\tgps\t%.8f\t%.8f\t%.3f\t%f\t%f\t%f\t%d\n' %
+                        (r[0], r[1], r[2], r[3], r[4], r[5], r[6], r[7]) for r in self.gps]),
+            (self.pressure, ['%d\tpress\t%f\n' % (r[0], r[1]) for r in self.pressure])))
+        with open(file, 'w') as f:
+            f.write(''.join(lines))
+
+    def _frames(self, streams):
+        # Frames are packed from rows given as the integer time and the tuple of all columns
+        return b''.join(self._merge([(data, [s.pack(*values(int(r[0]), tuple(r)))
+                                             for r in data.tolist()])
+                                     for data, s, values in streams]))
+
+    def _merge(self, streams):
+        # Frames of all streams ordered by time, in stream order for equal times
+        times = np.concatenate([data[:, 0] for data, _ in streams])
+        frames = [frame for _, stream in streams for frame in stream]
+        return [frames[i] for i in np.argsort(times, kind='stable')]
+
+    def _write(self, file, parts):
+        with open(file, 'wb') as f:
+            for part in parts:
+                f.write(part)
+
+
+def write_geotiff(file, latitude, longitude, size=1024, resolution=10.0):
+    # Square DEM of synthetic_terrain centred at the given coordinates in EPSG:4326, as used by
+    # elevation.GeoFile. Requires GDAL.
+    import gdal
+    from osgeo import osr
+    step_y = np.degrees(resolution/EARTH_RADIUS)
+    step_x = step_y/np.cos(np.radians(latitude))
+    left = longitude - step_x*size/2
+    top = latitude + step_y*size/2
+    columns, rows = np.meshgrid(np.arange(size) + 0.5, np.arange(size) + 0.5)
+    x = (left + columns*step_x - longitude) / step_x * resolution
+    y = (top - rows*step_y - latitude) / step_y * resolution
+    dataset = gdal.GetDriverByName('GTiff').Create(file, size, size, 1, gdal.GDT_Float32)
+    dataset.SetGeoTransform((left, step_x, 0.0, top, 0.0, -step_y))
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    dataset.SetProjection(srs.ExportToWkt())
+    dataset.GetRasterBand(1).WriteArray(synthetic_terrain(x, y).astype(np.float32))
+    dataset.FlushCache()
+    return file
@@ -0,0 +1,367 @@
+# -*- coding: utf-8 -*-
+#
+#  (C) Copyright 2013, 2016 Wojciech Mruczkiewicz
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from .record_readers import read_binary, read_text
+from .gps_pressure_reader import GpsPressureReader
+from . import profiling
+import datetime
+import os
+import sqlite3
+import numpy as np
+
+TRACK_STORE_VERSION = 1
+
+# GPS points of a track chunk, consecutive chunks share a point so that the track is continuous
+TRACK_CHUNK_POINTS = 64
+
+EARTH_RADIUS = 6371008.8
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS rides (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    start_time INTEGER,
+    end_time INTEGER,
+    gps_count INTEGER NOT NULL,
+    press_count INTEGER NOT NULL,
+    min_lon REAL, max_lon REAL, min_lat REAL, max_lat REAL,
+    distance REAL,
+    min_altitude REAL, max_altitude REAL
+);
+CREATE TABLE IF NOT EXISTS chunks (
+    id INTEGER PRIMARY KEY,
+    ride INTEGER NOT NULL REFERENCES rides(id) ON DELETE CASCADE,
+    start_time INTEGER NOT NULL, end_time INTEGER NOT NULL,
+    min_lon REAL NOT NULL, max_lon REAL NOT NULL, min_lat REAL NOT NULL, max_lat REAL NOT NULL,
+    points BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS chunks_ride ON chunks(ride);
+CREATE VIRTUAL TABLE IF NOT EXISTS ride_index USING rtree(
+    id, min_lon, max_lon, min_lat, max_lat, start_time, end_time);
+CREATE VIRTUAL TABLE IF NOT EXISTS chunk_index USING rtree(
+    id, min_lon, max_lon, min_lat, max_lat, start_time, end_time);
+'''
+
+# Boxes of the R*Trees are stored as 32 bit floats rounded outwards, so they select candidates and
+# the exact bounds of the tables decide
+_CHUNK_QUERY = '''
+SELECT c.id, c.ride FROM chunk_index i JOIN chunks c ON c.id = i.id
+WHERE i.max_lon >= ? AND i.min_lon <= ? AND i.max_lat >= ? AND i.min_lat <= ?
+    AND i.end_time >= ? AND i.start_time <= ?
+    AND c.max_lon >= ? AND c.min_lon <= ? AND c.max_lat >= ? AND c.min_lat <= ?
+    AND c.end_time >= ? AND c.start_time <= ?
+'''
+
+_RIDE_COLUMNS = ('id', 'path', 'size', 'mtime', 'start_time', 'end_time', 'gps_count',
+                 'press_count', 'min_lon', 'max_lon', 'min_lat', 'max_lat', 'distance',
+                 'min_altitude', 'max_altitude')
+
+
+def time_value(value):
+    # Milliseconds since the epoch of a number of milliseconds, a datetime or an ISO date, naive
+    # dates being UTC
+    if value is None or isinstance(value, (int, float, np.number)):
+        return value
+    if isinstance(value, str):
+        value = datetime.datetime.fromisoformat(value)
+    if isinstance(value, datetime.date) and not isinstance(value, datetime.datetime):
+        value = datetime.datetime(value.year, value.month, value.day)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=datetime.timezone.utc)
+    return int(round(value.timestamp() * 1000.0))
+
+
+def local_projection(latitude, longitude, origin):
+    # Equirectangular metres around the origin (latitude, longitude), accurate to a fraction of
+    # a percent over the tens of kilometres of a ride
+    lat0, lon0 = origin
+    x = np.radians(np.asarray(longitude, dtype=float) - lon0) * EARTH_RADIUS * np.cos(
+        np.radians(lat0))
+    y = np.radians(np.asarray(latitude, dtype=float) - lat0) * EARTH_RADIUS
+    return np.column_stack((x, y))
+
+
+def densify(points, spacing):
+    # Polyline points with the segments longer than spacing split evenly
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    if len(points) < 2:
+        return points
+    d = np.hypot(*np.diff(points, axis=0).T)
+    steps = np.maximum(np.ceil(d / spacing).astype(int), 1)
+    segment = np.repeat(np.arange(len(d)), steps)
+    fraction = (np.arange(len(segment)) - np.repeat(np.cumsum(steps) - steps, steps)) / \
+        np.repeat(steps, steps)
+    dense = points[segment] + fraction[:, np.newaxis] * (points[segment + 1] - points[segment])
+    return np.concatenate((dense, points[-1:]))
+
+
+def _read_file(file, reader, legacy):
+    if file.endswith('.log') or file.endswith('.txt'):
+        return read_text(file, reader)
+    else:
+        return read_binary(file, reader, legacy)
+
+
+# Points of a chunk as offsets from the corner of its box and from its start time
+_POINT_DTYPE = np.dtype([('lon', '<f4'), ('lat', '<f4'), ('time', '<u4')])
+
+
+def _encode_points(latitude, longitude, time, box, start_time):
+    points = np.zeros(len(latitude), dtype=_POINT_DTYPE)
+    points['lon'] = longitude - box[0]
+    points['lat'] = latitude - box[2]
+    points['time'] = time - start_time
+    return points.tobytes()
+
+
+def _decode_points(blob, min_lon, min_lat, start_time):
+    points = np.frombuffer(blob, dtype=_POINT_DTYPE)
+    return (points['lat'].astype(float) + min_lat, points['lon'].astype(float) + min_lon,
+            points['time'].astype(np.int64) + start_time)
+
+
+class TrackStore:
+    # SQLite store of the tracks of many recordings. Ingestion reads every recording once with
+    # GpsPressureReader and keeps its summary, its bounding box and time range in an R*Tree and
+    # the GPS track in chunks indexed by another R*Tree, so that spatial and time queries are
+    # answered from the database without decoding any recording.
+
+    def __init__(self, path):
+        self._path = path
+        self._db = sqlite3.connect(path)
+        self._db.execute('PRAGMA foreign_keys = ON')
+        version = self._db.execute('PRAGMA user_version').fetchone()[0]
+        if version not in (0, TRACK_STORE_VERSION):
+            raise ValueError('Unknown track store version: %d' % version)
+        with self._db:
+            self._db.executescript(_SCHEMA)
+            self._db.execute('PRAGMA user_version = %d' % TRACK_STORE_VERSION)
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self._db.execute('SELECT COUNT(*) FROM rides').fetchone()[0]
+
+    def ingest(self, files, legacy=False, force=False):
+        # Adds or updates the recordings, skipping the ones stored with the same size and
+        # modification time unless forced. Returns the ids of the recordings read.
+        ids = list()
+        for file in files:
+            path = os.path.abspath(file)
+            stat = os.stat(path)
+            row = self._db.execute('SELECT id, size, mtime FROM rides WHERE path = ?',
+                                   (path,)).fetchone()
+            if row is not None and not force and row[1:] == (stat.st_size, stat.st_mtime):
+                continue
+            with profiling.span('TrackStore.ingest'):
+                reader = _read_file(path, GpsPressureReader(), legacy)
+                ids.append(self._store(path, stat, reader))
+        return ids
+
+    def _store(self, path, stat, reader):
+        latitude, longitude = reader.gps_latitude(), reader.gps_longitude()
+        time = reader.gps_time()
+        valid = np.isfinite(latitude) & np.isfinite(longitude) & \
+            ((latitude != 0.0) | (longitude != 0.0))
+        latitude, longitude, time = latitude[valid], longitude[valid], time[valid]
+        altitude = reader.press_altitude()
+        altitude = altitude[np.isfinite(altitude)]
+        distance = None
+        if len(latitude) > 1:
+            points = local_projection(latitude, longitude, (latitude[0], longitude[0]))
+            distance = float(np.sum(np.hypot(*np.diff(points, axis=0).T)))
+        box = (float(np.min(longitude)), float(np.max(longitude)), float(np.min(latitude)),
+               float(np.max(latitude))) if len(latitude) > 0 else (None,) * 4
+        summary = (stat.st_size, stat.st_mtime, reader.start_time, reader.end_time,
+                   len(reader.gps_time()), len(reader.press_time())) + box + \
+            (distance, float(np.min(altitude)) if len(altitude) > 0 else None,
+             float(np.max(altitude)) if len(altitude) > 0 else None)
+
+        with self._db:
+            row = self._db.execute('SELECT id FROM rides WHERE path = ?', (path,)).fetchone()
+            if row is not None:
+                self._delete(row[0])
+            ride = self._db.execute(
+                'INSERT INTO rides (path, size, mtime, start_time, end_time, gps_count, '
+                'press_count, min_lon, max_lon, min_lat, max_lat, distance, min_altitude, '
+                'max_altitude) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (path,) + summary).lastrowid
+            if len(latitude) == 0:
+                return ride
+            self._db.execute('INSERT INTO ride_index VALUES (?, ?, ?, ?, ?, ?, ?)',
+                             (ride,) + box + (int(time[0]), int(time[-1])))
+            step = TRACK_CHUNK_POINTS - 1
+            for first in range(0, max(len(latitude) - 1, 1), step):
+                part = slice(first, first + TRACK_CHUNK_POINTS)
+                lat, lon, t = latitude[part], longitude[part], time[part]
+                chunk_box = (float(np.min(lon)), float(np.max(lon)), float(np.min(lat)),
+                             float(np.max(lat)))
+                times = (int(np.min(t)), int(np.max(t)))
+                chunk = self._db.execute(
+                    'INSERT INTO chunks (ride, start_time, end_time, min_lon, max_lon, min_lat, '
+                    'max_lat, points) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (ride,) + times + chunk_box +
+                    (_encode_points(lat, lon, t, chunk_box, times[0]),)).lastrowid
+                self._db.execute('INSERT INTO chunk_index VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                 (chunk,) + chunk_box + times)
+        return ride
+
+    def _delete(self, ride):
+        self._db.execute('DELETE FROM chunk_index WHERE id IN (SELECT id FROM chunks '
+                         'WHERE ride = ?)', (ride,))
+        self._db.execute('DELETE FROM ride_index WHERE id = ?', (ride,))
+        self._db.execute('DELETE FROM rides WHERE id = ?', (ride,))
+
+    def remove(self, file):
+        with self._db:
+            row = self._db.execute('SELECT id FROM rides WHERE path = ?',
+                                   (os.path.abspath(file),)).fetchone()
+            if row is not None:
+                self._delete(row[0])
+        return row is not None
+
+    def ride_id(self, file):
+        row = self._db.execute('SELECT id FROM rides WHERE path = ?',
+                               (os.path.abspath(file),)).fetchone()
+        return None if row is None else row[0]
+
+    def ride(self, ride):
+        # Summary of a ride as a dictionary
+        row = self._db.execute('SELECT %s FROM rides WHERE id = ?' % ', '.join(_RIDE_COLUMNS),
+                               (ride,)).fetchone()
+        return None if row is None else dict(zip(_RIDE_COLUMNS, row))
+
+    def paths(self, rides):
+        return [self.ride(ride)['path'] for ride in rides]
+
+    def points(self, ride):
+        # Latitudes, longitudes and times of the stored track of a ride
+        rows = self._db.execute('SELECT points, min_lon, min_lat, start_time FROM chunks '
+                                'WHERE ride = ? ORDER BY id', (ride,)).fetchall()
+        if not rows:
+            return np.zeros(0), np.zeros(0), np.zeros(0, dtype=np.int64)
+        # The first point of a chunk is the last one of the previous chunk
+        parts = [[c[1:] if i > 0 else c for c in _decode_points(*row)]
+                 for i, row in enumerate(rows)]
+        return tuple(np.concatenate(column) for column in zip(*parts))
+
+    def rides(self, bbox=None, start=None, end=None, exact=True):
+        # Ids of the rides with a part of the track inside the bounding box (west, south, east,
+        # north) in degrees between the start and end times, which are milliseconds since the
+        # epoch, datetimes or ISO dates. Without exact the bounding boxes of the rides are enough.
+        start, end = time_value(start), time_value(end)
+        start = -2.0**62 if start is None else start
+        end = 2.0**62 if end is None else end
+        if bbox is None:
+            rows = self._db.execute('SELECT id FROM rides WHERE end_time >= ? AND start_time <= ?',
+                                    (start, end)).fetchall()
+            return sorted(row[0] for row in rows)
+        west, south, east, north = bbox
+        if exact:
+            # Candidate chunks have a point inside the box in the time range
+            rides = set()
+            for chunk, ride in self._chunks([bbox], start, end):
+                if ride in rides:
+                    continue
+                lat, lon, time = _decode_points(*self._db.execute(
+                    'SELECT points, min_lon, min_lat, start_time FROM chunks WHERE id = ?',
+                    (chunk,)).fetchone())
+                if np.any((lon >= west) & (lon <= east) & (lat >= south) & (lat <= north) &
+                          (time >= start) & (time <= end)):
+                    rides.add(ride)
+            return sorted(rides)
+        rows = self._db.execute('SELECT id FROM ride_index WHERE max_lon >= ? AND min_lon <= ? '
+                                'AND max_lat >= ? AND min_lat <= ? AND end_time >= ? '
+                                'AND start_time <= ?',
+                                (west, east, south, north, start, end)).fetchall()
+        return sorted(row[0] for row in rows)
+
+    def _chunks(self, boxes, start, end):
+        # Chunks intersecting any of the boxes in the time range
+        start = -2.0**62 if start is None else start
+        end = 2.0**62 if end is None else end
+        found = set()
+        for west, south, east, north in boxes:
+            bounds = (west, east, south, north, start, end)
+            found.update(self._db.execute(_CHUNK_QUERY, bounds + bounds).fetchall())
+        return found
+
+    def near_route(self, latitude, longitude, distance=20.0, coverage=0.0, start=None,
+                   end=None):
+        # Rides passing within the distance in metres of the route, a polyline of latitudes and
+        # longitudes, as pairs of the ride id and the covered part of the route, the ratio of the
+        # route points within the distance of the track. Rides covering more than the coverage are
+        # returned, the best covering first.
+        import scipy.spatial
+        latitude = np.asarray(latitude, dtype=float)
+        longitude = np.asarray(longitude, dtype=float)
+        valid = np.isfinite(latitude) & np.isfinite(longitude)
+        latitude, longitude = latitude[valid], longitude[valid]
+        if len(latitude) == 0:
+            return []
+        with profiling.span('TrackStore.near_route'):
+            origin = (float(np.mean(latitude)), float(np.mean(longitude)))
+            route = densify(local_projection(latitude, longitude, origin), distance / 2.0)
+
+            # Boxes of route pieces grown by the distance, in degrees
+            margin = np.degrees(distance / EARTH_RADIUS)
+            lon_margin = margin / max(np.cos(np.radians(origin[0])), 1e-6)
+            dense_lon = origin[1] + np.degrees(route[:, 0] / (EARTH_RADIUS *
+                                                              np.cos(np.radians(origin[0]))))
+            dense_lat = origin[0] + np.degrees(route[:, 1] / EARTH_RADIUS)
+            boxes = list()
+            for first in range(0, len(route), TRACK_CHUNK_POINTS):
+                part = slice(first, first + TRACK_CHUNK_POINTS + 1)
+                boxes.append((np.min(dense_lon[part]) - lon_margin,
+                              np.min(dense_lat[part]) - margin,
+                              np.max(dense_lon[part]) + lon_margin,
+                              np.max(dense_lat[part]) + margin))
+            start = -2.0**62 if start is None else time_value(start)
+            end = 2.0**62 if end is None else time_value(end)
+            chunks = self._chunks(boxes, start, end)
+            by_ride = dict()
+            for chunk, ride in chunks:
+                by_ride.setdefault(ride, list()).append(chunk)
+
+            result = list()
+            for ride, ids in by_ride.items():
+                rows = self._db.execute('SELECT points, min_lon, min_lat, start_time FROM chunks '
+                                        'WHERE id IN (%s) ORDER BY id' % ','.join('?' * len(ids)),
+                                        ids).fetchall()
+                # Chunks are densified one by one, the chunks share their end points
+                track = list()
+                for row in rows:
+                    lat, lon, time = _decode_points(*row)
+                    inside = (time >= start) & (time <= end)
+                    track.append(densify(local_projection(lat[inside], lon[inside], origin),
+                                         distance / 2.0))
+                track = np.concatenate(track)
+                if len(track) == 0:
+                    continue
+                near, _ = scipy.spatial.cKDTree(track).query(route, distance_upper_bound=distance)
+                covered = np.count_nonzero(np.isfinite(near)) / float(len(route))
+                if covered > 0.0 and covered >= coverage:
+                    result.append((ride, covered))
+        return sorted(result, key=lambda r: (-r[1], r[0]))
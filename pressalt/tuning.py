@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+#
+#  (C) Copyright 2013, 2016 Wojciech Mruczkiewicz
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from concurrent.futures import ProcessPoolExecutor
+from math import sqrt
+import hashlib
+import itertools
+import json
+import os
+import numpy as np
+
+
+class TuningCase:
+    # Recorded events together with reference altitudes at given times. With offset set, the mean
+    # difference to the reference is removed before scoring, as for repeated rides recorded at
+    # different MSL pressures.
+
+    def __init__(self, name, gps_events, pressure_events, reference_time, reference_altitude,
+                 offset=False):
+        reference_time = np.asarray(reference_time, dtype=float)
+        reference_altitude = np.asarray(reference_altitude, dtype=float)
+        valid = np.isfinite(reference_altitude)
+        self.name = name
+        self.gps_events = gps_events
+        self.pressure_events = pressure_events
+        self.reference_time = reference_time[valid]
+        self.reference_altitude = reference_altitude[valid]
+        self.offset = offset
+        self._pressure_time = np.array([e[0] for e in pressure_events], dtype=float)
+        self._digest = None
+
+    def digest(self):
+        # SHA-1 of the events and the reference, so that cached scores of a case of the same
+        # name with other data are not served
+        if self._digest is None:
+            digest = hashlib.sha1(self.name.encode('utf-8'))
+            for array in (self.gps_events, self.pressure_events, self.reference_time,
+                          self.reference_altitude):
+                array = np.ascontiguousarray(array, dtype=float)
+                digest.update(str(array.shape).encode('ascii'))
+                digest.update(array.tobytes())
+            digest.update(b'offset' if self.offset else b'')
+            self._digest = digest.hexdigest()
+        return self._digest
+
+    def rmse(self, filter):
+        filter.execute(self.gps_events, self.pressure_events)
+        altitude = filter.altitude()
+        valid = np.isfinite(altitude)
+        if np.count_nonzero(valid) < 2:
+            return float('inf')
+        estimate = np.interp(self.reference_time, self._pressure_time[valid], altitude[valid],
+                             left=np.NaN, right=np.NaN)
+        d = estimate - self.reference_altitude
+        d = d[np.isfinite(d)]
+        if len(d) == 0:
+            return float('inf')
+        if self.offset:
+            d -= np.mean(d)
+        return sqrt(np.mean(d**2))
+
+
+def dem_case(reader, elevation, geoid=None, name='dem'):
+    # Reference altitudes of the GPS track taken from a GeoFile or GeoFiles elevation model
+    reference = elevation.values(reader.gps_longitude(), reader.gps_latitude(), geoid=geoid)
+    return TuningCase(name, reader.gps_events, reader.press_events, reader.gps_time(),
+                      reference)
+
+
+def repeat_case(reader, reference_reader, reference_altitude, cutoff=10.0, name='repeat',
+                align=False):
+    # Reference altitudes of a repeated ride, given for every GPS point of the reference ride and
+    # assigned to the nearest GPS points of the ride, as in scripts/case-repeat.py. Aligned rides
+    # are matched along the route, which also handles out and back routes and loops.
+    match = reference_reader.align_points if align else reference_reader.match_points
+    i, iw, _ = match(reader.gps_coordinates(), cutoff)
+    matched = np.delete(np.arange(len(i)), iw)
+    reference_time = reader.gps_time()[i[matched]]
+    return TuningCase(name, reader.gps_events, reader.press_events, reference_time,
+                      np.asarray(reference_altitude)[matched], offset=True)
+
+
+class Uniform:
+
+    def __init__(self, low, high):
+        self.low = low
+        self.high = high
+
+    def sample(self, rng):
+        return float(rng.uniform(self.low, self.high))
+
+
+class LogUniform:
+
+    def __init__(self, low, high):
+        self.low = low
+        self.high = high
+
+    def sample(self, rng):
+        return float(np.exp(rng.uniform(np.log(self.low), np.log(self.high))))
+
+
+def grid_candidates(space):
+    # All combinations of the listed parameter values
+    names = sorted(space)
+    return [dict(zip(names, values)) for values in itertools.product(*[space[n] for n in names])]
+
+
+def random_candidates(space, count, seed=0):
+    # Parameters drawn from Uniform or LogUniform ranges, or chosen from lists of values
+    rng = np.random.RandomState(seed)
+    candidates = list()
+    for _ in range(count):
+        candidate = dict()
+        for name in sorted(space):
+            axis = space[name]
+            if hasattr(axis, 'sample'):
+                candidate[name] = axis.sample(rng)
+            else:
+                candidate[name] = axis[rng.randint(len(axis))]
+        candidates.append(candidate)
+    return candidates
+
+
+def filter_arguments(params):
+    # P0 is swept as the list of its diagonal entries to keep candidates serializable
+    arguments = dict(params)
+    if 'P0' in arguments and np.ndim(arguments['P0']) == 1:
+        arguments['P0'] = np.diag(np.asarray(arguments['P0'], dtype=float))
+    return arguments
+
+
+def evaluate(filter_class, params, cases):
+    rmse = list()
+    for case in cases:
+        try:
+            rmse.append(case.rmse(filter_class(**filter_arguments(params))))
+        except (ValueError, ArithmeticError, np.linalg.LinAlgError):
+            rmse.append(float('inf'))
+    return {'params': params, 'rmse': rmse, 'score': float(np.mean(rmse))}
+
+
+_worker_filter_class = None
+_worker_cases = None
+
+
+def _initialize_worker(filter_class, cases):
+    global _worker_filter_class, _worker_cases
+    _worker_filter_class = filter_class
+    _worker_cases = cases
+
+
+def _evaluate_worker(params):
+    return evaluate(_worker_filter_class, params, _worker_cases)
+
+
+class Sweep:
+    # Evaluates parameter candidates of a filter class against tuning cases. Cases are sent to
+    # every worker process once and candidates are processed in batches. Results are appended to
+    # a JSON lines cache as soon as they are known, so an interrupted sweep resumes from it.
+
+    def __init__(self, filter_class, cases, cache=None, workers=None, batch_size=None):
+        self._filter_class = filter_class
+        self._cases = cases
+        self._cache = cache
+        self._workers = workers if workers is not None else (os.cpu_count() or 1)
+        self._batch_size = batch_size if batch_size is not None else 4*self._workers
+        self._results = dict()
+        if cache is not None and os.path.exists(cache):
+            with open(cache) as f:
+                for line in f:
+                    try:
+                        result = json.loads(line)
+                    except ValueError:
+                        # Last line of an interrupted sweep
+                        continue
+                    self._results[result['key']] = result
+
+    def key(self, params):
+        description = {'filter': self._filter_class.__name__,
+                       'cases': [case.digest() for case in self._cases],
+                       'params': params}
+        text = json.dumps(description, sort_keys=True, default=float)
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def run(self, candidates):
+        keys = [self.key(params) for params in candidates]
+        pending = dict()
+        for key, params in zip(keys, candidates):
+            if key not in self._results and key not in pending:
+                pending[key] = params
+        pending = list(pending.items())
+
+        if pending:
+            if self._workers > 1:
+                with ProcessPoolExecutor(self._workers, initializer=_initialize_worker,
+                                         initargs=(self._filter_class, self._cases)) as executor:
+                    for start in range(0, len(pending), self._batch_size):
+                        batch = pending[start:start + self._batch_size]
+                        results = executor.map(_evaluate_worker, [p for _, p in batch])
+                        self._store([k for k, _ in batch], results)
+            else:
+                for key, params in pending:
+                    self._store([key], [evaluate(self._filter_class, params, self._cases)])
+
+        return sorted((self._results[key] for key in set(keys)), key=lambda r: r['score'])
+
+    def best(self, candidates):
+        results = self.run(candidates)
+        return results[0] if results else None
+
+    def _store(self, keys, results):
+        lines = list()
+        for key, result in zip(keys, results):
+            result['key'] = key
+            self._results[key] = result
+            lines.append(json.dumps(result, sort_keys=True, default=float))
+        if self._cache is not None:
+            with open(self._cache, 'a') as f:
+                for line in lines:
+                    f.write(line + '\n')
@@ -16,14 +16,63 @@
 #   limitations under the License.
 
 import argparse
+import functools
+import itertools
+import os
 import pressalt
 import warnings
-import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor
+from pressalt import profiling
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+import numpy as np
 import pywt
 
 
+@functools.lru_cache(maxsize=1)
+def batch_figure():
+    # Image files are rendered by the Agg canvas without pyplot, which would keep every figure
+    # alive. A single figure is cleared and reused by all plots of a process.
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    return fig
+
+
+@functools.lru_cache(maxsize=1)
+def load_elevation(dem, geoid):
+    # Elevation data is loaded once per process and shared by the recordings of a batch
+    elevation = pressalt.GeoFiles(list(dem))
+    if geoid is not None:
+        try:
+            import PyGeographicLib
+            return elevation, PyGeographicLib.Geoid(geoid)
+        except ImportError as e:
+            warnings.warn("PyGeographicLib module is not available: %s" % str(e))
+            raise
+    return elevation, None
+
+
+def connect_zoom(fig, axes, zoom):
+    # Series given as pairs of a pyramid and a function drawing the samples of given indices
+    # are redrawn whenever the shown range or the size of the axes change
+    shown = [None]
+
+    def update(ax):
+        x_min, x_max = sorted(ax.get_xlim())
+        width = ax.get_window_extent().width
+        if shown[0] == (x_min, x_max, width):
+            return
+        shown[0] = (x_min, x_max, width)
+        for pyramid, draw in zoom:
+            draw(pyramid.indices(x_min, x_max, width))
+
+    for ax in axes:
+        ax.callbacks.connect('xlim_changed', update)
+    fig.canvas.mpl_connect('resize_event', lambda event: update(axes[0]))
+
+
 def make_plot(reader, filter, press_alt, elevation, geoid, heart_rate, output, x_axis, axis_1,
-              axis_2, width, height, dpi, legend):
+              axis_2, width, height, dpi, legend, decimate='none'):
 
     def get_gps_x():
         nonlocal gps_x
@@ -43,6 +92,39 @@ def make_plot(reader, filter, press_alt, elevation, geoid, heart_rate, output, x
                 press_x = reader.press_distance() / 1000
         return press_x
 
+    def get_heart_rate_x(seconds):
+        if x_axis == 'Time':
+            return seconds
+        # Distance along the GPS track at the times of the heart rate samples
+        time = np.asarray(seconds) * 1000.0 + heart_rate.start_time
+        return pressalt.Resampler(time).resample(reader.gps_time(), reader.gps_distance()) / 1000
+
+    def plot(ax, x, y, *args, **kwargs):
+        x, y = np.asarray(x), np.asarray(y)
+        if zoom is not None:
+            pyramid = pressalt.MinMaxPyramid(x, [y])
+            i = pyramid.indices(-np.inf, np.inf, buckets)
+            line, = ax.plot(x[i], y[i], *args, **kwargs)
+            zoom.append((pyramid, lambda i: line.set_data(x[i], y[i])))
+        else:
+            i = pressalt.decimation_indices(decimate, x, [y], buckets)
+            ax.plot(x[i], y[i], *args, **kwargs)
+
+    def fill_between(ax, x, y1, y2, **kwargs):
+        x = np.asarray(x)
+        if zoom is not None:
+            pyramid = pressalt.MinMaxPyramid(x, [y1, y2])
+            i = pyramid.indices(-np.inf, np.inf, buckets)
+            band = [ax.fill_between(x[i], y1[i], y2[i], **kwargs)]
+
+            def draw(i):
+                band[0].remove()
+                band[0] = ax.fill_between(x[i], y1[i], y2[i], **kwargs)
+            zoom.append((pyramid, draw))
+        else:
+            i = pressalt.decimation_indices(decimate, x, [y1, y2], buckets)
+            ax.fill_between(x[i], y1[i], y2[i], **kwargs)
+
     def fill_axis(ax, variables):
         label = None
         if variables is not None:
@@ -50,55 +132,64 @@ def make_plot(reader, filter, press_alt, elevation, geoid, heart_rate, output, x
                 if label is None:
                     label = variables_unit_label[v]
                 if v == 'alt_gps':
-                    ax.plot(get_gps_x(), reader.gps_altitude(), variables_color[v],
-                            label=variables_label[v])
+                    plot(ax, get_gps_x(), reader.gps_altitude(), variables_color[v],
+                         label=variables_label[v])
                 elif v == 'alt_press':
-                    ax.plot(get_press_x(), reader.press_altitude(), variables_color[v],
-                            label=variables_label[v])
+                    plot(ax, get_press_x(), reader.press_altitude(), variables_color[v],
+                         label=variables_label[v])
                 elif v == 'alt_filt':
-                    ax.plot(get_press_x(), press_alt, variables_color[v],
-                            label=variables_label[v])
+                    plot(ax, get_press_x(), press_alt, variables_color[v],
+                         label=variables_label[v])
                 elif v == 'alt_dem':
                     if elevation is None:
                         raise ValueError('No dem data for elevation plot')
                     gps_lon = reader.gps_longitude()
                     gps_lat = reader.gps_latitude()
-                    ax.plot(get_gps_x(), elevation.values(gps_lon, gps_lat, geoid=geoid),
-                            variables_color[v], label=variables_label[v])
+                    plot(ax, get_gps_x(), elevation.values(gps_lon, gps_lat, geoid=geoid),
+                         variables_color[v], label=variables_label[v])
                 elif v == 'alt_filt_sd':
                     alt = filter.altitude()
                     alt_sd = filter.altitude_sd()
-                    ax.fill_between(get_press_x(), alt - alt_sd, alt + alt_sd,
-                                    facecolor=variables_color[v], edgecolor=variables_color[v],
-                                    alpha=0.25)
+                    fill_between(ax, get_press_x(), alt - alt_sd, alt + alt_sd,
+                                 facecolor=variables_color[v], edgecolor=variables_color[v],
+                                 alpha=0.25)
                 elif v == 'press':
-                    ax.plot(get_press_x(), reader.press_pressure(), variables_color[v],
-                            label=variables_label[v])
+                    plot(ax, get_press_x(), reader.press_pressure(), variables_color[v],
+                         label=variables_label[v])
                 elif v == 'press_msl':
-                    ax.plot(get_press_x(), filter.pressure_msl(), variables_color[v],
-                            label=variables_label[v])
+                    plot(ax, get_press_x(), filter.pressure_msl(), variables_color[v],
+                         label=variables_label[v])
                 elif v == 'speed_gps':
-                    ax.plot(get_gps_x(), reader.gps_speed()*3.6, variables_color[v],
-                            label=variables_label[v])
+                    plot(ax, get_gps_x(), reader.gps_speed()*3.6, variables_color[v],
+                         label=variables_label[v])
                 elif v == 'bearing_gps':
-                    ax.plot(get_gps_x(), reader.gps_bearing(), variables_color[v],
-                            label=variables_label[v])
+                    plot(ax, get_gps_x(), reader.gps_bearing(), variables_color[v],
+                         label=variables_label[v])
                 elif v == 'heart_rate':
-                    if x_axis != 'Time':
-                        raise ValueError('Heart rate requires time on horizontal axis')
-                    ax.plot(heart_rate.seconds(), heart_rate.values, variables_color[v],
-                            label=variables_label[v])
+                    plot(ax, get_heart_rate_x(heart_rate.seconds()), heart_rate.values,
+                         variables_color[v], label=variables_label[v])
                 elif v == 'heart_rr':
-                    if x_axis != 'Time':
-                        raise ValueError('RR intervals require time on horizontal axis')
                     time, rr = heart_rate.expand_rr_intervals()
-                    ax.plot(time, rr, 'o', color=variables_color[v], label=variables_label[v])
+                    plot(ax, get_heart_rate_x(time), rr, 'o', color=variables_color[v],
+                         label=variables_label[v])
         return label
 
     gps_x = None
     press_x = None
 
-    fig = plt.figure(figsize=(width, height), dpi=dpi)
+    if output is not None:
+        # Lines are decimated to the width of the image in pixels
+        buckets = int(width*dpi)
+        fig = batch_figure()
+        fig.set_size_inches(width, height)
+        fig.set_dpi(dpi)
+        zoom = None
+    else:
+        # Interactive plots draw the series from min/max pyramids at the detail of the view
+        import matplotlib.pyplot as plt
+        buckets = width*dpi
+        fig = plt.figure(figsize=(width, height), dpi=dpi)
+        zoom = list() if decimate != 'none' else None
 
     ax1 = fig.add_subplot(111)
     ax1.set_xlabel(x_unit_label[x_axis])
@@ -118,11 +209,15 @@ def make_plot(reader, filter, press_alt, elevation, geoid, heart_rate, output, x
 
     if output is not None:
         fig.savefig(output)
+        fig.clf()
     else:
+        if zoom:
+            connect_zoom(fig, (ax1, ax2), zoom)
         plt.pause(0)
+        plt.close(fig)
 
 
-def process_arguments(args):
+def process_file(args, file, output):
 
     def check_unit(variables):
         if variables is not None:
@@ -156,21 +251,12 @@ def process_arguments(args):
 
     if args.dem is not None:
         # Import and load the SRTM elevation data
-        elevation = pressalt.GeoFiles(args.dem)
-        if args.geoid is not None:
-            try:
-                import PyGeographicLib
-                geoid = PyGeographicLib.Geoid(args.geoid)
-            except ImportError as e:
-                warnings.warn("PyGeographicLib module is not available: %s" % str(e))
-                raise
-        else:
-            geoid = None
+        elevation, geoid = load_elevation(tuple(args.dem), args.geoid)
     else:
         elevation = None
         geoid = None
 
-    reader = read_file(args.file, pressalt.GpsPressureReader(), args.legacy)
+    reader = read_file(file, pressalt.GpsPressureReader(), args.legacy)
 
     if args.kml is not None:
         reader.export_to_kml(args.kml)
@@ -180,11 +266,33 @@ def process_arguments(args):
     if not check_unit(args.axis_2):
         raise ValueError('Unit mismatch for axis 2')
 
-    if needs_filter(args.axis_1) or needs_filter(args.axis_2):
+    if needs_filter(args.axis_1) or needs_filter(args.axis_2) or args.export is not None:
         if args.dpss_smooth and args.wavelet_smooth:
             raise ValueError('Only one wavelet or dpss post-smoother can be used at once')
-        filter = filters[args.filter]()
-        filter.execute(reader.gps_events, reader.press_events)
+        if args.temperature:
+            atmosphere = pressalt.LapseRateAtmosphere(reader.temp_events, args.lapse_rate)
+        else:
+            atmosphere = None
+        if args.nmea:
+            # GGA altitudes with the vertical standard deviations as the accuracy
+            gps_events = read_file(file, pressalt.NmeaReader(), args.legacy).gps_events(
+                args.nmea_uere)
+            filter = filters[args.filter](atmosphere=atmosphere, gps_var_factor=1.0)
+        else:
+            gps_events = reader.gps_events
+            filter = filters[args.filter](atmosphere=atmosphere)
+        if args.filter == 'AltitudeAccelFilter':
+            events = (gps_events, reader.press_events, reader.accel_events, reader.gyro_events)
+        else:
+            events = (gps_events, reader.press_events)
+        if args.cache is not None:
+            # Results of the same recording, filter and settings are read from the cache
+            cache = pressalt.ResultCache(args.cache, int(args.cache_size * (1 << 20)))
+            cache.execute(filter, pressalt.file_digest(file), *events, legacy=args.legacy,
+                          nmea=args.nmea, nmea_uere=args.nmea_uere if args.nmea else None,
+                          lapse_rate=args.lapse_rate if args.temperature else None)
+        else:
+            filter.execute(*events)
         if args.dpss_smooth:
             press_alt = reader.smooth(filter.altitude(), args.dpss_n, args.dpss_width)
         elif args.wavelet_smooth:
@@ -195,15 +303,76 @@ def process_arguments(args):
         filter = None
         press_alt = None
 
-    if needs_heart_rate(args.axis_1) or needs_heart_rate(args.axis_2):
-        heart_rate = read_file(args.file, pressalt.HeartRateReader(), args.legacy)
-        heart_rate.expand_time(*reader.time_range())
-        reader.expand_time(*heart_rate.time_range())
+    if needs_heart_rate(args.axis_1) or needs_heart_rate(args.axis_2) or \
+            args.export is not None:
+        heart_rate = read_file(file, pressalt.HeartRateReader(), args.legacy)
+        if heart_rate.start_time is not None:
+            heart_rate.expand_time(*reader.time_range())
+            reader.expand_time(*heart_rate.time_range())
+        else:
+            heart_rate = None
     else:
         heart_rate = None
 
-    make_plot(reader, filter, press_alt, elevation, geoid, heart_rate, args.output, args.x_unit,
-              args.axis_1, args.axis_2, args.width, args.height, args.dpi, args.legend)
+    if args.export is not None:
+        with profiling.span('export_recording'):
+            export_recording(args, file, reader, filter, press_alt, heart_rate)
+        if args.axis_1 is None and args.axis_2 is None:
+            return
+
+    with profiling.span('make_plot'):
+        make_plot(reader, filter, press_alt, elevation, geoid, heart_rate, output,
+                  args.x_unit, args.axis_1, args.axis_2, args.width, args.height, args.dpi,
+                  args.legend, args.decimate)
+
+
+def export_recording(args, file, reader, filter, press_alt, heart_rate):
+    # Parquet dataset partitioned by the recording name
+    if args.dpss_smooth:
+        smoothing = {'method': 'dpss', 'n': args.dpss_n, 'width': args.dpss_width}
+    elif args.wavelet_smooth:
+        smoothing = {'method': 'wavelet', 'levels': args.wavelet_levels, 'wavelet': args.wavelet}
+    else:
+        smoothing = None
+    tables = pressalt.recording_columns(reader, filter, press_alt if smoothing else None,
+                                        heart_rate, args.export_step)
+    metadata = pressalt.export_metadata(reader, filter, smoothing, file=os.path.basename(file),
+                                        nmea=args.nmea, temperature=args.temperature)
+    pressalt.write_dataset(pressalt.arrow_tables(tables, metadata), args.export,
+                           os.path.splitext(os.path.basename(file))[0])
+
+
+def process_arguments(args):
+    # Text recordings don't keep the NMEA sentences, filtering them would use no GPS at all
+    text = [f for f in args.files if f.endswith('.log') or f.endswith('.txt')]
+    if args.nmea and text:
+        raise ValueError('NMEA sentences are recorded only in binary recordings: %s' %
+                         ', '.join(text))
+
+    if len(args.files) == 1 and args.batch_dir is None:
+        process_file(args, args.files[0], args.output)
+        return
+
+    # Batch mode renders every recording into an image file of the batch directory, or only
+    # exports them without the variables to plot
+    if args.output is not None or args.kml is not None:
+        raise ValueError('Output image and kml files are not used in the batch mode')
+    names = [os.path.splitext(os.path.basename(f))[0] for f in args.files]
+    if len(set(names)) != len(names):
+        raise ValueError('Recordings of the same name would share an output file')
+    if args.export is not None and args.axis_1 is None and args.axis_2 is None:
+        outputs = [None] * len(args.files)
+    elif args.batch_dir is None:
+        raise ValueError('Several recordings require the --batch-dir option')
+    else:
+        outputs = [os.path.join(args.batch_dir, name + '.' + args.batch_format) for name in names]
+        os.makedirs(args.batch_dir, exist_ok=True)
+    if args.jobs > 1:
+        with ProcessPoolExecutor(args.jobs) as executor:
+            list(executor.map(process_file, itertools.repeat(args), args.files, outputs))
+    else:
+        for file, output in zip(args.files, outputs):
+            process_file(args, file, output)
 
 
 LABEL_ALTITUDE = 'Altitude [m]'
@@ -215,8 +384,10 @@ LABEL_INTERVAL = 'Interval [ms]'
 
 filters = {'AltitudeFilter': pressalt.AltitudeFilter,
            'AltitudeRateFilter': pressalt.AltitudeRateFilter,
-           'AltitudeRateSmoother': pressalt.AltitudeRateSmoother}
-filters_name = ['AltitudeFilter', 'AltitudeRateFilter', 'AltitudeRateSmoother']
+           'AltitudeRateSmoother': pressalt.AltitudeRateSmoother,
+           'AltitudeAccelFilter': pressalt.AltitudeAccelFilter}
+filters_name = ['AltitudeFilter', 'AltitudeRateFilter', 'AltitudeRateSmoother',
+                'AltitudeAccelFilter']
 
 variables = ['alt_gps', 'alt_press', 'alt_filt', 'alt_filt_sd', 'alt_dem', 'press', 'press_msl',
              'speed_gps', 'bearing_gps', 'heart_rate', 'heart_rr']
@@ -263,8 +434,9 @@ x_unit_label = {'Time': 'Time [s]', 'Distance': 'Distance [km]'}
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Convert binary recording to the text file.',
                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    parser.add_argument('file', type=str,
-                        help='Recording file, for *.log or *.txt files text reader is used.')
+    parser.add_argument('files', type=str, nargs='+', metavar='file',
+                        help='Recording file, for *.log or *.txt files text reader is used. ' +
+                        'Several files are rendered in the batch mode.')
     parser.add_argument('-o', '--output', dest='output', help='Output image file.')
     parser.add_argument('-k', '--kml', dest='kml', help='Output kml file.')
     parser.add_argument('-d', '--dem', dest='dem', nargs='+', help='Digital elevation map files.')
@@ -280,10 +452,42 @@ if __name__ == '__main__':
     parser.add_argument('-2', dest='axis_2', choices=variables, nargs='+',
                         help='Variable to be plotted on a second vertical axis.')
     parser.add_argument('--legacy', action='store_true', help='Use legacy binary mode.')
+    parser.add_argument('--temperature', action='store_true',
+                        help='Compensate the barometric formula with the recorded temperature.')
+    parser.add_argument('--lapse-rate', dest='lapse_rate', type=float, default=0.0065,
+                        help='Temperature lapse rate in K/m for --temperature.')
+    parser.add_argument('--nmea', action='store_true',
+                        help='Filter with the GGA altitudes of the recorded NMEA sentences and ' +
+                        'their VDOP based variances instead of the GPS fixes. Binary recordings ' +
+                        'only.')
+    parser.add_argument('--nmea-uere', dest='nmea_uere', type=float, default=pressalt.NMEA_UERE,
+                        help='User equivalent range error in metres scaling the VDOP for --nmea.')
+    parser.add_argument('--export', dest='export',
+                        help='Directory of a Parquet dataset receiving the raw, filtered and ' +
+                        'smoothed series of the recordings. No plot is made without -1 or -2.')
+    parser.add_argument('--export-step', dest='export_step', type=float,
+                        help='Step in milliseconds of the exported table of all series aligned ' +
+                        'on a common time grid, not exported when missing.')
+    parser.add_argument('--cache', dest='cache',
+                        help='Directory caching the filter results by the recording content, ' +
+                        'the filter and its settings.')
+    parser.add_argument('--cache-size', dest='cache_size', type=float, default=1024,
+                        help='Size bound of the --cache directory in MiB, the least recently ' +
+                        'used results are removed over it.')
     parser.add_argument('--width', dest='width', type=float, default=6.4, help='Plot width.')
     parser.add_argument('--height', dest='height', type=float, default=3.6, help='Plot height.')
     parser.add_argument('--dpi', dest='dpi', type=float, default=100, help='Plot height.')
     parser.add_argument('--legend', dest='legend', help='Plot legend location.')
+    parser.add_argument('--decimate', dest='decimate', choices=pressalt.DECIMATION_METHODS,
+                        default='m4', help='Decimation of the plotted lines to the image width ' +
+                        'in pixels. Interactive plots use min/max pyramids, updated on zoom, ' +
+                        'unless none.')
+    parser.add_argument('--batch-dir', dest='batch_dir',
+                        help='Directory of the images rendered for every recording.')
+    parser.add_argument('--batch-format', dest='batch_format', choices=['png', 'svg'],
+                        default='png', help='Image format of the batch mode.')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=1,
+                        help='Number of processes rendering recordings in the batch mode.')
     parser.add_argument('--dpss-smooth', dest='dpss_smooth', action='store_true',
                         help='Smooth the filtered results using digital Slepian window.')
     parser.add_argument('--dpss-n', dest='dpss_n', type=int, default=51,
@@ -296,7 +500,19 @@ if __name__ == '__main__':
                         help='Wavelet level for smoothing cut-off.')
     parser.add_argument('--wavelet', choices=pywt.wavelist(), dest='wavelet', default='sym4',
                         help='Wavelet function to use, see pywt.wavelist().')
-
+    parser.add_argument('--profile', dest='profile', nargs='?', const='', metavar='TRACE',
+                        help='Print the time spent in every stage and event counts, with a file ' +
+                        'name also write a Chrome trace of the stages.')
 
     args = parser.parse_args()
-    process_arguments(args)
+    if args.profile is not None:
+        profiler = profiling.enable()
+        try:
+            process_arguments(args)
+        finally:
+            profiling.disable()
+            profiler.report()
+            if args.profile:
+                profiler.write_trace(args.profile)
+    else:
+        process_arguments(args)
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  (C) Copyright 2013, 2016 Wojciech Mruczkiewicz
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import pressalt
+
+
+# Modules that reading recordings and running the filters must not import, the package loads
+# them only for the features using them
+HEAVY_MODULES = ('scipy', 'matplotlib', 'pyproj', 'pywt', 'gdal', 'osgeo', 'numba', 'simplekml')
+
+IMPORT_SCRIPT = '''
+import sys, time
+start = time.perf_counter()
+import pressalt
+imported = time.perf_counter()
+pressalt.read_binary, pressalt.GpsPressureReader, pressalt.AltitudeFilter
+pressalt.AltitudeRateFilter, pressalt.AltitudeRateSmoother, pressalt.AltitudeAccelFilter
+used = time.perf_counter()
+print(imported - start, used - start, ' '.join(m for m in %r if m in sys.modules))
+''' % (HEAVY_MODULES,)
+
+
+def measure(run, items, repeat, setup=None):
+    # Wall times of repeated runs, the setup result of every repetition is passed to the run
+    times = list()
+    for _ in range(repeat):
+        state = setup() if setup is not None else None
+        start = time.perf_counter()
+        run(state)
+        times.append(time.perf_counter() - start)
+    best = min(times)
+    return {'best': best, 'mean': sum(times) / len(times), 'items': items,
+            'rate': items / best if best > 0.0 else None}
+
+
+def benchmark_readers(recording, directory, repeat):
+    files = dict()
+    for name, write in (('v10', recording.write_v10), ('v11', recording.write_v11),
+                        ('v12', recording.write_v12), ('text', recording.write_text)):
+        files[name] = os.path.join(directory, 'recording.' + name)
+        write(files[name])
+
+    frames = len(recording.gps) + len(recording.pressure) + len(recording.accel) + \
+        len(recording.temp)
+    text_lines = len(recording.gps) + len(recording.pressure)
+    results = dict()
+    for name in ('v10', 'v11'):
+        results['read_binary.' + name] = measure(
+            lambda _: pressalt.read_binary(files[name], pressalt.GpsPressureReader(), legacy=True),
+            frames, repeat)
+    results['read_binary.v12'] = measure(
+        lambda _: pressalt.read_binary(files['v12'], pressalt.GpsPressureReader()),
+        frames, repeat)
+    results['read_binary.v12_strict'] = measure(
+        lambda _: pressalt.read_binary(files['v12'], pressalt.GpsPressureReader(), recover=False),
+        frames, repeat)
+    results['read_text'] = measure(
+        lambda _: pressalt.read_text(files['text'], pressalt.GpsPressureReader()),
+        text_lines, repeat)
+    return results, files
+
+
+def benchmark_filters(reader, repeat):
+    gps, pressure = reader.gps_events, reader.press_events
+    # Every tenth GPS fix, the steady-state gains pay off only with sparse fixes
+    sparse = gps[::10]
+    cases = (('AltitudeFilter', pressalt.AltitudeFilter, {}, gps),
+             ('AltitudeFilter.steady', pressalt.AltitudeFilter, {'steady_state': True}, gps),
+             ('AltitudeFilter.sparse', pressalt.AltitudeFilter, {}, sparse),
+             ('AltitudeFilter.sparse_steady', pressalt.AltitudeFilter, {'steady_state': True},
+              sparse),
+             ('AltitudeRateFilter', pressalt.AltitudeRateFilter, {}, gps),
+             ('AltitudeRateSmoother', pressalt.AltitudeRateSmoother, {}, gps))
+    results = dict()
+    for name, filter_class, arguments, events in cases:
+        results['execute.' + name] = measure(
+            lambda f: f.execute(events, pressure), len(pressure), repeat,
+            lambda: filter_class(**arguments))
+    results['execute.AltitudeAccelFilter'] = measure(
+        lambda f: f.execute(gps, pressure, reader.accel_events, reader.gyro_events),
+        len(pressure), repeat, pressalt.AltitudeAccelFilter)
+    return results
+
+
+def benchmark_distances(file, repeat):
+    # Distances are cached by the reader, so every repetition reads the recording again
+    def setup():
+        return pressalt.read_binary(file, pressalt.GpsPressureReader())
+    reader = setup()
+    return {'gps_distance': measure(lambda r: r.gps_distance(), len(reader.gps_events), repeat,
+                                    setup),
+            'press_distance': measure(lambda r: r.press_distance(), len(reader.press_events),
+                                      repeat, setup)}
+
+
+def benchmark_elevation(recording, reader, directory, size, repeat):
+    try:
+        geotiff = pressalt.write_geotiff(os.path.join(directory, 'dem.tif'), recording.latitude,
+                                         recording.longitude, size=size)
+        elevation = pressalt.GeoFiles([geotiff])
+    except (ImportError, AttributeError) as e:
+        return {'GeoFiles.values': {'skipped': 'Elevation module is not available: %s' % e}}
+    lon, lat = reader.gps_longitude(), reader.gps_latitude()
+    return {'GeoFiles.values': measure(lambda _: elevation.values(lon, lat), len(lon), repeat)}
+
+
+def benchmark_import(repeat):
+    # Every repetition imports the package in a fresh interpreter
+    times, heavy = list(), set()
+    for _ in range(repeat):
+        output = subprocess.check_output([sys.executable, '-c', IMPORT_SCRIPT],
+                                         universal_newlines=True).split(' ', 2)
+        times.append((float(output[0]), float(output[1])))
+        heavy.update(output[2].split())
+    results = dict()
+    for i, name in enumerate(('import.pressalt', 'import.filters')):
+        best = min(t[i] for t in times)
+        results[name] = {'best': best, 'mean': sum(t[i] for t in times) / len(times), 'items': 1,
+                         'rate': 1.0 / best if best > 0.0 else None}
+    results['import.filters']['heavy_modules'] = sorted(heavy)
+    return results
+
+
+def check_import(repeat):
+    results = benchmark_import(repeat)
+    heavy = results['import.filters']['heavy_modules']
+    for name in ('import.pressalt', 'import.filters'):
+        print('%-36s %10.4fs' % (name, results[name]['best']), file=sys.stderr)
+    if heavy:
+        print('Importing the readers and filters loaded: %s' % ', '.join(heavy), file=sys.stderr)
+    return not heavy
+
+
+def compare(results, baseline):
+    # Ratio of the best times to a previous run, above 1 when slower
+    for name in sorted(results):
+        current, previous = results[name], baseline.get(name)
+        if previous is None or 'best' not in current or 'best' not in previous:
+            continue
+        print('%-36s %10.4fs %10.4fs %7.2fx' % (name, previous['best'], current['best'],
+                                                 current['best'] / previous['best']),
+              file=sys.stderr)
+
+
+def process_arguments(args):
+    recording = pressalt.SyntheticRecording(args.duration, args.gps_rate, args.pressure_rate,
+                                            args.accel_rate, args.temp_rate, seed=args.seed)
+    results = benchmark_import(args.repeat)
+    with tempfile.TemporaryDirectory() as directory:
+        readers, files = benchmark_readers(recording, directory, args.repeat)
+        results.update(readers)
+        reader = pressalt.read_binary(files['v12'], pressalt.GpsPressureReader())
+        results.update(benchmark_filters(reader, args.repeat))
+        results.update(benchmark_distances(files['v12'], args.repeat))
+        if args.dem_size > 0:
+            results.update(benchmark_elevation(recording, reader, directory, args.dem_size,
+                                               args.repeat))
+
+    report = {'version': pressalt.__version__,
+              'python': platform.python_version(),
+              'numpy': np.__version__,
+              'machine': platform.machine(),
+              'parameters': vars(args),
+              'results': results}
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(results, json.load(f)['results'])
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time readers, filters and elevation lookups ' +
+                                     'on synthetic recordings.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-o', '--output', dest='output',
+                        help='Output JSON file, writing to standard output when missing.')
+    parser.add_argument('-c', '--compare', dest='compare',
+                        help='JSON file of a previous run to compare the times with.')
+    parser.add_argument('--duration', dest='duration', type=float, default=3600.0,
+                        help='Recording duration in seconds.')
+    parser.add_argument('--gps-rate', dest='gps_rate', type=float, default=1.0,
+                        help='GPS fixes per second.')
+    parser.add_argument('--pressure-rate', dest='pressure_rate', type=float, default=25.0,
+                        help='Pressure samples per second.')
+    parser.add_argument('--accel-rate', dest='accel_rate', type=float, default=50.0,
+                        help='Accelerometer samples per second.')
+    parser.add_argument('--temp-rate', dest='temp_rate', type=float, default=1.0,
+                        help='Temperature samples per second.')
+    parser.add_argument('--dem-size', dest='dem_size', type=int, default=1024,
+                        help='Size of the synthetic GeoTIFF in pixels, 0 to skip elevation.')
+    parser.add_argument('--repeat', dest='repeat', type=int, default=3,
+                        help='Repetitions of every measurement.')
+    parser.add_argument('--seed', dest='seed', type=int, default=0,
+                        help='Seed of the synthetic recording.')
+    parser.add_argument('--check-import', dest='check_import', action='store_true',
+                        help='Only check that importing the readers and filters loads none of ' +
+                        'the heavy dependencies, failing otherwise.')
+    args = parser.parse_args()
+    if args.check_import:
+        sys.exit(0 if check_import(args.repeat) else 1)
+    process_arguments(args)
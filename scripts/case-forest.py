@@ -17,6 +17,9 @@
 
 import warnings
 import pressalt
+import matplotlib
+# Plots are written to files only
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 
 
@@ -46,6 +49,7 @@ def plot_plot(file, fig, ax, tight, xlabel, ylabel, loc, title=None):
         fig.savefig(file)
     else:
         plt.pause(0)
+    plt.close(fig)
 
 
 def plot_altitude(file, tight, width, height, dpi, loc, title, x_min, x_turn, y_lim, gps_x=None,
@@ -77,11 +81,6 @@ def plot_altitude(file, tight, width, height, dpi, loc, title, x_min, x_turn, y_
 
     plot_plot(file, fig, ax, tight, 'Distance [km]', 'Altitude [m]', loc, title)
 
-    if file is not None:
-        fig.savefig(file)
-    else:
-        plt.pause(0)
-
 
 def plot_forest(reader, filter, prefix, tight=True, width=6.4, height=3.6, dpi=100, elev=None,
                 geoid=None):
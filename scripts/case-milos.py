@@ -17,6 +17,9 @@
 
 import warnings
 import pressalt
+import matplotlib
+# Plots are written to files only
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 
 
@@ -46,6 +49,7 @@ def plot_plot(file, fig, ax, tight, xlabel, ylabel, loc, title=None):
         fig.savefig(file)
     else:
         plt.pause(0)
+    plt.close(fig)
 
 
 def plot_altitude(file, tight, width, height, dpi, x_lim, y_lim, title=None, gps_x=None,
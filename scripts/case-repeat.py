@@ -18,7 +18,10 @@
 import glob
 import warnings
 import pressalt
+import matplotlib
 import matplotlib.patches
+# Plots are written to files only
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import numpy as np
 
@@ -47,6 +50,7 @@ def plot_plot(file, fig, ax, tight, xlabel, ylabel, loc, title=None):
         fig.savefig(file)
     else:
         plt.pause(0)
+    plt.close(fig)
 
 
 def plot_altitudes(filters, altitude, elevation, file, title, tight=True, width=6.4, height=3.6,
@@ -82,20 +86,24 @@ def altitude_press(file, reader, filter):
 
 class AltitudePressMoved:
 
-    def __init__(self, ref_reader, ref_filter, smooth=False):
+    def __init__(self, ref_reader, ref_filter, smooth=False, align=False):
         self.offset = -3.0
         self.ref_reader = ref_reader
         self.ref_alt = ref_filter.altitude_gps()
         self.ref_ind = range(1, self.ref_alt.shape[0] + 1)
         self.ref_dist = ref_reader.gps_distance()
         self.smooth = smooth
+        self.align = align
 
     def __call__(self, file, reader, filter):
         if self.smooth:
             alt = reader.smooth_wavelet(filter.altitude_gps(), 4)
         else:
             alt = filter.altitude_gps()
-        i, iw, d = self.ref_reader.match_points(reader.gps_coordinates(), 10.0)
+        if self.align:
+            i, iw, d = self.ref_reader.align_points(reader.gps_coordinates(), 10.0)
+        else:
+            i, iw, d = self.ref_reader.match_points(reader.gps_coordinates(), 10.0)
         alt_n = np.concatenate((alt, [np.NaN]))
         m = self.ref_reader.mean_offset(i, iw, self.ref_alt, alt_n)
         sd = self.ref_reader.mean_sd(i, iw, self.ref_alt, alt_n)
@@ -154,11 +162,11 @@ if __name__ == '__main__':
     plot_altitudes(filters, altitude_press, None, 'repeat-press-16.png', 'Filtered Altitude',
                    tight=True, width=7.0)
 
-    apm = AltitudePressMoved(filters[0][1], filters[0][2])
+    apm = AltitudePressMoved(filters[0][1], filters[0][2], align=True)
     plot_altitudes(filters, apm, apm.elevation(elevation, geoid), 'repeat-press-moved-16.png',
                    'Filtered Altitude (positioned)', tight=True, width=7.0)
 
-    apms = AltitudePressMoved(filters[0][1], filters[0][2], True)
+    apms = AltitudePressMoved(filters[0][1], filters[0][2], True, align=True)
     plot_altitudes(filters, apms, apms.elevation(elevation, geoid),
                    'repeat-press-moved-smooth-16.png', 'Filtered Altitude (positioned, smoothed)',
                    tight=True, width=7.0)
@@ -16,6 +16,7 @@
 #   limitations under the License.
 
 import argparse
+import sys
 import pressalt
 
 
@@ -25,15 +26,34 @@ def read_file(file, reader, legacy):
     else:
         return pressalt.read_binary(file, reader, legacy)
 
+
+def write_fixes(fixes, file):
+    # Tab separated columns of the parsed fixes with a header
+    print('\t'.join(fixes.dtype.names), file=file)
+    for row in fixes:
+        print('\t'.join(map(str, row)), file=file)
+
+
 parser = argparse.ArgumentParser(description='Convert binary recording to the text file.')
 parser.add_argument('file', type=str, help='File with a binary recording')
 parser.add_argument('-o', '--output', dest='output',
                     help='Output file, writing to standard output when missing')
 parser.add_argument('--legacy', action='store_true', help='Use legacy binary mode.')
+parser.add_argument('--parse', action='store_true',
+                    help='Write the GGA fixes with the dilutions of precision of the GSA ' +
+                    'sentences as columns instead of the raw sentences.')
 args = parser.parse_args()
 
-if args.output is not None:
-    with open(args.output, 'w') as f:
-        pressalt.read_binary(args.file, pressalt.RecordNmeaToText(file=f))
-else:
-    read_file(args.file, pressalt.RecordNmeaToText(), args.legacy)
+output = open(args.output, 'w') if args.output is not None else sys.stdout
+try:
+    if args.parse:
+        nmea = read_file(args.file, pressalt.NmeaReader(), args.legacy)
+        write_fixes(nmea.fixes(), output)
+        if nmea.invalid_count() > 0:
+            print('Skipped %d sentences with a bad checksum' % nmea.invalid_count(),
+                  file=sys.stderr)
+    else:
+        read_file(args.file, pressalt.RecordNmeaToText(file=output), args.legacy)
+finally:
+    if output is not sys.stdout:
+        output.close()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  (C) Copyright 2013, 2016 Wojciech Mruczkiewicz
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import argparse
+import datetime
+import pressalt
+
+
+def read_file(file, reader, legacy):
+    if file.endswith('.log') or file.endswith('.txt'):
+        return pressalt.read_text(file, reader)
+    else:
+        return pressalt.read_binary(file, reader, legacy)
+
+
+def print_rides(store, rides):
+    for ride, coverage in rides:
+        r = store.ride(ride)
+        start = datetime.datetime.fromtimestamp(r['start_time'] / 1000.0, datetime.timezone.utc)
+        line = '%d\t%s\t%s\t%.2f' % (ride, start.strftime('%Y-%m-%d %H:%M:%S'),
+                                     r['path'], (r['distance'] or 0.0) / 1000.0)
+        print(line if coverage is None else line + '\t%.3f' % coverage)
+
+
+def route(store, file, legacy):
+    # Stored track of the recording, read from the file when it is not in the store
+    ride = store.ride_id(file)
+    if ride is not None:
+        latitude, longitude, _ = store.points(ride)
+        return latitude, longitude
+    reader = read_file(file, pressalt.GpsPressureReader(), legacy)
+    return reader.gps_latitude(), reader.gps_longitude()
+
+
+parser = argparse.ArgumentParser(description='Store of the tracks of many recordings with ' +
+                                 'spatial and time queries.')
+parser.add_argument('store', help='SQLite file of the track store, created when missing.')
+parser.add_argument('--start', help='Start date or time of the queried rides, ISO format UTC.')
+parser.add_argument('--end', help='End date or time of the queried rides, ISO format UTC.')
+commands = parser.add_subparsers(dest='command')
+commands.required = True
+ingest = commands.add_parser('ingest', help='Add the recordings or update the changed ones.')
+ingest.add_argument('files', nargs='+', metavar='file', help='Recording file.')
+ingest.add_argument('--legacy', action='store_true', help='Use legacy binary mode.')
+ingest.add_argument('--force', action='store_true', help='Read the unchanged recordings too.')
+commands.add_parser('list', help='Rides in the time range.')
+bbox = commands.add_parser('bbox', help='Rides passing the bounding box in the time range.')
+bbox.add_argument('bounds', type=float, nargs=4, metavar=('west', 'south', 'east', 'north'),
+                  help='Bounding box in degrees.')
+bbox.add_argument('--coarse', action='store_true',
+                  help='Select the rides by their bounding boxes only.')
+near = commands.add_parser('near', help='Rides passing near the track of a recording, with ' +
+                           'the part of the track they cover.')
+near.add_argument('route', help='Recording of the route, stored or read from the file.')
+near.add_argument('--distance', type=float, default=20.0, help='Distance in metres.')
+near.add_argument('--coverage', type=float, default=0.0,
+                  help='Least part of the route the rides pass within the distance.')
+near.add_argument('--legacy', action='store_true', help='Use legacy binary mode.')
+args = parser.parse_args()
+
+with pressalt.TrackStore(args.store) as store:
+    if args.command == 'ingest':
+        ids = store.ingest(args.files, args.legacy, args.force)
+        print('Stored %d recordings, %d in total' % (len(ids), len(store)))
+    elif args.command == 'list':
+        print_rides(store, [(r, None) for r in store.rides(None, args.start, args.end)])
+    elif args.command == 'bbox':
+        print_rides(store, [(r, None) for r in store.rides(args.bounds, args.start, args.end,
+                                                           not args.coarse)])
+    elif args.command == 'near':
+        latitude, longitude = route(store, args.route, args.legacy)
+        print_rides(store, store.near_route(latitude, longitude, args.distance, args.coverage,
+                                            args.start, args.end))